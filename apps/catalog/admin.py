@@ -23,6 +23,8 @@ class CategoryAdmin(DraggableMPTTAdmin):
         "indented_title",
         "slug",
         "is_active",
+        "product_count",
+        "product_count_total",
         "image_preview",
         "created_at",
     )
@@ -58,7 +60,7 @@ class CategoryAdmin(DraggableMPTTAdmin):
 class ProductImageInline(admin.TabularInline):
     model = ProductImage
     extra = 1
-    readonly_fields = ("image_preview",)
+    readonly_fields = ("image_preview", "status")
 
     def image_preview(self, obj):
         if obj.image and getattr(obj.image, "url", None):
@@ -121,7 +123,7 @@ class ProductAdmin(admin.ModelAdmin):
     inlines = [ProductImageInline, CharacteristicsInline]
     prepopulated_fields = {"slug": ("name",)}
 
-    readonly_fields = ("created_at", "updated_at")
+    readonly_fields = ("effective_price", "created_at", "updated_at")
 
     fieldsets = (
         (None, {"fields": ("code", "name", "slug", "category")}),
@@ -133,6 +135,7 @@ class ProductAdmin(admin.ModelAdmin):
                     "old_price",
                     "wholesale_price",
                     "discount",
+                    "effective_price",
                     "promotion",
                 )
             },
@@ -153,10 +156,10 @@ class ProductAdmin(admin.ModelAdmin):
         """
         Показываем первую картинку товара в списке.
         """
-        img = obj.images.first()
-        if img and img.image and getattr(img.image, "url", None):
+        if obj.main_image:
+            url = ProductImage._meta.get_field("image").storage.url(obj.main_image)
             return mark_safe(
-                f'<img src="{img.image.url}" style="max-height:60px; border-radius:6px;" />'
+                f'<img src="{url}" style="max-height:60px; border-radius:6px;" />'
             )
         return "—"
 
@@ -200,9 +203,10 @@ class CharacteristicsAdmin(admin.ModelAdmin):
 
 @admin.register(ProductImage)
 class ProductImageAdmin(admin.ModelAdmin):
-    list_display = ("product", "image_preview")
+    list_display = ("product", "image_preview", "status")
+    list_filter = ("status",)
     search_fields = ("product__name", "product__code")
-    readonly_fields = ("image_preview",)
+    readonly_fields = ("image_preview", "status")
 
     def image_preview(self, obj):
         if obj.image and getattr(obj.image, "url", None):
@@ -0,0 +1,396 @@
+"""
+Кэш ответов каталога.
+
+Ключ = версия каталога + эндпоинт + нормализованный query string.
+Старые ключи не удаляем: после bump_version() они просто перестают читаться
+и вытесняются самим кэшем (LRU / TIMEOUT).
+
+Та же версия даёт валидаторы для HTTP-кэша клиентов (ETag / Last-Modified / 304).
+"""
+import functools
+import hashlib
+import pickle
+import threading
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.models import F, Max, Subquery
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+from .models import CatalogVersion
+
+# товары, картинки, характеристики, категории — всё, что попадает в ответы /products/
+CATALOG = "catalog"
+# структура дерева категорий (tree_id/lft/rght/parent, названия, картинки)
+CATEGORIES = "categories"
+# счётчики товаров в категориях (counts.py) — меняются с каждым товаром, дерево не трогают
+CATEGORY_COUNTS = "category_counts"
+# справочники внутри каждой детальной карточки (категория, названия характеристик)
+PRODUCT_DETAIL = "product_detail"
+# списки похожих товаров (similar.py) — только ответы /products/{slug}/similar/
+SIMILAR = "similar"
+
+
+# ===== версия каталога =====
+def get_version(name: str = CATALOG) -> int:
+    value = (
+        CatalogVersion.objects
+        .filter(name=name)
+        .values_list("value", flat=True)
+        .first()
+    )
+    return value or 0
+
+
+def get_version_info(name: str = CATALOG):
+    """
+    (версия, время последнего изменения) одним запросом — для ETag и Last-Modified.
+    """
+    row = (
+        CatalogVersion.objects
+        .filter(name=name)
+        .values_list("value", "updated_at")
+        .first()
+    )
+    return row or (0, None)
+
+
+def get_versions_info(*names):
+    """
+    (версии в порядке names, время последнего изменения любой из них) одним запросом.
+    """
+    rows = CatalogVersion.objects.filter(name__in=names).values_list("name", "value", "updated_at")
+    rows = {name: (value, updated_at) for name, value, updated_at in rows}
+    values = tuple(rows.get(name, (0, None))[0] for name in names)
+    changed = [rows[name][1] for name in names if name in rows and rows[name][1] is not None]
+    return values, max(changed) if changed else None
+
+
+def get_versions(*names) -> dict:
+    """
+    Несколько версий одним запросом: {"catalog": 12, "categories": 3}.
+    """
+    values = dict(CatalogVersion.objects.filter(name__in=names).values_list("name", "value"))
+    return {name: values.get(name, 0) for name in names}
+
+
+def bump_version(name: str = CATALOG) -> None:
+    """
+    Атомарно увеличивает версию (UPDATE ... SET value = value + 1).
+    Внутри transaction.atomic() новое значение становится видно другим
+    воркерам только вместе с самими изменениями.
+    """
+    now = timezone.now()
+    updated = CatalogVersion.objects.filter(name=name).update(value=F("value") + 1, updated_at=now)
+    if updated:
+        return
+    try:
+        _, created = CatalogVersion.objects.get_or_create(name=name, defaults={"value": 1})
+    except IntegrityError:
+        created = False
+    if not created:
+        CatalogVersion.objects.filter(name=name).update(value=F("value") + 1, updated_at=now)
+
+
+# ===== статистика =====
+class CacheStats:
+    """
+    Счётчики попаданий и размера кэша (в пределах процесса).
+    Размер считаем только для записей текущей версии — старые уже недостижимы.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+        self.entries = 0
+        self.bytes = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stored(self, version: int, size: int):
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self.entries = 0
+                self.bytes = 0
+            self.entries += 1
+            self.bytes += size
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "version": self.version,
+                "entries": self.entries,
+                "bytes": self.bytes,
+            }
+
+
+response_cache_stats = CacheStats()
+
+
+def normalize_query(query_params, allowed, prefixes=()) -> str:
+    """
+    ?page=2&category=5&utm=x&ordering=price -> "category=5&ordering=price&page=2"
+    Неизвестные и пустые параметры отбрасываем, чтобы не плодить ключи.
+    prefixes — динамические параметры вроде attr[12].
+    """
+    items = []
+    for key in sorted(query_params.keys()):
+        if key not in allowed and not key.startswith(tuple(prefixes)):
+            continue
+        for value in sorted(v for v in query_params.getlist(key) if v != ""):
+            items.append((key, value))
+    return urlencode(items)
+
+
+# ===== кэш ответов для ViewSet =====
+class CachedResponseMixin:
+    """
+    Кэширует response.data для list/retrieve (храним уже pickled bytes,
+    чтобы заодно знать размер записи).
+    Абсолютные URL картинок зависят от хоста, поэтому он тоже входит в ключ.
+    """
+
+    # версии, от которых зависит ответ: ключ кэша меняется с любой из них
+    response_cache_version_names = (CATALOG,)
+    response_cache_query_params = ("search", "ordering", "page", "page_size")
+    response_cache_query_prefixes = ()
+    # агрегаты (facets) не зависят от страницы и сортировки — не дробим по ним ключ
+    response_cache_unpaged_actions = ("facets",)
+
+    def get_response_cache_query_params(self):
+        params = set(self.response_cache_query_params)
+        filterset_class = getattr(self, "filterset_class", None)
+        if filterset_class is not None:
+            params.update(filterset_class.base_filters)
+        if self.action in self.response_cache_unpaged_actions:
+            params.difference_update(("ordering", "page", "page_size"))
+            return params
+        pagination_class = getattr(self, "pagination_class", None)
+        if pagination_class is not None:
+            for attr in ("page_query_param", "page_size_query_param", "mode_query_param", "cursor_query_param"):
+                value = getattr(pagination_class, attr, None)
+                if value:
+                    params.add(value)
+        return params
+
+    def get_response_cache_key(self, request, version: int) -> str:
+        query = normalize_query(
+            request.query_params,
+            self.get_response_cache_query_params(),
+            self.response_cache_query_prefixes,
+        )
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field, "")
+        raw = "|".join((request.build_absolute_uri("/"), str(lookup), query))
+        digest = hashlib.md5(raw.encode("utf-8")).hexdigest()
+        return f"catalog:response:{version}:{self.basename}:{self.action}:{digest}"
+
+    def get_response_cache_version_names(self):
+        return self.response_cache_version_names
+
+    def cached_response(self, request, producer):
+        names = self.get_response_cache_version_names()
+        if len(names) == 1:
+            version = get_version(names[0])
+        else:
+            version = "-".join(map(str, get_versions(*names).values()))
+        key = self.get_response_cache_key(request, version)
+
+        payload = cache.get(key)
+        if payload is not None:
+            response_cache_stats.hit()
+            return Response(pickle.loads(payload))
+
+        response_cache_stats.miss()
+        response = producer()
+        if response.status_code == 200:
+            timeout = getattr(settings, "CATALOG_RESPONSE_CACHE_TIMEOUT", 60 * 60)
+            payload = pickle.dumps(response.data, pickle.HIGHEST_PROTOCOL)
+            cache.set(key, payload, timeout)
+            response_cache_stats.stored(version, len(payload))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, functools.partial(super().list, request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request, functools.partial(super().retrieve, request, *args, **kwargs))
+
+
+# ===== условные запросы (ETag / Last-Modified / 304) =====
+def get_last_modified(name: str, version, changed_at, model) -> int | None:
+    """
+    max(updated_at) таблицы и времени последнего bump_version() — unix timestamp.
+    Время версии покрывает удаления, которые max(updated_at) не двигают.
+    Считаем один раз на версию.
+    """
+    label = model._meta.label_lower if model is not None else ""
+    key = f"catalog:last_modified:{name}:{version}:{label}"
+    value = cache.get(key)
+    if value is not None:
+        return value or None
+
+    candidates = [changed_at]
+    if model is not None:
+        candidates.append(model.objects.aggregate(value=Max("updated_at"))["value"])
+    candidates = [c for c in candidates if c is not None]
+    value = int(max(candidates).timestamp()) if candidates else 0
+    cache.set(key, value, getattr(settings, "CATALOG_RESPONSE_CACHE_TIMEOUT", 60 * 60))
+    return value or None
+
+
+class ConditionalResponseMixin:
+    """
+    ETag / Last-Modified для GET-эндпоинтов каталога и 304 по If-None-Match /
+    If-Modified-Since — до запросов к каталогу и сериализаторов (нужна только версия).
+
+    ETag сильный: ответ однозначно определяется версией, эндпоинтом, хостом
+    (абсолютные URL картинок), lookup-ом, query string и форматом ответа.
+    Cache-Control — из settings.CATALOG_CACHE_CONTROL по "<basename>:<action>" или "<basename>".
+    """
+
+    # версии, от которых зависит ответ (категории: дерево + счётчики товаров)
+    conditional_version_names = (CATALOG,)
+    # чья колонка updated_at попадает в Last-Modified
+    conditional_model = None
+
+    def get_conditional_version_names(self):
+        return self.conditional_version_names
+
+    def get_etag(self, request, version) -> str:
+        query = urlencode(sorted((k, v) for k in request.query_params for v in request.query_params.getlist(k)))
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field, "")
+        raw = "|".join(
+            (
+                f"{','.join(self.get_conditional_version_names())}:{version}",
+                self.basename or "",
+                self.action or "",
+                request.build_absolute_uri("/"),
+                str(lookup),
+                query,
+                getattr(request, "accepted_media_type", "") or "",
+            )
+        )
+        return quote_etag(hashlib.md5(raw.encode("utf-8")).hexdigest())
+
+    def get_cache_control(self) -> dict:
+        config = getattr(settings, "CATALOG_CACHE_CONTROL", {}) or {}
+        return config.get(f"{self.basename}:{self.action}", config.get(self.basename, {}))
+
+    def set_validators(self, response, etag: str, last_modified: int | None):
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified)
+        cache_control = self.get_cache_control()
+        if cache_control:
+            patch_cache_control(response, public=True, **cache_control)
+        # JSON и browsable API по одному URL
+        patch_vary_headers(response, ("Accept",))
+
+    def conditional_response(self, request, producer):
+        if request.method not in ("GET", "HEAD"):
+            return producer()
+
+        names = self.get_conditional_version_names()
+        if len(names) == 1:
+            version, changed_at = get_version_info(names[0])
+        else:
+            versions, changed_at = get_versions_info(*names)
+            version = "-".join(map(str, versions))
+        etag = self.get_etag(request, version)
+        last_modified = get_last_modified(",".join(names), version, changed_at, self.conditional_model)
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = producer()
+        if response.status_code in (200, 304):
+            self.set_validators(response, etag, last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(request, functools.partial(super().list, request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(request, functools.partial(super().retrieve, request, *args, **kwargs))
+
+
+# ===== кэш детальной карточки =====
+class ProductDetailCache:
+    """
+    /products/{slug}/ по slug, а не по версии всего каталога: webhook по одному
+    товару не сбрасывает карточки остальных.
+
+    Запись: {"stamp": (updated_at товара, поколение справочников), "hosts": {host: pickled data}}.
+    Перед отдачей stamp сверяется одним запросом по индексу slug — так карточку,
+    изменённую в другом процессе (свой LocMem-кэш), мы не отдадим. Картинки и
+    характеристики двигают Product.updated_at (signals.product_touch), категории и
+    CharacteristicsDict — поколение PRODUCT_DETAIL. Записи, изменённые в обход
+    сигналов (queryset.update), живут не дольше CATALOG_DETAIL_CACHE_TIMEOUT.
+    """
+
+    def __init__(self):
+        self.stats = CacheStats()
+
+    @staticmethod
+    def key(slug: str) -> str:
+        return f"catalog:product:{hashlib.md5(slug.encode('utf-8')).hexdigest()}"
+
+    @staticmethod
+    def get_stamp(queryset, slug: str):
+        """
+        (updated_at, поколение) видимого товара или None — один запрос.
+        """
+        generation = CatalogVersion.objects.filter(name=PRODUCT_DETAIL).values("value")[:1]
+        row = (
+            queryset
+            .filter(slug=slug)
+            .annotate(detail_generation=Subquery(generation))
+            .values_list("updated_at", "detail_generation")
+            .first()
+        )
+        if row is None:
+            return None
+        return row[0].isoformat(), row[1] or 0
+
+    def get(self, slug: str, host: str, stamp):
+        entry = cache.get(self.key(slug))
+        if entry is not None and entry["stamp"] == stamp and host in entry["hosts"]:
+            self.stats.hit()
+            return pickle.loads(entry["hosts"][host])
+        self.stats.miss()
+        return None
+
+    def set(self, slug: str, host: str, stamp, data):
+        key = self.key(slug)
+        entry = cache.get(key)
+        if entry is None or entry["stamp"] != stamp:
+            entry = {"stamp": stamp, "hosts": {}}
+        payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        entry["hosts"][host] = payload
+        cache.set(key, entry, getattr(settings, "CATALOG_DETAIL_CACHE_TIMEOUT", 5 * 60))
+        self.stats.stored(0, len(payload))
+
+    def evict(self, *slugs):
+        keys = [self.key(slug) for slug in set(slugs) if slug]
+        if keys:
+            cache.delete_many(keys)
+
+
+product_detail_cache = ProductDetailCache()
@@ -0,0 +1,124 @@
+"""
+Лента изменений товаров: GET /products/changes/?since=<токен> — что поменялось
+после токена, чтобы клиент с локальной копией каталога не качал её заново.
+
+Журнал ProductChange пишут сигналы товара (вебхук CRM, админка, удаление
+по product.deleted), картинок / характеристик (они часть карточки) и удаление
+категории (SET_NULL у товаров проходит без сигналов). Токен —
+закодированный id последней отданной строки журнала: id растут в порядке commit,
+SQLite пишет транзакции по одной.
+
+Старые строки удаляет catalog_prune_changes (CATALOG_CHANGES_RETENTION_DAYS).
+Токен старше удалённого хвоста -> 410: изменения потеряны, клиент перекачивает
+каталог (/snapshot/) целиком.
+"""
+import base64
+import binascii
+import json
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .models import ProductChange
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+class TokenExpired(Exception):
+    pass
+
+
+@dataclass
+class ChangeBatch:
+    upserted: list = field(default_factory=list)  # id товаров в порядке изменений
+    deleted: list = field(default_factory=list)
+    last_id: int = 0
+    has_more: bool = False
+
+
+def get_page_size() -> int:
+    return int(getattr(settings, "CATALOG_CHANGES_PAGE_SIZE", 500))
+
+
+# ===== токен =====
+def encode_token(change_id: int) -> str:
+    raw = json.dumps({"c": change_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_token(token: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        change_id = int(json.loads(raw.decode("utf-8"))["c"])
+    except (TypeError, ValueError, KeyError, binascii.Error, UnicodeDecodeError):
+        raise InvalidToken(token)
+    if change_id < 0:
+        raise InvalidToken(token)
+    return change_id
+
+
+# ===== запись =====
+def record_change(product_id, kind: str, using=None):
+    ProductChange.objects.using(using).create(product_id=product_id, kind=kind)
+
+
+def record_changes(product_ids, kind: str, using=None):
+    ProductChange.objects.using(using).bulk_create(
+        ProductChange(product_id=product_id, kind=kind) for product_id in product_ids
+    )
+
+
+def current_token() -> str:
+    return encode_token(ProductChange.objects.aggregate(last=Max("id"))["last"] or 0)
+
+
+# ===== чтение =====
+def read_changes(since: int, limit: int | None = None) -> ChangeBatch:
+    """
+    Изменения после since: по каждому товару — последнее из попавших в страницу.
+    """
+    limit = limit or get_page_size()
+    oldest = ProductChange.objects.aggregate(first=Min("id"))["first"]
+    # строки после since уже удалены — часть изменений клиент не увидит
+    if oldest is not None and since < oldest - 1:
+        raise TokenExpired(since)
+
+    rows = list(
+        ProductChange.objects
+        .filter(id__gt=since)
+        .order_by("id")
+        .values_list("id", "product_id", "kind")[:limit + 1]
+    )
+    batch = ChangeBatch(last_id=since, has_more=len(rows) > limit)
+    rows = rows[:limit]
+
+    latest = {}
+    for change_id, product_id, kind in rows:
+        # повторное изменение двигает товар в конец, как в журнале
+        latest.pop(product_id, None)
+        latest[product_id] = kind
+        batch.last_id = change_id
+
+    for product_id, kind in latest.items():
+        (batch.deleted if kind == ProductChange.DELETE else batch.upserted).append(product_id)
+    return batch
+
+
+def prune_changes(days: int | None = None) -> int:
+    """
+    Удаляет строки старше days дней; последняя строка остаётся всегда — по ней
+    read_changes отличает обрезанный журнал от пустого.
+    """
+    if days is None:
+        days = int(getattr(settings, "CATALOG_CHANGES_RETENTION_DAYS", 30))
+    last = ProductChange.objects.aggregate(last=Max("id"))["last"]
+    if last is None:
+        return 0
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted, _ = ProductChange.objects.filter(created_at__lt=cutoff, id__lt=last).delete()
+    return deleted
@@ -0,0 +1,91 @@
+"""
+Счётчики товаров в категориях для меню: Category.product_count (товары самой категории)
+и Category.product_count_total (вместе с подкатегориями). Считаются только товары
+витрины — is_active и is_available.
+
+Полный пересчёт — один GROUP BY category_id, сумма по ветке собирается проходом
+по категориям в порядке (tree_id, lft) со стеком открытых предков (по rght).
+Изменения товара (вебхук CRM, админка) двигают счётчики точечно: -1 старой категории
+и её предкам, +1 новой (signals.category_counts_product_*). Перенос и удаление
+категорий — полный пересчёт.
+
+Изменение счётчиков двигает свою версию CATEGORY_COUNTS, а не CATEGORIES: поиск
+и снимок каталога следят только за структурой дерева и не пересобираются целиком
+из-за каждого товара.
+"""
+from django.db.models import Count, F, Value
+from django.db.models.functions import Greatest
+
+from .cache import CATEGORY_COUNTS, bump_version
+from .models import LIVE_PRODUCTS, Category, Product
+
+
+def compute_category_counts() -> dict:
+    """
+    {id категории: (товаров в самой категории, вместе с подкатегориями)}
+    """
+    direct = dict(
+        Product.objects
+        .filter(LIVE_PRODUCTS, category__isnull=False)
+        .order_by()
+        .values_list("category_id")
+        .annotate(count=Count("id"))
+    )
+    totals = {}
+    stack = []  # открытые предки: (tree_id, rght, id)
+    for pk, tree_id, lft, rght in Category.objects.order_by("tree_id", "lft").values_list("id", "tree_id", "lft", "rght"):
+        while stack and (stack[-1][0] != tree_id or stack[-1][1] < lft):
+            stack.pop()
+        count = direct.get(pk, 0)
+        totals[pk] = count
+        for _, _, ancestor in stack:
+            totals[ancestor] += count
+        stack.append((tree_id, rght, pk))
+    return {pk: (direct.get(pk, 0), total) for pk, total in totals.items()}
+
+
+def rebuild_category_counts() -> int:
+    """
+    Полный пересчёт, пишем только разошедшиеся строки. -> сколько категорий исправлено.
+    """
+    counts = compute_category_counts()
+    changed = []
+    for category in Category.objects.only("id", "product_count", "product_count_total"):
+        expected = counts.get(category.pk, (0, 0))
+        if (category.product_count, category.product_count_total) != expected:
+            category.product_count, category.product_count_total = expected
+            changed.append(category)
+    if changed:
+        # bulk_update не шлёт сигналов и не трогает updated_at
+        Category.objects.bulk_update(changed, ["product_count", "product_count_total"], batch_size=500)
+        bump_version(CATEGORY_COUNTS)
+    return len(changed)
+
+
+def _shift(category_id, delta: int, using) -> bool:
+    node = Category.objects.using(using).filter(pk=category_id).values("tree_id", "lft", "rght").first()
+    if node is None:
+        return False
+    categories = Category.objects.using(using)
+    categories.filter(pk=category_id).update(product_count=Greatest(F("product_count") + delta, Value(0)))
+    # категория и все её предки: lft <= node.lft и rght >= node.rght в том же дереве
+    categories.filter(tree_id=node["tree_id"], lft__lte=node["lft"], rght__gte=node["rght"]).update(
+        product_count_total=Greatest(F("product_count_total") + delta, Value(0))
+    )
+    return True
+
+
+def shift_category_counts(old, new, using="default") -> bool:
+    """
+    Товар перешёл из состояния old в new (Product.get_count_key() или None — товара не было / нет).
+    """
+    if old == new:
+        return False
+    changed = False
+    for key, delta in ((old, -1), (new, 1)):
+        if key is None:
+            continue
+        category_id, counted = key
+        if category_id is not None and counted:
+            changed |= _shift(category_id, delta, using)
+    return changed
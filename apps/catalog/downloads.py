@@ -0,0 +1,195 @@
+"""
+Скачивание картинок CRM для вебхука товаров (sync_product_images).
+
+Вебхук с сотнями товаров по несколько картинок качал их по одной, каждая —
+новое TCP+TLS соединение и до 12 с ожидания. Здесь:
+    - общий requests.Session на процесс: keep-alive, соединения переиспользуются;
+    - до CRM_WEBHOOK_IMAGE_WORKERS загрузок одновременно, не больше
+      CRM_WEBHOOK_IMAGE_PER_HOST на один хост;
+    - CRM_WEBHOOK_IMAGE_BUDGET секунд на весь вебхук: что не успело — ошибка
+      "time budget exceeded", картинка докачается следующим вебхуком (source_url не сохранён).
+
+Вебхук заранее ставит в очередь все недостающие URL (prefetch), sync_product_images
+забирает результаты по порядку (get) — порядок картинок товара не меняется.
+Вперёд качается не больше окна (2 × потоков): скачанные байты держатся в памяти,
+пока их не заберёт get().
+"""
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+USER_AGENT = "Ak-KagazWebhook/1.0"
+BUDGET_EXCEEDED = "time budget exceeded"
+
+
+@dataclass
+class Download:
+    url: str
+    content: bytes | None = None
+    error: str | None = None
+
+
+def get_workers() -> int:
+    return max(1, int(getattr(settings, "CRM_WEBHOOK_IMAGE_WORKERS", 8)))
+
+
+def get_per_host() -> int:
+    return max(1, int(getattr(settings, "CRM_WEBHOOK_IMAGE_PER_HOST", 4)))
+
+
+def get_budget() -> float:
+    return float(getattr(settings, "CRM_WEBHOOK_IMAGE_BUDGET", 60))
+
+
+def get_max_bytes() -> int:
+    return int(getattr(settings, "CRM_WEBHOOK_MAX_IMAGE_BYTES", 10_000_000) or 10_000_000)
+
+
+# ===== общий пул соединений =====
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Один Session на процесс: urllib3 держит открытые соединения к каждому хосту
+    (до CRM_WEBHOOK_IMAGE_PER_HOST), следующие вебхуки их переиспользуют.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=get_per_host())
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = USER_AGENT
+            _session = session
+        return _session
+
+
+class ImageDownloader:
+    """
+    Загрузки одного вебхука. Использовать как контекстный менеджер: на выходе
+    незапущенные загрузки отменяются.
+    """
+
+    def __init__(self, *, budget=None, workers=None, per_host=None, max_bytes=None, timeout=None, window=None):
+        self.deadline = time.monotonic() + (get_budget() if budget is None else budget)
+        self.per_host = per_host or get_per_host()
+        self.max_bytes = max_bytes or get_max_bytes()
+        # (connect, read); read дополнительно режется остатком бюджета
+        self.timeout = timeout or tuple(getattr(settings, "CRM_WEBHOOK_IMAGE_TIMEOUT", (5, 12)))
+        self.session = get_session()
+        workers = workers or get_workers()
+        self.window = window or 2 * workers
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="crm-image")
+        self._hosts = defaultdict(lambda: threading.BoundedSemaphore(self.per_host))
+        self._hosts_lock = threading.Lock()
+        self._waiting = deque()  # ещё не запущены, в порядке prefetch
+        self._futures = {}  # запущены и не забраны get(), в порядке запуска
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._waiting.clear()
+        self._futures.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def prefetch(self, urls):
+        known = set(self._waiting) | self._futures.keys()
+        for url in urls:
+            if url not in known:
+                known.add(url)
+                self._waiting.append(url)
+        self._fill()
+
+    def _fill(self):
+        while self._waiting and len(self._futures) < self.window:
+            url = self._waiting.popleft()
+            self._futures[url] = self._executor.submit(self._download, url)
+
+    def get(self, url) -> Download:
+        if url in self._futures:
+            # запущенные раньше и не забранные — пропущены (товар упал до картинок):
+            # не держим их байты и место в окне
+            for skipped in list(itertools.takewhile(lambda key: key != url, self._futures)):
+                self._futures.pop(skipped).cancel()
+            future = self._futures.pop(url)
+        else:
+            # вне окна — запускаем сразу, в обход очереди
+            if url in self._waiting:
+                self._waiting.remove(url)
+            future = self._executor.submit(self._download, url)
+        self._fill()
+        try:
+            return future.result(timeout=max(self.remaining(), 0))
+        except FutureTimeout:
+            future.cancel()
+            return Download(url, error=BUDGET_EXCEEDED)
+
+    # ===== в потоке пула =====
+    def _host_slot(self, url):
+        host = urlparse(url).netloc.lower()
+        with self._hosts_lock:
+            return self._hosts[host]
+
+    def _download(self, url) -> Download:
+        slot = self._host_slot(url)
+        if not slot.acquire(timeout=max(self.remaining(), 0)):
+            return Download(url, error=BUDGET_EXCEEDED)
+        try:
+            return self._fetch(url)
+        except requests.Timeout:
+            if self.remaining() <= 0:
+                return Download(url, error=BUDGET_EXCEEDED)
+            return Download(url, error="exception: Timeout")
+        except Exception as e:
+            return Download(url, error=f"exception: {type(e).__name__}")
+        finally:
+            slot.release()
+
+    def _fetch(self, url) -> Download:
+        remaining = self.remaining()
+        if remaining <= 0:
+            return Download(url, error=BUDGET_EXCEEDED)
+        connect, read = self.timeout
+        with self.session.get(url, timeout=(min(connect, remaining), min(read, remaining)), stream=True) as resp:
+            if resp.status_code >= 400:
+                return Download(url, error=f"http {resp.status_code}")
+
+            content_type = (resp.headers.get("Content-Type") or "").lower()
+            if content_type and not content_type.startswith("image/"):
+                return Download(url, error=f"content-type {content_type}")
+
+            content_length = resp.headers.get("Content-Length")
+            if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+                return Download(url, error="too large")
+
+            chunks = []
+            total = 0
+            for chunk in resp.iter_content(chunk_size=64 * 1024):
+                if not chunk:
+                    continue
+                total += len(chunk)
+                if total > self.max_bytes:
+                    return Download(url, error="too large")
+                if self.remaining() <= 0:
+                    return Download(url, error=BUDGET_EXCEEDED)
+                chunks.append(chunk)
+            return Download(url, content=b"".join(chunks))
@@ -0,0 +1,174 @@
+"""
+Фоновая обработка картинок товаров: LANCZOS и WEBP method=6 — до секунды CPU на
+картинку, в потоке запроса это держит GIL и весь воркер сервера.
+
+ProductImage.save() с новым файлом пишет исходник как есть (status=pending) и после
+commit ставит задачу сюда. Задача: поток пула читает исходник из storage, отдаёт
+байты процессу (process_image_bytes), результат записывает рядом и подменяет файл
+в записи (ProductImage.apply_processed). Потоков столько же, сколько процессов —
+остальные задачи ждут в очереди. Задача одна на исходник: те же байты, загруженные
+в другую запись, пока первая ещё в работе, новой обработки не запускают — готовый
+результат применяется ещё раз.
+
+CATALOG_IMAGE_WORKERS — число процессов; 0 — обработка прямо в запросе.
+Очередь живёт в памяти процесса сервера: задачи, не доделанные до перезапуска,
+добирает catalog_rebuild --only pending_images.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from apps.utils import get_rendition_widths, process_image_bytes
+
+logger = logging.getLogger(__name__)
+
+
+def get_worker_count() -> int:
+    return max(0, int(getattr(settings, "CATALOG_IMAGE_WORKERS", 2)))
+
+
+class ImageJobPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._processes = None
+        self._threads = None
+        self._size = 0
+        self._active = {}  # исходник -> пришли ли ещё записи, пока он в работе
+        self.queued = 0  # поставлены и ещё не закончены, включая running
+        self.running = 0
+        self.processed = 0
+        self.failed = 0
+        self._process_seconds = 0.0
+        self._total_seconds = 0.0
+        self._max_seconds = 0.0
+        self._last_seconds = None
+
+    def enabled(self) -> bool:
+        return get_worker_count() > 0
+
+    def _executors(self):
+        size = get_worker_count()
+        with self._lock:
+            if self._threads is None or self._size != size:
+                old = (self._processes, self._threads)
+                # spawn, а не fork: сервер многопоточный, форк мог бы унести чужие блокировки
+                self._processes = ProcessPoolExecutor(size, mp_context=multiprocessing.get_context("spawn"))
+                self._threads = ThreadPoolExecutor(size, thread_name_prefix="catalog-image")
+                self._size = size
+                for executor in old:
+                    if executor is not None:
+                        executor.shutdown(wait=False)
+            return self._processes, self._threads
+
+    def _reset_processes(self, broken):
+        with self._lock:
+            if self._processes is broken:
+                self._processes = ProcessPoolExecutor(self._size, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, storage, name, on_done, on_error=None):
+        """
+        Ужать файл name из storage. on_done(main, renditions) / on_error() вызываются
+        в потоке пула — со своим соединением с БД. name уже в работе — on_done/on_error
+        той задачи вызовутся ещё раз, по новым записям.
+        """
+        _, threads = self._executors()
+        with self._lock:
+            if name in self._active:
+                self._active[name] = True
+                return
+            self._active[name] = False
+            self.queued += 1
+        threads.submit(self._run, time.monotonic(), storage, name, on_done, on_error)
+
+    def _run(self, enqueued, storage, name, on_done, on_error):
+        with self._lock:
+            self.running += 1
+        processes, _ = self._executors()
+        seconds = None
+        close_old_connections()
+        try:
+            with storage.open(name, "rb") as f:
+                data = f.read()
+            try:
+                main, renditions, seconds = processes.submit(process_image_bytes, data, get_rendition_widths()).result()
+            except BrokenProcessPool:
+                # процесс убит (OOM и т.п.) — пул больше не принимает задачи, поднимаем новый
+                self._reset_processes(processes)
+                raise
+            on_done(main, renditions)
+            while self._again(name):
+                on_done(main, renditions)
+        except Exception:
+            logger.exception("Image processing failed: %s", name)
+            seconds = None
+            if on_error is not None:
+                try:
+                    on_error()
+                    while self._again(name):
+                        on_error()
+                except Exception:
+                    logger.exception("Image processing on_error failed: %s", name)
+        finally:
+            close_old_connections()
+            with self._lock:
+                self._active.pop(name, None)
+                self.queued -= 1
+                self.running -= 1
+                if seconds is None:
+                    self.failed += 1
+                else:
+                    self.processed += 1
+                    self._process_seconds += seconds
+                    self._total_seconds += time.monotonic() - enqueued
+                    self._max_seconds = max(self._max_seconds, seconds)
+                    self._last_seconds = seconds
+                self._idle.notify_all()
+
+    def _again(self, name) -> bool:
+        """
+        Пока шла задача, тот же исходник поставили ещё раз? Нет — задача закончена:
+        следующий submit запустит новую.
+        """
+        with self._lock:
+            if self._active.get(name):
+                self._active[name] = False
+                return True
+            self._active.pop(name, None)
+            return False
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Дождаться пустой очереди (команды, тесты). -> False, если не дождались.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self.queued == 0, timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            done = self.processed
+
+            def ms(value):
+                return None if value is None else round(value * 1000, 1)
+
+            return {
+                "workers": get_worker_count(),
+                "queue_depth": self.queued - self.running,
+                "running": self.running,
+                "processed": done,
+                "failed": self.failed,
+                # время в процессе обработки (resize + encode) и от постановки до подмены файла
+                "avg_processing_ms": ms(self._process_seconds / done) if done else None,
+                "max_processing_ms": ms(self._max_seconds) if done else None,
+                "last_processing_ms": ms(self._last_seconds),
+                "avg_total_ms": ms(self._total_seconds / done) if done else None,
+            }
+
+
+image_jobs = ImageJobPool()
@@ -0,0 +1,290 @@
+"""
+Замеры производительности каталога на синтетических данных.
+
+    python manage.py catalog_benchmark search --sizes 10000 100000
+
+Данные создаются внутри транзакции и откатываются в конце — рабочая БД не меняется.
+"""
+import random
+import statistics
+import time
+from decimal import Decimal
+from functools import reduce
+from operator import and_
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from apps.catalog.models import (
+    Category,
+    Characteristics,
+    CharacteristicsDict,
+    Product,
+    ProductImage,
+    main_image_subquery,
+    normalize_characteristic_value,
+)
+from apps.catalog.search import ProductSearchIndex
+
+WORDS = (
+    "бумага офисная тетрадь ручка шариковая гелевая карандаш папка регистратор "
+    "скрепки степлер маркер текстовыделитель клей ластик линейка блокнот ежедневник "
+    "конверт файл скотч калькулятор корректор точилка альбом краски кисть пенал"
+).split()
+COLORS = "синий красный черный зеленый белый желтый".split()
+FORMATS = "A3 A4 A5 A6".split()
+
+
+class Rollback(Exception):
+    pass
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+class Command(BaseCommand):
+    help = "Бенчмарки каталога на синтетических товарах (данные откатываются)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenario", choices=sorted(self.scenarios()))
+        parser.add_argument("--sizes", nargs="+", type=int, default=[10_000, 100_000])
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=42)
+
+    @classmethod
+    def scenarios(cls):
+        return {name[len("bench_"):] for name in dir(cls) if name.startswith("bench_")}
+
+    def handle(self, *args, **options):
+        bench = getattr(self, f"bench_{options['scenario']}")
+        for size in options["sizes"]:
+            random.seed(options["seed"])
+            try:
+                with transaction.atomic():
+                    started = time.perf_counter()
+                    self.generate(size)
+                    self.stdout.write(f"\n== {size} products (generated in {time.perf_counter() - started:.1f}s)")
+                    bench(size, options["repeat"])
+                    raise Rollback
+            except Rollback:
+                pass
+
+    # ---------- данные ----------
+    def generate(self, size):
+        roots = [Category.objects.create(name=f"Раздел {i}", slug=f"bench-root-{i}") for i in range(5)]
+        categories = roots + [
+            Category.objects.create(name=f"Подраздел {i}", slug=f"bench-sub-{i}", parent=roots[i % len(roots)])
+            for i in range(25)
+        ]
+        keys = [
+            CharacteristicsDict.objects.create(title="Формат"),
+            CharacteristicsDict.objects.create(title="Цвет"),
+            CharacteristicsDict.objects.create(title="Плотность", unit="г/м²"),
+        ]
+
+        products = []
+        for i in range(size):
+            name = " ".join(random.sample(WORDS, 2)).capitalize() + f" {random.choice(COLORS)} {i}"
+            price = Decimal(random.randint(10, 5000))
+            discount = random.choice((0, 0, 0, 5, 10, 20))
+            products.append(
+                Product(
+                    code=f"BN-{i:07d}",
+                    name=name,
+                    slug=f"bench-{i}",
+                    category=random.choice(categories),
+                    price=price,
+                    wholesale_price=Decimal(random.randint(5, 4000)),
+                    discount=discount,
+                    # bulk_create не вызывает save()
+                    effective_price=Product.compute_effective_price(price, discount),
+                    promotion=random.random() < 0.1,
+                    quantity=random.randint(0, 100),
+                    is_available=random.random() < 0.95,
+                )
+            )
+        Product.objects.bulk_create(products, batch_size=2000)
+
+        chars = []
+        for pk in Product.objects.filter(code__startswith="BN-").values_list("id", flat=True):
+            for key, value in (
+                (keys[0], random.choice(FORMATS)),
+                (keys[1], random.choice(COLORS)),
+                (keys[2], str(random.choice((60, 80, 120, 160)))),
+            ):
+                # bulk_create не вызывает save() — нормализуем сами
+                chars.append(
+                    Characteristics(
+                        product_id=pk,
+                        key=key,
+                        value=value,
+                        value_normalized=normalize_characteristic_value(value),
+                    )
+                )
+        Characteristics.objects.bulk_create(chars, batch_size=5000)
+        self.keys = keys
+
+        # картинки — только записи (файлы для замеров не нужны)
+        images = [
+            ProductImage(product_id=pk, image=f"products/{pk}/{n}.webp")
+            for pk in Product.objects.filter(code__startswith="BN-").values_list("id", flat=True)
+            for n in range(random.randint(0, 6))
+        ]
+        ProductImage.objects.bulk_create(images, batch_size=5000)
+        # bulk_create обходит сигналы — главную картинку проставляем сами
+        Product.objects.filter(code__startswith="BN-").update(main_image=main_image_subquery())
+
+    # ---------- сценарии ----------
+    def bench_list(self, size, repeat):
+        """
+        GET /products/?page_size=200: ProductListSerializer vs ProductListRowSerializer.
+        """
+        from django.core.cache import cache
+        from django.test import RequestFactory, override_settings
+        from rest_framework.renderers import JSONRenderer
+
+        from apps.catalog.views import ProductViewSet
+
+        view = ProductViewSet.as_view({"get": "list"})
+        factory = RequestFactory()
+
+        def render(fast, query):
+            with override_settings(CATALOG_FAST_LIST_SERIALIZATION=fast):
+                cache.clear()  # меряем без кэша ответов
+                response = view(factory.get("/api/catalog/products/", query))
+                return JSONRenderer().render(response.data)
+
+        self.stdout.write(f"{'query':<32}{'serializer ms':>15}{'values ms':>12}{'speedup':>9}  same")
+        for query in (
+            {"page_size": 200},
+            {"page_size": 200, "ordering": "price", "page": 5},
+            {"page_size": 200, "pagination": "cursor", "ordering": "-created_at"},
+        ):
+            slow_ms = timed(lambda: render(False, query), repeat)
+            fast_ms = timed(lambda: render(True, query), repeat)
+            same = render(False, query) == render(True, query)
+            title = "&".join(f"{k}={v}" for k, v in query.items())
+            self.stdout.write(f"{title:<32}{slow_ms:>15.2f}{fast_ms:>12.2f}{slow_ms / fast_ms:>8.1f}x  {same}")
+
+    def bench_render(self, size, repeat):
+        """
+        JSONRenderer vs StreamingJSONRenderer на готовых response.data:
+        время, время до первого куска и пик памяти (tracemalloc).
+        Потоковый ответ читаем по кускам, как WSGI-сервер, не склеивая.
+        """
+        import tracemalloc
+
+        from django.test import RequestFactory
+        from rest_framework.renderers import JSONRenderer
+
+        from apps.catalog.renderers import StreamingJSONRenderer
+        from apps.catalog.tree import get_category_tree
+        from apps.catalog.views import ProductViewSet
+
+        factory = RequestFactory()
+        view = ProductViewSet.as_view({"get": "list"})
+        payloads = {
+            "products page_size=200": view(factory.get("/api/catalog/products/", {"page_size": 200})).data,
+            "categories tree": get_category_tree(factory.get("/api/catalog/categories/tree/")),
+        }
+
+        def plain(data):
+            return len(JSONRenderer().render(data))
+
+        def streamed(data):
+            return sum(len(chunk) for chunk in StreamingJSONRenderer().iter_render(data))
+
+        def first_chunk(data):
+            return next(iter(StreamingJSONRenderer().iter_render(data)))
+
+        def peak_kb(fn, data):
+            tracemalloc.start()
+            fn(data)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return peak / 1024
+
+        self.stdout.write(
+            f"{'payload':<26}{'bytes':>9}{'json ms':>10}{'stream ms':>11}{'first ms':>10}"
+            f"{'json KB':>10}{'stream KB':>11}  same"
+        )
+        for title, data in payloads.items():
+            same = JSONRenderer().render(data) == b"".join(StreamingJSONRenderer().iter_render(data))
+            self.stdout.write(
+                f"{title:<26}{plain(data):>9}"
+                f"{timed(lambda: plain(data), repeat):>10.2f}"
+                f"{timed(lambda: streamed(data), repeat):>11.2f}"
+                f"{timed(lambda: first_chunk(data), repeat):>10.2f}"
+                f"{peak_kb(plain, data):>10.0f}{peak_kb(streamed, data):>11.0f}  {same}"
+            )
+
+    def bench_attributes(self, size, repeat):
+        fmt, color, density = self.keys
+        cases = [
+            ("format=A4", {fmt.pk: ["A4"]}),
+            ("format=A4|A5 & color", {fmt.pk: ["A4", "A5"], color.pk: ["синий"]}),
+            ("format & color & density", {fmt.pk: ["A4"], color.pk: ["черный"], density.pk: ["80"]}),
+        ]
+        base = Product.objects.filter(is_active=True, is_available=True)
+
+        def naive(filters):
+            # JOIN на каждую характеристику по сырому value
+            qs = base
+            for key_id, values in filters.items():
+                qs = qs.filter(characteristics__key_id=key_id, characteristics__value__in=values)
+            qs = qs.distinct().order_by("-created_at")
+            return qs.count(), list(qs.values_list("id", flat=True)[:40])
+
+        def indexed(filters):
+            qs = base
+            for key_id, values in filters.items():
+                product_ids = Characteristics.objects.filter(
+                    key_id=key_id,
+                    value_normalized__in=[normalize_characteristic_value(v) for v in values],
+                ).values("product_id")
+                qs = qs.filter(id__in=product_ids)
+            qs = qs.order_by("-created_at")
+            return qs.count(), list(qs.values_list("id", flat=True)[:40])
+
+        self.stdout.write(f"{'filters':<28}{'join ms':>10}{'hits':>8}{'index ms':>10}{'hits':>8}")
+        for title, filters in cases:
+            naive_ms = timed(lambda: naive(filters), repeat)
+            indexed_ms = timed(lambda: indexed(filters), repeat)
+            self.stdout.write(
+                f"{title:<28}{naive_ms:>10.2f}{naive(filters)[0]:>8}{indexed_ms:>10.2f}{indexed(filters)[0]:>8}"
+            )
+
+    def bench_search(self, size, repeat):
+        queries = ["бумага", "ручка синяя", "BN-0000123", "степлр", "тетр", "калькулятор черный"]
+        base = Product.objects.filter(is_active=True, is_available=True)
+
+        def scan(query):
+            # как SearchFilter: каждое слово icontains по name/code/slug
+            terms = [Q(name__icontains=t) | Q(code__icontains=t) | Q(slug__icontains=t) for t in query.split()]
+            qs = base.filter(reduce(and_, terms)).order_by("-created_at")
+            return qs.count(), list(qs.values_list("id", flat=True)[:40])
+
+        index = ProductSearchIndex()
+        started = time.perf_counter()
+        index.rebuild()
+        self.stdout.write(f"index build: {(time.perf_counter() - started) * 1000:.0f} ms, {index.stats()}")
+
+        def indexed(query):
+            ids = index.search(query)
+            qs = base.filter(id__in=ids) if ids else base.none()
+            return qs.count(), ids[:40]
+
+        self.stdout.write(f"{'query':<22}{'scan ms':>10}{'hits':>8}{'index ms':>10}{'hits':>8}")
+        for query in queries:
+            scan_ms = timed(lambda: scan(query), repeat)
+            index_ms = timed(lambda: indexed(query), repeat)
+            self.stdout.write(
+                f"{query:<22}{scan_ms:>10.2f}{scan(query)[0]:>8}{index_ms:>10.2f}{indexed(query)[0]:>8}"
+            )
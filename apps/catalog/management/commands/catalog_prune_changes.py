@@ -0,0 +1,22 @@
+"""
+Чистка журнала изменений товаров (/products/changes/).
+
+    python manage.py catalog_prune_changes              # старше CATALOG_CHANGES_RETENTION_DAYS
+    python manage.py catalog_prune_changes --days 7
+
+Запускать по cron раз в сутки. Клиенты с токеном старше удалённых строк получат 410.
+"""
+from django.core.management.base import BaseCommand
+
+from apps.catalog.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = "Удаляет старые записи журнала изменений товаров."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None)
+
+    def handle(self, *args, **options):
+        deleted = prune_changes(options["days"])
+        self.stdout.write(f"changes: {deleted} deleted")
@@ -0,0 +1,228 @@
+"""
+Пересчёт денормализованных данных каталога.
+
+    python manage.py catalog_rebuild                 # всё
+    python manage.py catalog_rebuild --only characteristics
+    python manage.py catalog_rebuild --only stored_images
+    python manage.py catalog_rebuild --only pending_images
+    python manage.py catalog_rebuild --only main_images
+    python manage.py catalog_rebuild --only effective_prices
+    python manage.py catalog_rebuild --only similar
+    python manage.py catalog_rebuild --only category_counts
+    python manage.py catalog_rebuild --only renditions
+    python manage.py catalog_rebuild --only snapshot
+
+Нужен после добавления новых служебных колонок и после массовых правок
+через queryset.update()/bulk_create, которые обходят save() и сигналы.
+"""
+import itertools
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, Q
+
+from apps.catalog.cache import SIMILAR, bump_version
+from apps.catalog.counts import rebuild_category_counts
+from apps.catalog.models import (
+    Category,
+    Characteristics,
+    Product,
+    ProductImage,
+    StoredImage,
+    main_image_subquery,
+    normalize_characteristic_value,
+)
+from apps.catalog.similar import rebuild_similar
+from apps.catalog.snapshot import build_snapshot
+from apps.utils import (
+    delete_image_files,
+    generate_renditions,
+    get_rendition_widths,
+    process_image_bytes,
+    renditions_outdated,
+)
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает денормализованные данные каталога."
+
+    steps = (
+        "characteristics",
+        "stored_images",
+        "pending_images",
+        "main_images",
+        "effective_prices",
+        "similar",
+        "category_counts",
+        "renditions",
+        "snapshot",
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--only", nargs="+", choices=self.steps, default=None)
+
+    def handle(self, *args, **options):
+        for step in options["only"] or self.steps:
+            changed = getattr(self, f"rebuild_{step}")()
+            self.stdout.write(f"{step}: {changed} updated")
+        bump_version()
+
+    def rebuild_characteristics(self):
+        """
+        value_normalized для ?attr[<key_id>]=...
+        """
+        changed = 0
+        batch = []
+        rows = Characteristics.objects.only("id", "value", "value_normalized").iterator(chunk_size=BATCH_SIZE)
+        for ch in rows:
+            normalized = normalize_characteristic_value(ch.value)[:255]
+            if normalized == ch.value_normalized:
+                continue
+            ch.value_normalized = normalized
+            batch.append(ch)
+            if len(batch) >= BATCH_SIZE:
+                Characteristics.objects.bulk_update(batch, ["value_normalized"])
+                changed += len(batch)
+                batch = []
+        if batch:
+            Characteristics.objects.bulk_update(batch, ["value_normalized"])
+            changed += len(batch)
+        return changed
+
+    def rebuild_stored_images(self):
+        """
+        StoredImage.refs — число записей ProductImage на каждый файл: для файлов,
+        загруженных до учёта ссылок и после bulk_create/queryset.delete().
+        Запускать без параллельных загрузок. Файлы без ссылок удаляются.
+        """
+        changed = 0
+        storage = ProductImage._meta.get_field("image").storage
+        refs = dict(
+            ProductImage.objects.exclude(image="").values_list("image").annotate(n=Count("id")).order_by()
+        )
+        for stored in list(StoredImage.objects.all()):
+            count = refs.pop(stored.name, 0)
+            if count == stored.refs:
+                continue
+            if count:
+                StoredImage.objects.filter(pk=stored.pk).update(refs=count)
+            else:
+                stored.delete()
+                delete_image_files(storage, stored.name)
+            changed += 1
+        StoredImage.objects.bulk_create(
+            [StoredImage(name=name, refs=count) for name, count in refs.items()],
+            batch_size=BATCH_SIZE,
+        )
+        return changed + len(refs)
+
+    def rebuild_pending_images(self):
+        """
+        Картинки, которые фоновая обработка не успела ужать (перезапуск сервера
+        с непустой очередью), — ужимаем здесь же, в процессе команды. Один исходник
+        на несколько записей обрабатывается один раз.
+        """
+        changed = 0
+        sources = (
+            ProductImage.objects.filter(status=ProductImage.PENDING)
+            .values_list("image", flat=True)
+            .distinct()
+            .order_by("image")
+        )
+        storage = ProductImage._meta.get_field("image").storage
+        for name in list(sources):
+            try:
+                with storage.open(name, "rb") as f:
+                    main, renditions, _ = process_image_bytes(f.read(), get_rendition_widths())
+            except Exception as e:
+                self.stderr.write(f"pending_images: {name}: {e}")
+                ProductImage.objects.filter(image=name, status=ProductImage.PENDING).update(status=ProductImage.FAILED)
+                continue
+            changed += ProductImage.apply_processed(name, main, renditions)
+        return changed
+
+    def rebuild_main_images(self):
+        """
+        Product.main_image — путь первой картинки для списка товаров.
+        """
+        main_image = main_image_subquery()
+        # трогаем только расходящиеся строки — в отчёте честное число исправленных
+        return (
+            Product.objects
+            .annotate(expected_main_image=main_image)
+            .filter(~Q(main_image=F("expected_main_image")))
+            .update(main_image=main_image)
+        )
+
+    def rebuild_effective_prices(self):
+        """
+        Product.effective_price — цена со скидкой для ?ordering=effective_price и фильтров.
+        """
+        changed = 0
+        batch = []
+        rows = Product.objects.only("id", "price", "discount", "effective_price").iterator(chunk_size=BATCH_SIZE)
+        for product in rows:
+            effective_price = Product.compute_effective_price(product.price, product.discount)
+            if effective_price == product.effective_price:
+                continue
+            product.effective_price = effective_price
+            batch.append(product)
+            if len(batch) >= BATCH_SIZE:
+                Product.objects.bulk_update(batch, ["effective_price"])
+                changed += len(batch)
+                batch = []
+        if batch:
+            Product.objects.bulk_update(batch, ["effective_price"])
+            changed += len(batch)
+        return changed
+
+    def rebuild_similar(self):
+        """
+        Списки похожих товаров целиком — после переноса категорий или массовых правок.
+        """
+        changed = 0
+        ids = list(Product.objects.order_by("id").values_list("id", flat=True))
+        for start in range(0, len(ids), BATCH_SIZE):
+            changed += rebuild_similar(ids[start:start + BATCH_SIZE])[1]
+        if changed:
+            bump_version(SIMILAR)
+        return changed
+
+    def rebuild_category_counts(self):
+        """
+        Category.product_count / product_count_total — счётчики товаров для меню.
+        """
+        return rebuild_category_counts()
+
+    def rebuild_renditions(self):
+        """
+        Превью (srcset) картинок товаров и категорий, загруженных до их появления
+        или после смены IMAGE_RENDITION_WIDTHS. Готовые не пересоздаются; превью
+        не уже исходника (от прежней версии) удаляются.
+        """
+        changed = 0
+        images = itertools.chain(
+            (
+                pi.image
+                for pi in ProductImage.objects.filter(status=ProductImage.READY)
+                .only("id", "image", "product_id")
+                .iterator(chunk_size=BATCH_SIZE)
+            ),
+            (c.image for c in Category.objects.exclude(image="").exclude(image__isnull=True).only("id", "image")),
+        )
+        for image in images:
+            if not image or not image.storage.exists(image.name):
+                continue
+            if not renditions_outdated(image):
+                continue
+            generate_renditions(image)
+            changed += 1
+        return changed
+
+    def rebuild_snapshot(self):
+        """
+        Снимок каталога (/snapshot/) целиком, все блоки заново.
+        """
+        _, rebuilt = build_snapshot(force=True)
+        return rebuilt
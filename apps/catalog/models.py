@@ -1,11 +1,29 @@
-from django.db import models
-from django.db.models import Q
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
 from django.core.validators import MaxValueValidator
 from mptt.models import MPTTModel, TreeForeignKey
 from django.template.defaultfilters import truncatechars  # 👈 добавь этот импорт
-from apps.utils import get_product_upload_path, rename_upload_file
+from apps.utils import (
+    content_key,
+    delete_image_files,
+    generate_renditions,
+    get_product_upload_path,
+    is_new_upload,
+    key_from_name,
+    original_filename,
+    rename_upload_file,
+    store_original,
+    store_renditions,
+)
 from imagekit.models import ProcessedImageField
 
+from .images import image_jobs
+
 
 class Category(MPTTModel):
     name = models.CharField(
@@ -36,6 +54,18 @@ class Category(MPTTModel):
         default=True,
         verbose_name="Активна?",
     )
+    # товары витрины (is_active и is_available): в самой категории и вместе с подкатегориями.
+    # Ведутся сигналами товаров, полный пересчёт — counts.rebuild_category_counts()
+    product_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name="Товаров",
+    )
+    product_count_total = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name="Товаров с подкатегориями",
+    )
     created_at = models.DateTimeField(
         auto_now_add=True,
         verbose_name="Дата создания",
@@ -57,9 +87,33 @@ class Category(MPTTModel):
         return self.name
 
     def save(self, *args, **kwargs):
-        if self.image:
-            rename_upload_file(self.image)
+        # только новый файл: правка других полей (list_editable в админке) картинку не перекодирует
+        new_image = is_new_upload(self.image) and rename_upload_file(self.image)
         super().save(*args, **kwargs)
+        # уже ужатый файл (те же байты) приходит вместе с превью
+        if new_image:
+            generate_renditions(self.image)
+
+
+# ===== индексы витрины =====
+# товары, которые видит покупатель (ProductViewSet.get_queryset)
+LIVE_PRODUCTS = Q(is_active=True, is_available=True)
+
+# поле сортировки -> суффикс имени индекса. Все ProductViewSet.ordering_fields:
+# каждое поле и сортируется, и (цены) фильтруется диапазоном ?min_*/max_*, так что
+# индекс нужен и для порядка строк, и для поиска по диапазону.
+PRODUCT_ORDERING_INDEXES = (
+    ("created_at", "created"),
+    ("price", "price"),
+    ("wholesale_price", "wprice"),
+    ("discount", "discount"),
+    ("effective_price", "eprice"),
+    ("name", "name"),
+)
+
+
+# поля товара, от которых зависят списки похожих товаров (Product.get_similar_key)
+SIMILAR_KEY_FIELDS = ("category_id", "effective_price", "is_active", "is_available")
 
 
 class Product(models.Model):
@@ -124,6 +178,16 @@ class Product(models.Model):
         verbose_name="Скидка (%)",
         validators=[MaxValueValidator(95)],
     )
+    # цена, которую платит покупатель: price минус discount %.
+    # Пересчитывается в save() — сортировка и фильтр по ней идут по индексу, без выражений в SQL
+    effective_price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Цена со скидкой",
+    )
     promotion = models.BooleanField(
         default=False,
         verbose_name="Сезонные товары",
@@ -140,6 +204,15 @@ class Product(models.Model):
         verbose_name="Есть в наличии?",
         default=True,
     )
+    # путь первой картинки (ProductImage с наименьшим id) в storage.
+    # Ведётся сигналами ProductImage — список товаров не трогает таблицу картинок.
+    main_image = models.CharField(
+        max_length=255,
+        blank=True,
+        default="",
+        editable=False,
+        verbose_name="Главное изображение",
+    )
     created_at = models.DateTimeField(
         auto_now_add=True,
         verbose_name="Дата создания",
@@ -153,12 +226,132 @@ class Product(models.Model):
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
         ordering = ("-created_at",)
+        indexes = [
+            # Витрина: Django пишет is_active=True как голое "is_active" в WHERE,
+            # по такому условию SQLite не ищет по префиксу индекса. Поэтому индексы
+            # частичные (WHERE is_active AND is_available) — планировщик берёт их,
+            # когда запрос содержит то же условие, и читает строки уже в порядке сортировки.
+            *(
+                models.Index(fields=[field], name=f"catalog_prod_live_{suffix}_idx", condition=LIVE_PRODUCTS)
+                for field, suffix in PRODUCT_ORDERING_INDEXES
+            ),
+            # то же внутри категории (?category=, ?category_in=)
+            *(
+                models.Index(fields=["category", field], name=f"catalog_prod_cat_{suffix}_idx", condition=LIVE_PRODUCTS)
+                for field, suffix in PRODUCT_ORDERING_INDEXES
+            ),
+        ]
 
     def __str__(self) -> str:
         return f"{self.code} — {self.name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # slug, с которым товар прочитан: при смене slug кэш карточки чистим и по старому.
+        # __dict__ — чтобы не догружать отложенное (only/defer) поле
+        instance._loaded_slug = instance.__dict__.get("slug")
+        # то же для счётчиков категорий; при отложенных полях ключа нет — signals пересчитает целиком
+        if {"category_id", "is_active", "is_available"} <= instance.__dict__.keys():
+            instance._loaded_count_key = instance.get_count_key()
+        # и для похожих товаров (similar.py): правка остатка или описания их не пересчитывает
+        if set(SIMILAR_KEY_FIELDS) <= instance.__dict__.keys():
+            instance._loaded_similar_key = instance.get_similar_key()
+        return instance
+
+    def get_count_key(self):
+        """
+        (category_id, виден ли на витрине) — по изменению пары двигаются счётчики категорий (counts.py).
+        """
+        return self.category_id, bool(self.is_active and self.is_available)
+
+    def get_similar_key(self):
+        """
+        Всё, от чего зависит оценка похожести, кроме характеристик (у них свои сигналы).
+        """
+        return tuple(getattr(self, field) for field in SIMILAR_KEY_FIELDS)
+
+    @staticmethod
+    def compute_effective_price(price, discount):
+        if price is None:
+            return None
+        discount = min(max(discount or 0, 0), 100)
+        value = Decimal(price) * (100 - discount) / 100
+        return value.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+    def save(self, *args, **kwargs):
+        self.effective_price = self.compute_effective_price(self.price, self.discount)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"price", "discount"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "effective_price"}
+        super().save(*args, **kwargs)
+
+
+class StoredImage(models.Model):
+    """
+    Файл картинки товара в products/store/ и число записей ProductImage, которые на
+    него ссылаются: одинаковые байты (фото общее для вариантов товара) лежат одним файлом.
+
+    Ссылка берётся атомарным UPDATE refs = refs + 1, файл удаляется в одной транзакции
+    с удалением строки при refs = 0. Загрузка тех же байт параллельно с удалением
+    последней ссылки либо успевает взять ссылку (файл остаётся), либо строки уже
+    нет — и файл пишется заново.
+    """
+
+    name = models.CharField(max_length=255, unique=True, verbose_name="Файл")
+    refs = models.PositiveIntegerField(default=0, verbose_name="Ссылок")
+
+    class Meta:
+        verbose_name_plural = "Файлы изображений"
+        verbose_name = "Файл изображения"
+
+    def __str__(self) -> str:
+        return self.name
+
+    @classmethod
+    def link(cls, name) -> bool:
+        """
+        Ещё одна ссылка на файл из учёта. -> False, если его нет (или только что удалили).
+        """
+        return bool(cls.objects.filter(name=name).update(refs=F("refs") + 1))
+
+    @classmethod
+    def acquire(cls, name):
+        """
+        Ссылка на файл, который мог ещё не попасть в учёт (только что записан).
+        """
+        if cls.link(name):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, refs=1)
+        except IntegrityError:
+            cls.link(name)
+
+    @classmethod
+    def release(cls, name, storage) -> bool:
+        """
+        Минус ссылка; последняя — файл с превью удаляется. -> True, если удалён.
+        """
+        with transaction.atomic():
+            cls.objects.filter(name=name, refs__gt=0).update(refs=F("refs") - 1)
+            deleted, _ = cls.objects.filter(name=name, refs=0).delete()
+            if deleted:
+                # до commit: параллельный link() ждёт эту транзакцию и строки уже не найдёт
+                delete_image_files(storage, name)
+        return bool(deleted)
+
 
 class ProductImage(models.Model):
+    PENDING = "pending"
+    READY = "ready"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "В обработке"),
+        (READY, "Готово"),
+        (FAILED, "Ошибка"),
+    )
+
     class Meta:
         verbose_name_plural = "Изображения"
         verbose_name = "Изображение"
@@ -189,18 +382,162 @@ class ProductImage(models.Model):
         format="WEBP",
         options={"quality": 82},
     )
+    # pending — лежит исходник, WEBP и превью готовит фоновый процесс (images.py);
+    # на витрину (main_image, карточка) попадают только ready
+    status = models.CharField(
+        max_length=7,
+        choices=STATUS_CHOICES,
+        default=READY,
+        editable=False,
+        verbose_name="Обработка",
+    )
 
     def __str__(self) -> str:
         return self.image.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # файл, с которым запись прочитана: после замены картинки старый освобождаем (release_file)
+        instance._loaded_image = instance.__dict__.get("image")
+        return instance
+
     def save(self, *args, **kwargs):
-        if self.image:
-            rename_upload_file(self.image)
-        super().save(*args, **kwargs)
+        old_name = getattr(self, "_loaded_image", None)
+        if not is_new_upload(self.image):
+            self._save_row(old_name, False, args, kwargs)
+            return
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "status"}
+
+        # файлы лежат по хешу содержимого: те же байты (фото общее для вариантов
+        # товара) уже ужимали — ссылаемся на готовый WEBP с превью. Ссылка берётся
+        # в одной транзакции с записью: между проверкой и save файл не удалят
+        key = content_key(self.image)
+        with transaction.atomic():
+            if self._link_stored(f"{key}.webp"):
+                self.status = self.READY
+                self._save_row(old_name, True, args, kwargs)
+                return
+
+        if not image_jobs.enabled():
+            rename_upload_file(self.image, key, reuse=False)
+            self.status = self.READY
+            self._save_row(old_name, False, args, kwargs)
+            generate_renditions(self.image)
+            return
+
+        self.status = self.PENDING
+        with transaction.atomic():
+            # те же байты ещё ждут обработки — один исходник, одна задача (image_jobs)
+            linked = self._link_stored(original_filename(self.image, key))
+            if linked:
+                self._save_row(old_name, True, args, kwargs)
+        if not linked:
+            store_original(self.image, key)
+            self._save_row(old_name, False, args, kwargs)
+        self.schedule_processing()
+
+    def _link_stored(self, filename) -> bool:
+        name = self.image.field.generate_filename(self, filename)
+        if not StoredImage.link(name):
+            return False
+        self.image.name = name
+        self.image._committed = True
+        return True
+
+    def _save_row(self, old_name, linked, args, kwargs):
+        """
+        linked — ссылку на файл уже взяли (_link_stored); иначе берём здесь,
+        если файл в записи сменился.
+        """
+        name = self.image.name
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if name and name != old_name and not linked:
+                StoredImage.acquire(name)
+        self._loaded_image = name
+        if old_name and old_name != name:
+            transaction.on_commit(lambda: ProductImage.release_file(old_name))
+
+    def schedule_processing(self):
+        """
+        После commit: до него фоновый поток не увидит ни записи, ни файла.
+        """
+        name, storage = self.image.name, self.image.storage
+
+        def _submit():
+            image_jobs.submit(
+                storage,
+                name,
+                on_done=lambda main, renditions: ProductImage.apply_processed(name, main, renditions),
+                on_error=lambda: ProductImage.objects.filter(image=name, status=ProductImage.PENDING).update(
+                    status=ProductImage.FAILED
+                ),
+            )
+
+        transaction.on_commit(_submit)
+
+    @classmethod
+    def apply_processed(cls, source_name, main: bytes, renditions: dict) -> int:
+        """
+        Подменяет исходник готовым WEBP во всех ждущих его записях. Удалённые записи
+        и те, куда успели загрузить другой файл, не трогаем. Сохранение через save():
+        сигналы пересчитают main_image, updated_at товара и журнал изменений.
+        -> число подменённых записей.
+        """
+        swapped = 0
+        target = None
+        for image in cls.objects.filter(image=source_name, status=cls.PENDING).order_by("pk"):
+            with transaction.atomic():
+                linked = False
+                if target is None:
+                    filename = f"{key_from_name(source_name)}.webp"
+                    linked = image._link_stored(filename)
+                    if not linked:
+                        FieldFile.save(image.image, filename, content=ContentFile(main), save=False)
+                        store_renditions(image.image.storage, image.image.name, renditions)
+                    target = image.image.name
+                else:
+                    image.image.name = target
+                image.status = cls.READY
+                image._save_row(source_name, linked, (), {"update_fields": ["image", "status"]})
+            swapped += 1
+        return swapped
+
+    @classmethod
+    def release_file(cls, name) -> bool:
+        """
+        Файл общий для всех записей с теми же байтами: удаляем, когда ссылок не осталось.
+        """
+        if not name:
+            return False
+        storage = cls._meta.get_field("image").storage
+        if StoredImage.objects.filter(name=name).exists():
+            return StoredImage.release(name, storage)
+        # файлы, загруженные до учёта ссылок (catalog_rebuild --only stored_images)
+        if cls.objects.filter(image=name).exists():
+            return False
+        delete_image_files(storage, name)
+        return True
 
 
 # ====== НОВОЕ: справочник характеристик и значения для товаров ======
 
+def main_image_subquery():
+    """
+    Путь первой картинки товара: UPDATE product SET main_image = (SELECT ...).
+    Один запрос и при добавлении, и при удалении картинки, без гонок с порядком сигналов.
+    """
+    first = (
+        ProductImage.objects
+        .filter(product=OuterRef("pk"), status=ProductImage.READY)
+        .order_by("id")
+        .values("image")[:1]
+    )
+    return Coalesce(Subquery(first), Value(""), output_field=models.CharField())
+
+
 class CharacteristicsDict(models.Model):
     class Meta:
         verbose_name = "Описание характеристик"
@@ -220,10 +557,29 @@ class CharacteristicsDict(models.Model):
         return truncatechars(self.title, 30)
 
 
+# латиница и кириллица, которые в значениях характеристик путают чаще всего ("А4" vs "A4")
+_HOMOGLYPHS = str.maketrans("авекморстух", "abekmopctyx")
+
+
+def normalize_characteristic_value(value) -> str:
+    """
+    " А4 " / "a4" / "A4" -> "a4": регистр, ё, лишние пробелы и похожие буквы.
+    """
+    text = " ".join(str(value or "").casefold().replace("ё", "е").split())
+    return text.translate(_HOMOGLYPHS)
+
+
 class Characteristics(models.Model):
     class Meta:
         verbose_name_plural = "Характеристики"
         verbose_name = "Характеристика"
+        indexes = [
+            # ?attr[<key_id>]=<value> -> product_id только по индексу
+            models.Index(
+                fields=["key", "value_normalized", "product"],
+                name="catalog_char_key_value_idx",
+            ),
+        ]
 
     product = models.ForeignKey(
         Product,
@@ -240,6 +596,124 @@ class Characteristics(models.Model):
     value = models.TextField(
         verbose_name="Значение",
     )
+    value_normalized = models.CharField(
+        max_length=255,
+        blank=True,
+        default="",
+        editable=False,
+        verbose_name="Значение (для фильтра)",
+    )
 
     def __str__(self):
         return self.key.title
+
+    def save(self, *args, **kwargs):
+        self.value_normalized = normalize_characteristic_value(self.value)[:255]
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "value" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "value_normalized"}
+        super().save(*args, **kwargs)
+
+
+# ====== похожие товары (заранее посчитанные соседи, см. similar.py) ======
+
+class SimilarProduct(models.Model):
+    class Meta:
+        verbose_name = "Похожий товар"
+        verbose_name_plural = "Похожие товары"
+        ordering = ("product", "position")
+        indexes = [
+            # /products/{slug}/similar/: соседи товара по порядку
+            models.Index(fields=["product", "position"], name="catalog_similar_pos_idx"),
+        ]
+
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="similar_links",
+        verbose_name="Товар",
+    )
+    similar = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="similar_to",
+        verbose_name="Похожий товар",
+    )
+    position = models.PositiveSmallIntegerField(
+        verbose_name="Позиция",
+    )
+    score = models.FloatField(
+        verbose_name="Оценка сходства",
+    )
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.similar_id}"
+
+
+# ====== журнал изменений товаров (/products/changes/, см. changes.py) ======
+
+class ProductChange(models.Model):
+    """
+    Строка на каждое сохранение / удаление товара. id — монотонный номер изменения,
+    из него строится токен ?since=. product_id без внешнего ключа: запись об удалении
+    (tombstone) переживает сам товар.
+    """
+
+    UPSERT = "upsert"
+    DELETE = "delete"
+    KIND_CHOICES = (
+        (UPSERT, "Изменён"),
+        (DELETE, "Удалён"),
+    )
+
+    product_id = models.BigIntegerField(
+        verbose_name="ID товара",
+    )
+    kind = models.CharField(
+        max_length=6,
+        choices=KIND_CHOICES,
+        verbose_name="Тип",
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        db_index=True,
+        verbose_name="Дата",
+    )
+
+    class Meta:
+        verbose_name = "Изменение товара"
+        verbose_name_plural = "Журнал изменений товаров"
+        ordering = ("id",)
+
+    def __str__(self):
+        return f"{self.pk}: {self.kind} {self.product_id}"
+
+
+# ====== служебное: версии каталога для инвалидации кэшей ======
+
+class CatalogVersion(models.Model):
+    """
+    Монотонный счётчик изменений. Любая запись в каталог (вебхук CRM, админка)
+    увеличивает value, а ключи кэшей строятся с учётом текущего значения.
+    """
+
+    name = models.CharField(
+        max_length=64,
+        primary_key=True,
+        verbose_name="Название",
+    )
+    value = models.PositiveBigIntegerField(
+        default=0,
+        verbose_name="Версия",
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name="Дата обновления",
+    )
+
+    class Meta:
+        verbose_name = "Версия каталога"
+        verbose_name_plural = "Версии каталога"
+
+    def __str__(self) -> str:
+        return f"{self.name}={self.value}"
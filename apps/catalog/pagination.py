@@ -0,0 +1,191 @@
+"""
+Keyset (cursor) пагинация для ленты товаров.
+
+Вместо COUNT(*) + OFFSET запоминаем позицию последней строки страницы
+(значение поля сортировки + id) и следующую страницу берём условием
+"строго после (value, id)". Стоимость страницы не зависит от её номера.
+"""
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.sql.where import AND, WhereNode
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Сортировка: (<поле> ASC|DESC, id ASC|DESC) — id уникален и служит tiebreaker-ом.
+    Для nullable полей (price, wholesale_price) NULL-ы выбираются отдельным
+    "сегментом": так условие остаётся диапазоном по индексу, без OR по NULL.
+    """
+
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self, page_size: int):
+        self.page_size = page_size
+        self.has_next = False
+        self.next_position = None
+        self.ordering = None
+        self.request = None
+
+    # ---------- ordering ----------
+    def get_ordering_term(self, request, queryset, view) -> str | None:
+        """
+        Первое поле сортировки — от фильтра сортировки самого view (ProductOrderingFilter),
+        а не от голого OrderingFilter. None — порядок не по колонке (релевантность поиска):
+        keyset по нему не построить.
+        """
+        backend = next(
+            (b for b in getattr(view, "filter_backends", ()) if issubclass(b, OrderingFilter)),
+            OrderingFilter,
+        )
+        ordering = backend().get_ordering(request, queryset, view)
+        if not ordering:
+            return None
+        term = ordering[0]
+        return term if term.lstrip("-") != "pk" else term.replace("pk", "id")
+
+    # ---------- cursor encode/decode ----------
+    @staticmethod
+    def _dump_value(value):
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        return value
+
+    def encode_cursor(self, value, pk) -> str:
+        raw = json.dumps({"o": self.ordering, "v": self._dump_value(value), "id": pk}, separators=(",", ":"))
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+    def decode_cursor(self, token: str, model_field):
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+            data = json.loads(raw.decode("utf-8"))
+            pk = int(data["id"])
+            value = data["v"]
+        except (TypeError, ValueError, KeyError, binascii.Error, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if data.get("o") != self.ordering:
+            # курсор выдан для другой сортировки
+            raise NotFound(self.invalid_cursor_message)
+        if value is not None:
+            try:
+                value = model_field.to_python(value)
+            except Exception:
+                raise NotFound(self.invalid_cursor_message)
+        return value, pk
+
+    # ---------- paging ----------
+    # сравнения, которые никогда не пропускают NULL
+    null_rejecting_lookups = frozenset({"exact", "gt", "gte", "lt", "lte", "range", "in"})
+
+    def _rejects_null(self, queryset, field_name) -> bool:
+        """
+        Фильтр уже отсёк NULL по полю (?min_price= -> price >= ...)? Тогда сегмент NULL-ов
+        пуст, и запрос к нему — лишний (и с сортировкой во временном B-дереве).
+        Смотрим только условия, соединённые через AND.
+        """
+        nodes = [queryset.query.where]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, WhereNode):
+                if node.connector == AND and not node.negated:
+                    nodes.extend(node.children)
+                continue
+            target = getattr(getattr(node, "lhs", None), "target", None)
+            if (
+                getattr(target, "name", None) == field_name
+                and getattr(node, "lookup_name", None) in self.null_rejecting_lookups
+                and node.rhs is not None
+            ):
+                return True
+        return False
+
+    def _segments(self, queryset, descending, model_field):
+        if not model_field.null:
+            return [None]
+        if self._rejects_null(queryset, model_field.name):
+            return [False]
+        nulls_largest = connections[queryset.db].features.nulls_order_largest
+        # где окажутся NULL-ы при обычном ORDER BY (без NULLS FIRST/LAST — чтобы работал индекс)
+        nulls_first = descending == nulls_largest
+        return [True, False] if nulls_first else [False, True]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering_term(request, queryset, view)
+        descending = self.ordering.startswith("-")
+        field_name = self.ordering.lstrip("-")
+        model_field = queryset.model._meta.get_field(field_name)
+        op = "lt" if descending else "gt"
+        order_by = (self.ordering, "-id" if descending else "id")
+
+        position = None
+        token = request.query_params.get(self.cursor_query_param)
+        if token:
+            position = self.decode_cursor(token, model_field)
+
+        segments = self._segments(queryset, descending, model_field)
+        if position is not None and model_field.null:
+            # начинаем с сегмента, в котором остановились
+            if (position[0] is None) not in segments:
+                raise NotFound(self.invalid_cursor_message)
+            segments = segments[segments.index(position[0] is None):]
+
+        rows = []
+        need = self.page_size + 1
+        for is_null in segments:
+            qs = queryset
+            if is_null is not None:
+                qs = qs.filter(**{f"{field_name}__isnull": is_null})
+            if position is not None:
+                value, pk = position
+                if value is None and is_null:
+                    qs = qs.filter(**{f"id__{op}": pk})
+                elif value is not None and not is_null:
+                    qs = qs.filter(**{f"{field_name}__{op}e": value}).filter(
+                        Q(**{f"{field_name}__{op}": value}) | Q(**{f"id__{op}": pk})
+                    )
+            rows.extend(qs.order_by(*order_by)[: need - len(rows)])
+            if len(rows) >= need:
+                break
+
+        self.has_next = len(rows) > self.page_size
+        rows = rows[: self.page_size]
+        if self.has_next and rows:
+            last = rows[-1]
+            if isinstance(last, dict):
+                self.next_position = (last[field_name], last["id"])
+            else:
+                self.next_position = (getattr(last, field_name), last.pk)
+        return rows
+
+    def get_next_link(self):
+        if not self.has_next or self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(*self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
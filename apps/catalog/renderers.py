@@ -0,0 +1,193 @@
+"""
+Потоковый JSON для больших ответов каталога (page_size=200, дерево категорий).
+
+JSONRenderer из DRF собирает весь ответ одной строкой, потом кодирует её в bytes —
+в пике это data + str + bytes. Здесь ответ режется по записям (элементы results /
+корневые категории), записи кодируются пачками C-энкодером json, и наружу уходят
+куски по ~16 КБ через StreamingHttpResponse.
+
+Байты те же, что у JSONRenderer: компактные разделители, ensure_ascii=False,
+\\u2028/\\u2029 экранированы, Decimal -> float, UUID -> str.
+
+Включается заголовком Accept: application/json; stream=true;
+обычный Accept: application/json по-прежнему получает JSONRenderer.
+
+Чего поток не делает:
+    - Decimal и UUID C-энкодер не знает — на них он вызывает default(). В списке
+      товаров и дереве категорий их нет: DecimalField отдаёт строки
+      (COERCE_DECIMAL_TO_STRING), id — int. default() срабатывает только на
+      редких полях вроде агрегатов /facets/;
+    - response.data собирается целиком до рендера: его же кладёт в кеш
+      CachedResponseMixin, размер страницы ограничен page_size, дерево и так
+      лежит в кеше. Поток убирает из пика строку и bytes всего ответа.
+"""
+import datetime
+import decimal
+import json
+import uuid
+from json.encoder import c_make_encoder, encode_basestring, encode_basestring_ascii
+
+from django.http import StreamingHttpResponse
+from django.utils.functional import Promise
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def _encode_datetime(value):
+    # как rest_framework.utils.encoders.JSONEncoder
+    text = value.isoformat()
+    if text.endswith("+00:00"):
+        text = text[:-6] + "Z"
+    return text
+
+
+class StreamingJSONEncoder:
+    """
+    C-энкодер json вызывает default() только для типов, которых не знает сам.
+    Вместо цепочки isinstance из DRF — один поиск по точному типу в таблице;
+    всё остальное (редкие типы) отдаём DRF-энкодеру, чтобы результат не расходился.
+    """
+
+    chunk_size = 16 * 1024
+    batch_size = 32
+
+    converters = {
+        decimal.Decimal: float,
+        uuid.UUID: str,
+        datetime.datetime: _encode_datetime,
+        datetime.date: datetime.date.isoformat,
+    }
+
+    def __init__(self):
+        self.item_separator, self.key_separator = (",", ":") if api_settings.COMPACT_JSON else (", ", ": ")
+        self._fallback = JSONEncoder().default
+        encoder = json.JSONEncoder(
+            ensure_ascii=not api_settings.UNICODE_JSON,
+            allow_nan=not api_settings.STRICT_JSON,
+            separators=(self.item_separator, self.key_separator),
+            default=self.default,
+        )
+        if c_make_encoder is not None:
+            # JSONEncoder.encode() собирает C-энкодер на каждый вызов — здесь один на все записи.
+            # Циклов в данных сериализатора не бывает, markers не нужны.
+            self._iterencode = c_make_encoder(
+                None,
+                self.default,
+                encode_basestring_ascii if encoder.ensure_ascii else encode_basestring,
+                None,
+                self.key_separator,
+                self.item_separator,
+                False,
+                False,
+                encoder.allow_nan,
+            )
+        else:
+            self._iterencode = lambda value, level: encoder.iterencode(value)
+
+    def default(self, value):
+        convert = self.converters.get(type(value))
+        if convert is not None:
+            return convert(value)
+        if isinstance(value, Promise):
+            return str(value)
+        return self._fallback(value)
+
+    def iter_pieces(self, data, depth=2):
+        """
+        Куски JSON-текста. Словари на первых depth уровнях раскрываем по ключам,
+        списки — пачками записей (одна карточка, одна ветка дерева — одна запись).
+        """
+        if depth <= 0 or not data:
+            yield "".join(self._iterencode(data, 0))
+        # словари с не-строковыми ключами целиком отдаём json — у него свои правила для ключей
+        elif isinstance(data, dict) and all(isinstance(key, str) for key in data):
+            yield "{"
+            first = True
+            for key, value in data.items():
+                if not first:
+                    yield self.item_separator
+                first = False
+                yield "".join(self._iterencode(key, 0)) + self.key_separator
+                yield from self.iter_pieces(value, depth - 1)
+            yield "}"
+        elif isinstance(data, (list, tuple)):
+            # один вызов C-энкодера на batch_size записей, скобки пачки срезаем
+            yield "["
+            for start in range(0, len(data), self.batch_size):
+                if start:
+                    yield self.item_separator
+                yield "".join(self._iterencode(data[start:start + self.batch_size], 0))[1:-1]
+            yield "]"
+        else:
+            yield "".join(self._iterencode(data, 0))
+
+    def iterencode(self, data):
+        """
+        Куски bytes примерно по chunk_size.
+        """
+        buffer = []
+        size = 0
+        for piece in self.iter_pieces(data):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                yield self._finish(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield self._finish(buffer)
+
+    @staticmethod
+    def _finish(buffer):
+        # как JSONRenderer: U+2028/U+2029 валидны в JSON, но не в JavaScript
+        text = "".join(buffer).replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+        return text.encode("utf-8")
+
+
+class StreamingJSONRenderer(JSONRenderer):
+    media_type = "application/json; stream=true"
+    format = "json-stream"
+    # сам ответ — обычный JSON
+    response_media_type = "application/json"
+
+    encoder = StreamingJSONEncoder()
+
+    def iter_render(self, data):
+        if data is None:
+            return iter(())
+        return self.encoder.iterencode(data)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # без StreamingResponseMixin (например, ответы с ошибками) — тот же JSON целиком
+        return b"".join(self.iter_render(data))
+
+
+class StreamingResponseMixin:
+    """
+    Добавляет StreamingJSONRenderer к рендерерам ViewSet-а и превращает
+    успешный Response в StreamingHttpResponse, если клиент выбрал этот формат.
+    """
+
+    # первым: "application/json" без stream=true и "*/*" с ним не совпадают
+    # и уходят дальше, в JSONRenderer
+    renderer_classes = [StreamingJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES]
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        renderer = getattr(response, "accepted_renderer", None)
+        if not isinstance(response, Response) or not isinstance(renderer, StreamingJSONRenderer):
+            return response
+        if response.status_code != 200 or response.data is None:
+            return response
+
+        streaming = StreamingHttpResponse(
+            renderer.iter_render(response.data),
+            status=response.status_code,
+            content_type=renderer.response_media_type,
+        )
+        for header, value in response.items():
+            if header.lower() != "content-type":
+                streaming[header] = value
+        return streaming
@@ -0,0 +1,449 @@
+"""
+Поиск по товарам без LIKE '%q%'.
+
+В памяти процесса держим инвертированный индекс:
+  токен    -> {product_id: вес поля}
+  триграмма -> {токены словаря}   (опечатки и неполные слова)
+Токены берём из name, code, названия категории и значений характеристик.
+Нормализация: casefold + ё->е, поэтому кириллица ищется без учёта регистра
+и на SQLite (где LOWER/LIKE работают только с ASCII).
+
+Индекс строится лениво при первом поиске и дальше обновляется точечно:
+сигналы товара/характеристик (вебхук CRM, админка) переиндексируют один товар,
+а изменения, сделанные другими процессами, подтягиваются по версии каталога
+из журнала ProductChange (changes.py): только товары, изменённые или удалённые
+после последней синхронизации. Синхронизацию делает один поток; остальные, пока
+она идёт, ищут по прежнему состоянию индекса.
+Тот же жизненный цикл у PrefixIndex для /suggest/.
+"""
+import bisect
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db.models import Case, IntegerField, Max, Value, When
+from rest_framework.filters import BaseFilterBackend, OrderingFilter
+from rest_framework.settings import api_settings
+
+from .cache import CATALOG, CATEGORIES, get_versions
+from .changes import TokenExpired, read_changes
+from .models import Characteristics, Product, ProductChange
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# вес совпадения по полю
+FIELD_WEIGHTS = {
+    "code": 4.0,
+    "name": 3.0,
+    "category": 1.0,
+    "characteristic": 0.5,
+}
+
+# насколько триграммы запроса должны покрываться токеном словаря
+MIN_TRIGRAM_COVERAGE = 0.5
+
+# больше изменений в журнале с прошлой синхронизации — дешевле перестроить индекс
+CATCH_UP_MAX_CHANGES = 5000
+
+
+def normalize(text: str) -> str:
+    return (text or "").casefold().replace("ё", "е")
+
+
+def tokenize(text: str):
+    return TOKEN_RE.findall(normalize(text))
+
+
+def trigrams(token: str):
+    padded = f"  {token} "
+    return {padded[i: i + 3] for i in range(len(padded) - 2)}
+
+
+class PrefixIndex:
+    """
+    Автодополнение: отсортированный массив ключей + bisect.
+    Ключ — нормализованный текст, начиная с каждого слова ("ручка синяя",
+    "синяя"), так что "син" находит и середину названия. Поиск — O(log n)
+    плюс просмотр нескольких соседних ключей.
+    """
+
+    def __init__(self):
+        self.keys = []  # sorted [(key, word_position, pk)]
+        self.items = {}  # pk -> (payload, [keys])
+
+    @staticmethod
+    def make_keys(pk, texts):
+        keys = set()
+        for text in texts:
+            words = tokenize(text)
+            for pos in range(len(words)):
+                keys.add((" ".join(words[pos:]), pos, pk))
+        return sorted(keys)
+
+    def add(self, pk, texts, payload):
+        self.remove(pk)
+        keys = self.make_keys(pk, texts)
+        self.items[pk] = (payload, keys)
+        for key in keys:
+            bisect.insort(self.keys, key)
+
+    def remove(self, pk):
+        item = self.items.pop(pk, None)
+        if item is None:
+            return
+        for key in item[1]:
+            idx = bisect.bisect_left(self.keys, key)
+            if idx < len(self.keys) and self.keys[idx] == key:
+                del self.keys[idx]
+
+    def bulk_load(self, entries):
+        """
+        entries: [(pk, texts, payload)] — одна сортировка вместо insort на каждый ключ.
+        """
+        self.keys = []
+        self.items = {}
+        for pk, texts, payload in entries:
+            keys = self.make_keys(pk, texts)
+            self.items[pk] = (payload, keys)
+            self.keys.extend(keys)
+        self.keys.sort()
+
+    def lookup(self, query: str, limit: int = 10):
+        prefix = " ".join(tokenize(query))
+        if not prefix:
+            return []
+        found = {}
+        idx = bisect.bisect_left(self.keys, (prefix,))
+        # смотрим чуть больше limit ключей, чтобы совпадения с начала названия шли первыми
+        while idx < len(self.keys) and len(found) < limit * 4:
+            key, pos, pk = self.keys[idx]
+            if not key.startswith(prefix):
+                break
+            if pk not in found or pos < found[pk]:
+                found[pk] = pos
+            idx += 1
+        ranked = sorted(found, key=lambda pk: (found[pk], len(self.items[pk][0]["name"]), pk))
+        return [self.items[pk][0] for pk in ranked[:limit]]
+
+
+class ProductSearchIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()  # rebuild/catch_up — по одному
+        self.postings = defaultdict(dict)  # token -> {pk: weight}
+        self.vocab_trigrams = defaultdict(set)  # trigram -> {token}
+        self.documents = {}  # pk -> {token: weight}
+        self.suggestions = PrefixIndex()  # name/code -> {"id", "slug", "name"}
+        self.versions = None  # {CATALOG: v, CATEGORIES: v} на момент синхронизации
+        self.change_id = 0  # последняя учтённая строка журнала ProductChange
+        self.build_seconds = None
+
+    # ---------- документы ----------
+    @staticmethod
+    def document_tokens(name, code, category_name, values) -> dict:
+        tokens = {}
+
+        def add(text, field):
+            weight = FIELD_WEIGHTS[field]
+            for token in tokenize(text):
+                if tokens.get(token, 0) < weight:
+                    tokens[token] = weight
+
+        add(name, "name")
+        add(code, "code")
+        add(category_name, "category")
+        for value in values:
+            add(value, "characteristic")
+        return tokens
+
+    def _remove(self, pk):
+        self.suggestions.remove(pk)
+        old = self.documents.pop(pk, None)
+        if not old:
+            return
+        for token in old:
+            docs = self.postings.get(token)
+            if docs is None:
+                continue
+            docs.pop(pk, None)
+            if not docs:
+                del self.postings[token]
+                for trigram in trigrams(token):
+                    bucket = self.vocab_trigrams.get(trigram)
+                    if bucket is not None:
+                        bucket.discard(token)
+                        if not bucket:
+                            del self.vocab_trigrams[trigram]
+
+    def _add(self, pk, document, suggest=True):
+        tokens, card, code = document
+        self._remove(pk)
+        if suggest:
+            self.suggestions.add(pk, (card["name"], code), card)
+        if not tokens:
+            return
+        self.documents[pk] = tokens
+        for token, weight in tokens.items():
+            docs = self.postings[token]
+            if not docs:
+                for trigram in trigrams(token):
+                    self.vocab_trigrams[trigram].add(token)
+            docs[pk] = weight
+
+    @staticmethod
+    def _searchable():
+        return Product.objects.filter(is_active=True, is_available=True)
+
+    def _load(self, queryset):
+        """
+        {pk: (tokens, card, code)} для товаров queryset — два запроса (товары + характеристики).
+        """
+        rows = list(queryset.values_list("id", "name", "code", "slug", "category__name"))
+        values = defaultdict(list)
+        chars = (
+            Characteristics.objects
+            .filter(product__in=queryset)
+            .values_list("product_id", "value")
+        )
+        for product_id, value in chars.iterator():
+            values[product_id].append(value)
+        return {
+            pk: (
+                self.document_tokens(name, code, category_name, values.get(pk, ())),
+                {"id": pk, "slug": slug, "name": name},
+                code,
+            )
+            for pk, name, code, slug, category_name in rows
+        }
+
+    # ---------- синхронизация ----------
+    def rebuild(self, versions=None):
+        with self._sync_lock:
+            self._rebuild(versions)
+
+    def _rebuild(self, versions=None):
+        started = time.monotonic()
+        if versions is None:
+            versions = get_versions(CATALOG, CATEGORIES)
+        # журнал — до чтения товаров: то, что закоммитят во время загрузки, доберёт catch_up
+        change_id = ProductChange.objects.aggregate(last=Max("id"))["last"] or 0
+        documents = self._load(self._searchable())
+        with self._lock:
+            self.postings = defaultdict(dict)
+            self.vocab_trigrams = defaultdict(set)
+            self.documents = {}
+            self.suggestions = PrefixIndex()
+            for pk, document in documents.items():
+                self._add(pk, document, suggest=False)
+            self.suggestions.bulk_load(
+                (pk, (card["name"], code), card) for pk, (_, card, code) in documents.items()
+            )
+            self.versions = versions
+            self.change_id = change_id
+            self.build_seconds = round(time.monotonic() - started, 3)
+
+    def _catch_up(self, versions):
+        """
+        Изменения других процессов по журналу ProductChange: перечитываем товары,
+        изменённые после прошлой синхронизации; удалённые и скрытые выкидываем.
+        """
+        try:
+            batch = read_changes(self.change_id, limit=CATCH_UP_MAX_CHANGES)
+        except TokenExpired:
+            batch = None  # журнал обрезан дальше нашей позиции
+        if batch is None or batch.has_more:
+            self._rebuild(versions)
+            return
+        changed = batch.upserted + batch.deleted
+        documents = self._load(self._searchable().filter(pk__in=changed)) if changed else {}
+        with self._lock:
+            for pk in changed:
+                if pk in documents:
+                    self._add(pk, documents[pk])
+                else:
+                    self._remove(pk)
+            self.versions = versions
+            self.change_id = batch.last_id
+
+    def ensure_fresh(self):
+        versions = get_versions(CATALOG, CATEGORIES)
+        if versions == self.versions:
+            return
+        # индекс уже есть — пока другой поток его синхронизирует, ищем по прежнему
+        if not self._sync_lock.acquire(blocking=self.versions is None):
+            return
+        try:
+            if versions == self.versions:
+                return
+            if self.versions is None or versions[CATEGORIES] != self.versions[CATEGORIES]:
+                # переименование категории задевает много документов — проще перестроить
+                self._rebuild(versions)
+            else:
+                self._catch_up(versions)
+        finally:
+            self._sync_lock.release()
+
+    def update_product(self, pk):
+        """
+        Точечная переиндексация после сохранения товара/его характеристик.
+        """
+        if self.versions is None:
+            return  # индекс ещё не строился — построится при первом поиске
+        documents = self._load(self._searchable().filter(pk=pk))
+        with self._lock:
+            if pk in documents:
+                self._add(pk, documents[pk])
+            else:
+                self._remove(pk)
+
+    def remove_product(self, pk):
+        with self._lock:
+            self._remove(pk)
+
+    # ---------- поиск ----------
+    def _match_tokens(self, query_token):
+        """
+        [(токен словаря, похожесть 0..1)] для одного слова запроса.
+        """
+        matches = {}
+        if query_token in self.postings:
+            matches[query_token] = 1.0
+            if query_token.isdigit():
+                # полный артикул/число — похожие искать незачем
+                return matches
+        query_trigrams = trigrams(query_token)
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self.vocab_trigrams.get(trigram, ()))
+        numeric = query_token.isdigit()
+        for token, count in shared.items():
+            if token in matches:
+                continue
+            if numeric and not token.startswith(query_token):
+                # в артикулах и числах опечаток не прощаем — только продолжение
+                continue
+            coverage = count / len(query_trigrams)
+            if coverage >= MIN_TRIGRAM_COVERAGE:
+                jaccard = count / (len(query_trigrams) + len(trigrams(token)) - count)
+                matches[token] = 0.8 * coverage * (0.5 + 0.5 * jaccard)
+        return matches
+
+    def search(self, query: str, limit: int = 1000):
+        """
+        id товаров по убыванию релевантности. Каждое слово запроса должно
+        найтись в документе (точно, по префиксу или с опечаткой).
+        """
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return []
+
+        with self._lock:
+            matched = [self._match_tokens(query_token) for query_token in query_tokens]
+            # начинаем с самого редкого слова: дальше проверяем только его кандидатов
+            matched.sort(key=lambda matches: sum(len(self.postings[t]) for t in matches))
+
+            scores = None
+            for matches in matched:
+                if scores is None:
+                    token_scores = {}
+                    for token, similarity in matches.items():
+                        for pk, weight in self.postings[token].items():
+                            score = similarity * weight
+                            if score > token_scores.get(pk, 0):
+                                token_scores[pk] = score
+                    scores = token_scores
+                else:
+                    narrowed = {}
+                    for pk, total in scores.items():
+                        best = 0
+                        for token, similarity in matches.items():
+                            weight = self.postings[token].get(pk)
+                            if weight is not None and similarity * weight > best:
+                                best = similarity * weight
+                        if best:
+                            narrowed[pk] = total + best
+                    scores = narrowed
+                if not scores:
+                    return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [pk for pk, _ in ranked[:limit]]
+
+    def suggest(self, query: str, limit: int = 10):
+        with self._lock:
+            return self.suggestions.lookup(query, limit)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "documents": len(self.documents),
+                "suggest_keys": len(self.suggestions.keys),
+                "tokens": len(self.postings),
+                "trigrams": len(self.vocab_trigrams),
+                "versions": self.versions,
+                "change_id": self.change_id,
+                "build_seconds": self.build_seconds,
+            }
+
+
+product_search_index = ProductSearchIndex()
+
+
+# ===== DRF backends =====
+class ProductSearchFilter(BaseFilterBackend):
+    """
+    ?search=... -> товары из индекса, по умолчанию в порядке релевантности.
+    Не больше CATALOG_SEARCH_MAX_RESULTS лучших: каждый id — параметр запроса и ветка
+    CASE для сортировки. Если совпадений больше, request.search_truncated = True —
+    список и фасеты отдают это как "search_truncated": true (count — после обрезки).
+    """
+
+    search_param = api_settings.SEARCH_PARAM
+
+    def get_search_query(self, request):
+        return (request.query_params.get(self.search_param) or "").strip()
+
+    def filter_queryset(self, request, queryset, view):
+        query = self.get_search_query(request)
+        if not query:
+            return queryset
+
+        limit = int(getattr(settings, "CATALOG_SEARCH_MAX_RESULTS", 1000))
+        product_search_index.ensure_fresh()
+        ids = product_search_index.search(query, limit=limit + 1)
+        if not ids:
+            return queryset.none()
+        if len(ids) > limit:
+            ids = ids[:limit]
+            request.search_truncated = True
+
+        rank = Case(
+            *[When(id=pk, then=Value(pos)) for pos, pk in enumerate(ids)],
+            output_field=IntegerField(),
+        )
+        return queryset.filter(id__in=ids).order_by(rank, "-id")
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                "name": self.search_param,
+                "required": False,
+                "in": "query",
+                "description": "Поиск по названию, коду, категории и характеристикам",
+                "schema": {"type": "string"},
+            },
+        ]
+
+
+class ProductOrderingFilter(OrderingFilter):
+    """
+    Без явного ?ordering= при поиске оставляем порядок релевантности.
+    """
+
+    def get_ordering(self, request, queryset, view):
+        params = request.query_params.get(self.ordering_param)
+        if not params and ProductSearchFilter().get_search_query(request):
+            return None
+        return super().get_ordering(request, queryset, view)
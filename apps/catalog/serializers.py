@@ -1,4 +1,10 @@
+import decimal
+
+from django.conf import settings
 from rest_framework import serializers
+from rest_framework.settings import api_settings
+
+from apps.utils import rendition_srcset
 
 from .models import (
     Category,
@@ -16,6 +22,7 @@ class ProductListSerializer(serializers.ModelSerializer):
     category_id = serializers.IntegerField(source="category.id", read_only=True)
     category_name = serializers.CharField(source="category.name", read_only=True)
     main_image = serializers.SerializerMethodField()
+    main_image_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
@@ -28,25 +35,221 @@ class ProductListSerializer(serializers.ModelSerializer):
             "wholesale_price",  
             "old_price",
             "discount",
+            "effective_price",
             "promotion",
             "is_available",
             "quantity", 
             "category_id",
             "category_name",
             "main_image",
+            "main_image_srcset",
         )
 
+    def _image_url(self, name):
+        request = self.context.get("request")
+        url = ProductImage._meta.get_field("image").storage.url(name)
+        return request.build_absolute_uri(url) if request else url
+
     def get_main_image(self, obj):
         """
-        Берём первую картинку (мы её заранее подтянем через prefetch_related).
-        Без доп. запросов к БД.
+        Путь первой картинки хранится в самом товаре (Product.main_image),
+        таблицу картинок не трогаем.
+        """
+        if not obj.main_image:
+            return None
+        return self._image_url(obj.main_image)
+
+    def get_main_image_srcset(self, obj):
+        # превью 160/320/640/1280 лежат рядом с картинкой (apps.utils.generate_renditions)
+        return rendition_srcset(obj.main_image, self._image_url, ProductImage._meta.get_field("image").storage)
+
+
+# ==========================
+# Product: bulk (корзина, избранное)
+# ==========================
+class ProductBulkLookupSerializer(serializers.Serializer):
+    """
+    Вход POST /products/bulk/: {"ids": [...], "slugs": [...]} — что лежит в localStorage.
+    Повторы убираем, порядок сохраняем.
+    """
+
+    # max_value — BIGINT: иначе огромное число из localStorage роняет запрос к БД
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1, max_value=2**63 - 1),
+        required=False,
+        default=list,
+    )
+    slugs = serializers.ListField(child=serializers.CharField(max_length=512), required=False, default=list)
+
+    def validate(self, attrs):
+        ids = list(dict.fromkeys(attrs["ids"]))
+        slugs = list(dict.fromkeys(attrs["slugs"]))
+        if not ids and not slugs:
+            raise serializers.ValidationError("Передайте ids или slugs.")
+        limit = getattr(settings, "CATALOG_BULK_LOOKUP_MAX_ITEMS", 500)
+        if len(ids) + len(slugs) > limit:
+            raise serializers.ValidationError(f"Не больше {limit} товаров за запрос.")
+        return {"ids": ids, "slugs": slugs}
+
+
+# ==========================
+# Product: list (быстрый путь)
+# ==========================
+class ProductListRowSerializer:
+    """
+    Тот же ответ, что у ProductListSerializer (байт в байт), но из строк .values():
+    без инстансов моделей, без объектов полей DRF на каждую строку и без
+    build_absolute_uri на каждую картинку. План (поле -> ключ строки -> конвертер)
+    собирается один раз из полей ProductListSerializer.
+
+    Интерфейс как у сериализатора: Serializer(rows, many=True, context=...).data
+    """
+
+    source_serializer = ProductListSerializer
+    main_image_field = "main_image"
+    main_image_srcset_field = "main_image_srcset"
+    main_image_key = "main_image"
+    # поля сортировки нужны keyset-пагинации, даже если их нет в ответе
+    extra_values = ("created_at",)
+
+    _plan = None
+
+    def __init__(self, instance=None, many=False, context=None, **kwargs):
+        self.instance = instance
+        self.many = many
+        self.context = context or {}
+
+    # ---------- план ----------
+    @staticmethod
+    def _decimal_converter(field):
+        if field.normalize_output or field.localize or not getattr(
+            field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING
+        ):
+            return field.to_representation
+
+        exponent = decimal.Decimal(".1") ** field.decimal_places if field.decimal_places is not None else None
+        context = decimal.getcontext().copy()
+        if field.max_digits is not None:
+            context.prec = field.max_digits
+        rounding = field.rounding
+
+        def convert(value):
+            if not isinstance(value, decimal.Decimal):
+                value = decimal.Decimal(str(value).strip())
+            if exponent is not None:
+                value = value.quantize(exponent, rounding=rounding, context=context)
+            return f"{value:f}"
+
+        return convert
+
+    @classmethod
+    def get_plan(cls):
         """
+        [(имя поля в ответе, ключ в строке values(), ключ-проверка связи или None, конвертер)]
+        """
+        if cls._plan is not None:
+            return cls._plan
+
+        plan = []
+        for name, field in cls.source_serializer().fields.items():
+            if name in (cls.main_image_field, cls.main_image_srcset_field):
+                continue
+            source = field.source
+            relation_key = None
+            if "." in source:
+                relation, attr = source.split(".", 1)
+                # category.id -> category_id, category.name -> category__name
+                key = f"{relation}_id" if attr == "id" else f"{relation}__{attr.replace('.', '__')}"
+                # как у DRF: нет связи -> поле пропускается целиком
+                relation_key = f"{relation}_id"
+            else:
+                key = source
+
+            if isinstance(field, serializers.DecimalField):
+                convert = cls._decimal_converter(field)
+            elif isinstance(field, (serializers.CharField, serializers.IntegerField, serializers.BooleanField)):
+                convert = None  # values() уже отдаёт str/int/bool
+            else:
+                convert = field.to_representation
+            plan.append((name, key, relation_key, convert))
+
+        cls._plan = plan
+        return plan
+
+    @classmethod
+    def values_fields(cls):
+        keys = []
+        for _, key, relation_key, _ in cls.get_plan():
+            for k in (key, relation_key):
+                if k and k not in keys:
+                    keys.append(k)
+        keys.extend(k for k in cls.extra_values if k not in keys)
+        return keys
+
+    @classmethod
+    def prepare_queryset(cls, queryset):
+        """
+        queryset товаров -> .values() ровно с нужными колонками + путь главной картинки.
+        """
+        return queryset.values(*cls.values_fields(), cls.main_image_key)
+
+    # ---------- сериализация ----------
+    def _image_url_builder(self):
+        storage = ProductImage._meta.get_field("image").storage
         request = self.context.get("request")
-        img = next(iter(getattr(obj, "images_all", obj.images.all())), None)
-        if img and getattr(img.image, "url", None):
-            url = img.image.url
-            return request.build_absolute_uri(url) if request else url
-        return None
+        if request is None:
+            # снимок каталога собирается без запроса: хост — из настроек (или относительные URL)
+            base_url = (self.context.get("base_url") or "").rstrip("/")
+            if not base_url:
+                return storage.url
+
+            def build_without_request(name):
+                url = storage.url(name)
+                return base_url + url if url.startswith("/") and not url.startswith("//") else url
+
+            return build_without_request
+
+        # build_absolute_uri("/path") == scheme://host + "/path" для обычных путей
+        prefix = request.build_absolute_uri("/")[:-1]
+
+        def build(name):
+            url = storage.url(name)
+            if url.startswith("/") and not url.startswith("//") and "/./" not in url and "/../" not in url:
+                return prefix + url
+            return request.build_absolute_uri(url)
+
+        return build
+
+    def to_representation_rows(self, rows):
+        plan = self.get_plan()
+        image_url = self._image_url_builder()
+        storage = ProductImage._meta.get_field("image").storage
+        main_image_field = self.main_image_field
+        main_image_srcset_field = self.main_image_srcset_field
+        main_image_key = self.main_image_key
+
+        result = []
+        for row in rows:
+            item = {}
+            for name, key, relation_key, convert in plan:
+                if relation_key is not None and row[relation_key] is None:
+                    continue
+                value = row[key]
+                if value is None or convert is None:
+                    item[name] = value
+                else:
+                    item[name] = convert(value)
+            path = row[main_image_key]
+            item[main_image_field] = image_url(path) if path else None
+            item[main_image_srcset_field] = rendition_srcset(path, image_url, storage)
+            result.append(item)
+        return result
+
+    @property
+    def data(self):
+        if self.many:
+            return self.to_representation_rows(self.instance)
+        return self.to_representation_rows([self.instance])[0]
 
 
 # ==========================
@@ -127,6 +330,7 @@ class ProductDetailSerializer(serializers.ModelSerializer):
             "wholesale_price", 
             "old_price",
             "discount",
+            "effective_price",
             "promotion",
             "is_active",
             "is_available",
@@ -149,6 +353,7 @@ class CategorySerializer(serializers.ModelSerializer):
         required=False,
     )
     image_url = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Category
@@ -159,11 +364,14 @@ class CategorySerializer(serializers.ModelSerializer):
             "parent",
             "image",
             "image_url",
+            "image_srcset",
             "is_active",
+            "product_count",
+            "product_count_total",
             "created_at",
             "updated_at",
         )
-        read_only_fields = ("created_at", "updated_at")
+        read_only_fields = ("product_count", "product_count_total", "created_at", "updated_at")
 
     def get_image_url(self, obj):
         request = self.context.get("request")
@@ -172,6 +380,18 @@ class CategorySerializer(serializers.ModelSerializer):
             return request.build_absolute_uri(url) if request else url
         return None
 
+    def get_image_srcset(self, obj):
+        if not obj.image:
+            return None
+        request = self.context.get("request")
+        storage = obj.image.storage
+
+        def build_url(name):
+            url = storage.url(name)
+            return request.build_absolute_uri(url) if request else url
+
+        return rendition_srcset(obj.image.name, build_url, storage)
+
 
 # ==========================
 # Category: дерево
@@ -182,8 +402,22 @@ class CategoryTreeSerializer(CategorySerializer):
     class Meta(CategorySerializer.Meta):
         fields = CategorySerializer.Meta.fields + ("children",)
 
+    def to_representation(self, obj):
+        data = super().to_representation(obj)
+        # дерево из памяти (tree.py): категории прочитаны при смене структуры,
+        # счётчики — свежие, по версии CATEGORY_COUNTS
+        counts = self.context.get("category_counts")
+        if counts is not None:
+            data["product_count"], data["product_count_total"] = counts.get(obj.pk, (0, 0))
+        return data
+
     def get_children(self, obj):
-        qs = obj.get_children()
+        # tree.get_category_tree() заранее раскладывает все категории по parent_id
+        children_map = self.context.get("category_children")
+        if children_map is not None:
+            qs = children_map.get(obj.pk, [])
+        else:
+            qs = obj.get_children()
         return CategoryTreeSerializer(qs, many=True, context=self.context).data
 
 
@@ -1,10 +1,27 @@
 import logging
 
 from django.db import transaction
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
+from mptt.signals import node_moved
 
-from .models import Product
+from .cache import CATEGORIES, CATEGORY_COUNTS, PRODUCT_DETAIL, bump_version, product_detail_cache
+from .changes import record_change, record_changes
+from .counts import rebuild_category_counts, shift_category_counts
+from .models import (
+    Product,
+    ProductImage,
+    Category,
+    Characteristics,
+    CharacteristicsDict,
+    ProductChange,
+    SIMILAR_KEY_FIELDS,
+    SimilarProduct,
+    main_image_subquery,
+)
+from .search import product_search_index
+from .similar import similar_refresh
 from .serializers import ProductSerializer
 from .webhooks import send_product_webhook_data
 
@@ -29,3 +46,206 @@ def product_pre_delete_send_webhook(sender, instance: Product, using, **kwargs):
 
     transaction.on_commit(_after_commit, using=using)
 
+
+# ===== инвалидация кэшей каталога =====
+CATALOG_MODELS = (Product, ProductImage, Category, Characteristics, CharacteristicsDict)
+
+
+def catalog_changed(sender, **kwargs):
+    """
+    Любое сохранение/удаление (вебхук CRM, админка, inline-ы) -> новая версия каталога.
+    """
+    bump_version()
+
+
+for _model in CATALOG_MODELS:
+    post_save.connect(catalog_changed, sender=_model, dispatch_uid=f"catalog_changed_save_{_model.__name__}")
+    post_delete.connect(catalog_changed, sender=_model, dispatch_uid=f"catalog_changed_delete_{_model.__name__}")
+# перенос ветки меняет фильтр include_descendants -> кэш списка товаров тоже устарел
+node_moved.connect(catalog_changed, sender=Category, dispatch_uid="catalog_changed_move_Category")
+
+
+@receiver(post_save, sender=Category, dispatch_uid="categories_changed_save")
+@receiver(post_delete, sender=Category, dispatch_uid="categories_changed_delete")
+@receiver(node_moved, sender=Category, dispatch_uid="categories_changed_move")
+def categories_changed(sender, **kwargs):
+    """
+    Дерево категорий (/categories/tree/) держим в памяти до следующего изменения.
+    Сюда же попадают категории, созданные вебхуком CRM (get_or_create -> save).
+    """
+    bump_version(CATEGORIES)
+
+
+# ===== журнал изменений (/products/changes/) =====
+@receiver(post_save, sender=Product, dispatch_uid="product_change_saved")
+def product_change_saved(sender, instance: Product, using, **kwargs):
+    """
+    В той же транзакции, что и сам товар: откат не оставляет записи в журнале.
+    """
+    record_change(instance.pk, ProductChange.UPSERT, using)
+
+
+@receiver(post_delete, sender=Product, dispatch_uid="product_change_deleted")
+def product_change_deleted(sender, instance: Product, using, **kwargs):
+    # tombstone: вебхук product.deleted, удаление из админки
+    record_change(instance.pk, ProductChange.DELETE, using)
+
+
+@receiver(pre_delete, sender=Category, dispatch_uid="product_change_category_deleted")
+def product_change_category_deleted(sender, instance: Category, using, **kwargs):
+    """
+    Товары удаляемой категории остаются без неё: SET_NULL делает queryset.update
+    без сигналов товара. Подкатегории удаляются каскадом и приходят сюда же, каждая
+    со своими товарами. Та же транзакция, что и удаление.
+    """
+    product_ids = list(Product.objects.using(using).filter(category=instance).values_list("id", flat=True))
+    record_changes(product_ids, ProductChange.UPSERT, using)
+
+
+# ===== счётчики товаров в категориях =====
+@receiver(post_save, sender=Product, dispatch_uid="category_counts_product_saved")
+def category_counts_product_saved(sender, instance: Product, created, using, **kwargs):
+    """
+    Смена категории или видимости товара: -1 старой ветке, +1 новой, в той же транзакции.
+    Если прежнее состояние неизвестно (товар читали с only/defer) — пересчёт целиком.
+    """
+    new = instance.get_count_key()
+    if created:
+        old = None
+    elif hasattr(instance, "_loaded_count_key"):
+        old = instance._loaded_count_key
+    else:
+        instance._loaded_count_key = new
+        transaction.on_commit(rebuild_category_counts, using=using)
+        return
+    instance._loaded_count_key = new
+    if shift_category_counts(old, new, using):
+        bump_version(CATEGORY_COUNTS)
+
+
+@receiver(post_delete, sender=Product, dispatch_uid="category_counts_product_deleted")
+def category_counts_product_deleted(sender, instance: Product, using, **kwargs):
+    old = getattr(instance, "_loaded_count_key", None) or instance.get_count_key()
+    if shift_category_counts(old, None, using):
+        bump_version(CATEGORY_COUNTS)
+
+
+@receiver(post_save, sender=Category, dispatch_uid="category_counts_category_saved")
+@receiver(post_delete, sender=Category, dispatch_uid="category_counts_category_deleted")
+@receiver(node_moved, sender=Category, dispatch_uid="category_counts_category_moved")
+def category_counts_category_changed(sender, **kwargs):
+    """
+    Перенос ветки меняет суммы у предков, удаление — обнуляет category у товаров (SET_NULL
+    без сигналов), а save() из админки пишет прочитанные ранее счётчики. Категории
+    меняются редко — пересчитываем всё после commit.
+    """
+    transaction.on_commit(rebuild_category_counts, using=kwargs.get("using"))
+
+
+# ===== кэш детальной карточки =====
+@receiver(post_save, sender=Category, dispatch_uid="product_detail_changed_category_save")
+@receiver(post_delete, sender=Category, dispatch_uid="product_detail_changed_category_delete")
+@receiver(post_save, sender=CharacteristicsDict, dispatch_uid="product_detail_changed_dict_save")
+@receiver(post_delete, sender=CharacteristicsDict, dispatch_uid="product_detail_changed_dict_delete")
+def product_detail_changed(sender, **kwargs):
+    """
+    Категория и названия характеристик есть в каждой карточке — новое поколение для всех.
+    """
+    bump_version(PRODUCT_DETAIL)
+
+
+@receiver(post_save, sender=Product, dispatch_uid="product_detail_evict_save")
+@receiver(post_delete, sender=Product, dispatch_uid="product_detail_evict_delete")
+def product_detail_evict(sender, instance: Product, using, **kwargs):
+    """
+    Сам товар: убираем карточку по новому и по прежнему slug (вебхук CRM может сменить slug).
+    После commit: до него другие запросы ещё читают старую строку.
+    """
+    slugs = (instance.slug, getattr(instance, "_loaded_slug", None))
+    instance._loaded_slug = instance.slug
+    transaction.on_commit(lambda: product_detail_cache.evict(*slugs), using=using)
+
+
+# ===== поисковый индекс =====
+@receiver(post_save, sender=Product, dispatch_uid="search_index_product_saved")
+def search_index_product_saved(sender, instance: Product, using, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: product_search_index.update_product(pk), using=using)
+
+
+@receiver(post_delete, sender=Product, dispatch_uid="search_index_product_deleted")
+def search_index_product_deleted(sender, instance: Product, using, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: product_search_index.remove_product(pk), using=using)
+
+
+@receiver(post_save, sender=Characteristics, dispatch_uid="product_touch_characteristics_save")
+@receiver(post_delete, sender=Characteristics, dispatch_uid="product_touch_characteristics_delete")
+@receiver(post_save, sender=ProductImage, dispatch_uid="product_touch_image_save")
+@receiver(post_delete, sender=ProductImage, dispatch_uid="product_touch_image_delete")
+def product_touch(sender, instance, using, **kwargs):
+    """
+    Картинки и характеристики — часть карточки товара: двигаем Product.updated_at.
+    Для картинок заодно пересчитываем Product.main_image. Карточка поменялась —
+    запись в журнал изменений: по нему другие процессы обновляют поисковый индекс
+    (ProductSearchIndex._catch_up).
+    """
+    product_id = instance.product_id
+    fields = {"updated_at": timezone.now()}
+    if sender is ProductImage:
+        # sync_product_images, inline-ы админки и удаления — всё проходит через сигналы картинки
+        fields["main_image"] = main_image_subquery()
+    if Product.objects.using(using).filter(pk=product_id).update(**fields):
+        record_change(product_id, ProductChange.UPSERT, using)
+    if sender is Characteristics:
+        transaction.on_commit(lambda: product_search_index.update_product(product_id), using=using)
+
+
+# ===== файлы картинок =====
+@receiver(post_delete, sender=ProductImage, dispatch_uid="image_file_release")
+def image_file_release(sender, instance: ProductImage, using, **kwargs):
+    """
+    Файл по хешу содержимого может быть общим для нескольких товаров —
+    удаляется вместе с превью, только когда на него не осталось ссылок.
+    """
+    name = instance.image.name
+    transaction.on_commit(lambda: ProductImage.release_file(name), using=using)
+
+
+# ===== похожие товары =====
+@receiver(post_save, sender=Product, dispatch_uid="similar_product_saved")
+def similar_product_saved(sender, instance: Product, created, using, **kwargs):
+    """
+    Цена, категория, снятие с витрины — пересчитываем соседей товара и списки, где он есть
+    (similar_refresh: один раз на транзакцию, после commit, в фоне).
+    Остаток, описание и прочее на похожесть не влияют — ничего не делаем.
+    Прежнее состояние неизвестно (товар читали с only/defer) — пересчитываем.
+    """
+    if instance.get_deferred_fields() & set(SIMILAR_KEY_FIELDS):
+        new = None
+    else:
+        new = instance.get_similar_key()
+    old = getattr(instance, "_loaded_similar_key", None)
+    instance._loaded_similar_key = new
+    if not created and new is not None and old == new:
+        return
+    similar_refresh.schedule([instance.pk], using)
+
+
+@receiver(pre_delete, sender=Product, dispatch_uid="similar_product_deleted")
+def similar_product_deleted(sender, instance: Product, using, **kwargs):
+    # строки SimilarProduct уйдут каскадом — списки, где был товар, запоминаем до удаления
+    referrers = list(
+        SimilarProduct.objects.using(using)
+        .filter(similar_id=instance.pk)
+        .values_list("product_id", flat=True)
+    )
+    if referrers:
+        similar_refresh.schedule(referrers, using)
+
+
+@receiver(post_save, sender=Characteristics, dispatch_uid="similar_characteristics_save")
+@receiver(post_delete, sender=Characteristics, dispatch_uid="similar_characteristics_delete")
+def similar_characteristics_changed(sender, instance: Characteristics, using, **kwargs):
+    # товар с пятью характеристиками в одной транзакции — всё равно один пересчёт
+    similar_refresh.schedule([instance.product_id], using)
@@ -0,0 +1,319 @@
+"""
+Похожие товары: для каждого товара заранее посчитанный список соседей (SimilarProduct),
+/products/{slug}/similar/ отдаёт его одним запросом по индексу (product, position).
+
+Кандидаты — товары витрины из той же ветки категорий: сначала категория товара
+с подкатегориями, если их меньше CATALOG_SIMILAR_LIMIT — ветка родителя и так до корня.
+Из ветки берём CATALOG_SIMILAR_CANDIDATES ближайших по цене со скидкой, оценка:
+    общие значения характеристик (key, value_normalized) — доля от характеристик товара,
+    категория — та же / подкатегория / соседняя ветка,
+    цена — насколько близка effective_price.
+
+Пересчёт точечный (signals.similar_product_saved): изменённый товар, товары, у которых
+он уже в списке, и его новые соседи — для них он, скорее всего, тоже похожий.
+Только когда поменялось то, от чего зависит оценка: категория, effective_price,
+видимость на витрине (Product.get_similar_key) или характеристики.
+Сигналы не считают сами, а ставят товар в очередь (similar_refresh): один пересчёт
+на транзакцию, после commit, в фоновом потоке.
+Перенос категорий и массовые правки в обход save() — catalog_rebuild --only similar.
+
+Ответы /similar/ кэшируются по версии SIMILAR (и CATALOG — карточки соседей):
+пересчёт списков не сбрасывает кэш остального каталога.
+"""
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Abs
+
+from .cache import SIMILAR, bump_version
+from .models import LIVE_PRODUCTS, Characteristics, Product, SimilarProduct
+from .tree import get_category_index
+
+ATTRIBUTE_WEIGHT = 0.5
+CATEGORY_WEIGHT = 0.3
+PRICE_WEIGHT = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+def get_limit() -> int:
+    return int(getattr(settings, "CATALOG_SIMILAR_LIMIT", 12))
+
+
+def get_candidate_limit() -> int:
+    return int(getattr(settings, "CATALOG_SIMILAR_CANDIDATES", 500))
+
+
+def is_async() -> bool:
+    return bool(getattr(settings, "CATALOG_SIMILAR_ASYNC", True))
+
+
+# ===== кандидаты =====
+def _scopes(category_id, index):
+    """
+    Категория товара с подкатегориями, затем ветки предков — до корня.
+    """
+    node = index.by_id.get(category_id)
+    while node is not None:
+        yield index.descendant_ids(node.pk)
+        node = index.by_id.get(node.parent_id)
+
+
+def _candidates(product, index, limit):
+    """
+    [{id, category_id, effective_price}] — ближайшие по цене товары витрины из ветки категорий.
+    """
+    queryset = Product.objects.filter(LIVE_PRODUCTS).exclude(pk=product["id"])
+    if product["effective_price"] is not None:
+        queryset = queryset.annotate(distance=Abs(F("effective_price") - Value(product["effective_price"])))
+        queryset = queryset.order_by(F("distance").asc(nulls_last=True), "id")
+    else:
+        queryset = queryset.order_by("-created_at", "id")
+    queryset = queryset.values("id", "category_id", "effective_price")
+
+    if product["category_id"] is None:
+        return list(queryset.filter(category__isnull=True)[:limit])
+
+    rows = []
+    for category_ids in _scopes(product["category_id"], index):
+        rows = list(queryset.filter(category_id__in=sorted(category_ids))[:limit])
+        if len(rows) >= get_limit():
+            break
+    return rows
+
+
+# ===== оценка =====
+def _price_score(price, other) -> float:
+    if price is None or other is None:
+        return 0.0
+    top = max(price, other)
+    if top <= 0:
+        return 1.0
+    return 1.0 - min(float(abs(price - other) / top), 1.0)
+
+
+def _category_score(category_id, other_id, index) -> float:
+    if category_id == other_id:
+        return 1.0
+    if category_id is not None and other_id in index.descendant_ids(category_id):
+        return 0.75
+    return 0.5
+
+
+def compute_similar(product, index) -> list:
+    """
+    [(id соседа, оценка)] по убыванию оценки, не длиннее CATALOG_SIMILAR_LIMIT.
+    product — строка {id, category_id, effective_price}.
+    """
+    candidates = _candidates(product, index, get_candidate_limit())
+    if not candidates:
+        return []
+
+    pairs = set(
+        Characteristics.objects
+        .filter(product_id=product["id"])
+        .exclude(value_normalized="")
+        .values_list("key_id", "value_normalized")
+    )
+    shared = Counter()
+    if pairs:
+        rows = (
+            Characteristics.objects
+            .filter(
+                product_id__in=[c["id"] for c in candidates],
+                key_id__in={key for key, _ in pairs},
+                value_normalized__in={value for _, value in pairs},
+            )
+            .values_list("product_id", "key_id", "value_normalized")
+        )
+        for product_id, key_id, value in rows:
+            if (key_id, value) in pairs:
+                shared[product_id] += 1
+
+    scored = []
+    for candidate in candidates:
+        score = (
+            ATTRIBUTE_WEIGHT * (shared[candidate["id"]] / len(pairs) if pairs else 0.0)
+            + CATEGORY_WEIGHT * _category_score(product["category_id"], candidate["category_id"], index)
+            + PRICE_WEIGHT * _price_score(product["effective_price"], candidate["effective_price"])
+        )
+        scored.append((candidate["id"], round(score, 6)))
+    scored.sort(key=lambda item: (-item[1], item[0]))
+    return scored[:get_limit()]
+
+
+# ===== запись =====
+def rebuild_similar(product_ids):
+    """
+    Пересчитывает списки товаров product_ids, пишет только изменившиеся.
+    -> ({id товара: [id соседей]}, сколько списков изменилось)
+    Снятые с витрины товары получают пустой список.
+    """
+    product_ids = sorted(set(product_ids))
+    if not product_ids:
+        return {}, 0
+
+    index = get_category_index()
+    products = (
+        Product.objects
+        .filter(LIVE_PRODUCTS, id__in=product_ids)
+        .values("id", "category_id", "effective_price")
+    )
+    neighbors = {pk: [] for pk in product_ids}
+    scored = {pk: [] for pk in product_ids}
+    for product in products:
+        scored[product["id"]] = compute_similar(product, index)
+        neighbors[product["id"]] = [similar_id for similar_id, _ in scored[product["id"]]]
+
+    stored = {pk: [] for pk in product_ids}
+    rows = (
+        SimilarProduct.objects
+        .filter(product_id__in=product_ids)
+        .order_by("product_id", "position")
+        .values_list("product_id", "similar_id", "score")
+    )
+    for product_id, similar_id, score in rows:
+        stored[product_id].append((similar_id, score))
+    changed = [pk for pk in product_ids if stored[pk] != scored[pk]]
+    if not changed:
+        return neighbors, 0
+
+    links = [
+        SimilarProduct(product_id=pk, similar_id=similar_id, position=position, score=score)
+        for pk in changed
+        for position, (similar_id, score) in enumerate(scored[pk])
+    ]
+    with transaction.atomic():
+        SimilarProduct.objects.filter(product_id__in=changed).delete()
+        SimilarProduct.objects.bulk_create(links)
+    return neighbors, len(changed)
+
+
+def refresh_similar(product_ids) -> int:
+    """
+    Точечный пересчёт после изменения товаров: сами товары, те, у кого они в списке,
+    и их новые соседи. -> сколько списков изменилось.
+    """
+    product_ids = set(product_ids)
+    referrers = set(
+        SimilarProduct.objects
+        .filter(similar_id__in=product_ids)
+        .values_list("product_id", flat=True)
+    )
+    neighbors, changed = rebuild_similar(product_ids)
+    affected = (referrers | {pk for ids in neighbors.values() for pk in ids}) - product_ids
+    changed += rebuild_similar(affected)[1]
+    if changed:
+        bump_version(SIMILAR)
+    return changed
+
+
+# ===== очередь пересчёта =====
+class SimilarRefreshQueue:
+    """
+    Пересчёт — десятки запросов на товар, тем больше, чем больше ветка категорий:
+    в запросе вебхука CRM или админки ему не место.
+
+    schedule() копит id товаров в пределах транзакции: товар и все его характеристики
+    дают один пересчёт. После commit пачка уходит в фоновый поток; пока он считает,
+    новые пачки сливаются в одну следующую. Поток один на процесс. id из откаченного
+    savepoint-а остаются в пачке — лишний пересчёт ничего не портит.
+
+    CATALOG_SIMILAR_ASYNC=False — пересчёт сразу после commit, в том же потоке.
+    Очередь живёт в памяти процесса: не досчитанное до перезапуска добирает
+    catalog_rebuild --only similar.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = set()
+        self._thread = None
+        self.batches = 0
+        self.failed = 0
+
+    def schedule(self, product_ids, using=None):
+        connection = transaction.get_connection(using)
+        batch = getattr(connection, "_similar_refresh_batch", None)
+        # ни одного колбэка пачки не осталось — транзакцию откатили, начинаем новую
+        if batch is None or not any(callback is batch for _, callback, _ in connection.run_on_commit):
+            batch = _RefreshBatch(self, connection)
+            connection._similar_refresh_batch = batch
+        batch.update(product_ids)
+        # колбэк на каждый вызов: откат savepoint-а снимает только свои; пачку целиком
+        # забирает первый сработавший, остальные видят её пустой
+        transaction.on_commit(batch, using=using)
+
+    def _flush(self, connection, batch):
+        if getattr(connection, "_similar_refresh_batch", None) is batch:
+            del connection._similar_refresh_batch
+        product_ids = set(batch)
+        batch.clear()
+        if not product_ids:
+            return
+        if not is_async():
+            refresh_similar(product_ids)
+            return
+        with self._lock:
+            self._pending.update(product_ids)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="catalog-similar", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    self._idle.notify_all()
+                    return
+                product_ids, self._pending = self._pending, set()
+            close_old_connections()
+            try:
+                refresh_similar(product_ids)
+            except Exception:
+                logger.exception("Similar products refresh failed: %s", sorted(product_ids))
+                with self._lock:
+                    self.failed += 1
+            finally:
+                close_old_connections()
+                with self._lock:
+                    self.batches += 1
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Дождаться пустой очереди (команды, тесты). -> False, если не дождались.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._thread is None, timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "async": is_async(),
+                "queued": len(self._pending),
+                "running": self._thread is not None,
+                "batches": self.batches,
+                "failed": self.failed,
+            }
+
+
+class _RefreshBatch(set):
+    """
+    id товаров одной транзакции; сам — колбэк on_commit.
+    """
+
+    def __init__(self, queue, connection):
+        super().__init__()
+        self.queue = queue
+        self.connection = connection
+
+    def __call__(self):
+        self.queue._flush(self.connection, self)
+
+
+similar_refresh = SimilarRefreshQueue()
@@ -0,0 +1,286 @@
+"""
+Снимок каталога: все активные товары одним файлом NDJSON (gzip) — для агрегаторов,
+холодного старта мобильного приложения и BI вместо обхода /products/ постранично.
+
+Строка = карточка товара из ProductListRowSerializer (те же поля, что у /products/),
+строки по возрастанию id.
+
+Файл — склейка gzip-блоков по BLOCK_SIZE id. После изменения каталога пережимаются
+только блоки, у которых поменялся отпечаток (count, sum(id), max(updated_at));
+картинки и характеристики двигают Product.updated_at (см. signals.product_touch).
+Переименование категорий меняет все блоки (category_name) — пересобираем целиком.
+gunzip / zcat / gzip.open читают склейку как один поток.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Count, F, Max, Sum
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_etags, quote_etag
+from rest_framework.utils.encoders import JSONEncoder
+
+from apps.utils import get_rendition_widths
+
+from .cache import CATALOG, CATEGORIES, get_versions
+from .models import Product
+from .serializers import ProductListRowSerializer
+
+BLOCK_SIZE = 1000
+MANIFEST_NAME = "manifest.json"
+FILE_PREFIX = "catalog-"
+FILE_SUFFIX = ".ndjson.gz"
+READ_CHUNK = 64 * 1024
+
+_lock = threading.Lock()
+
+
+@dataclass
+class Snapshot:
+    path: Path
+    etag: str
+    size: int
+    count: int
+    modified_at: datetime
+
+
+# ===== сборка =====
+def get_snapshot_dir() -> Path:
+    return Path(getattr(settings, "CATALOG_SNAPSHOT_DIR", Path(settings.MEDIA_ROOT) / "catalog_snapshot"))
+
+
+def _read_manifest(directory: Path):
+    try:
+        return json.loads((directory / MANIFEST_NAME).read_text("utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_atomic(path: Path, data: bytes):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _snapshot_from_manifest(directory: Path, manifest) -> Snapshot | None:
+    path = directory / manifest["file"]
+    if not path.exists():
+        return None
+    return Snapshot(
+        path=path,
+        etag=manifest["etag"],
+        size=manifest["size"],
+        count=manifest["count"],
+        modified_at=datetime.fromisoformat(manifest["modified_at"]),
+    )
+
+
+def _base_queryset():
+    return Product.objects.filter(is_active=True)
+
+
+def _fingerprints() -> dict:
+    """
+    {номер блока: [count, sum(id), max(updated_at)]} — один GROUP BY по активным товарам.
+    """
+    rows = (
+        _base_queryset()
+        .annotate(block=F("id") / BLOCK_SIZE)
+        .values("block")
+        .annotate(count=Count("id"), ids=Sum("id"), updated=Max("updated_at"))
+        .order_by("block")
+    )
+    return {str(row["block"]): [row["count"], row["ids"], row["updated"].isoformat()] for row in rows}
+
+
+def _encode_block(block: int, base_url: str) -> bytes:
+    queryset = _base_queryset().filter(id__gte=block * BLOCK_SIZE, id__lt=(block + 1) * BLOCK_SIZE)
+    rows = ProductListRowSerializer.prepare_queryset(queryset.order_by("id"))
+    cards = ProductListRowSerializer(rows, many=True, context={"base_url": base_url}).data
+    encoder = JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    text = "".join(encoder.encode(card) + "\n" for card in cards)
+    # mtime=0 — одинаковые данные дают одинаковые байты (и ETag) в любом процессе
+    return gzip.compress(text.encode("utf-8"), compresslevel=6, mtime=0)
+
+
+def build_snapshot(force: bool = False):
+    """
+    Пересобирает снимок, если версия каталога поменялась. -> (Snapshot, пережато блоков)
+    """
+    directory = get_snapshot_dir()
+    versions = get_versions(CATALOG, CATEGORIES)
+
+    with _lock:
+        manifest = _read_manifest(directory)
+        if not force and manifest and manifest["versions"] == versions:
+            snapshot = _snapshot_from_manifest(directory, manifest)
+            if snapshot is not None:
+                return snapshot, 0
+
+        blocks_dir = directory / "blocks"
+        blocks_dir.mkdir(parents=True, exist_ok=True)
+
+        base_url = getattr(settings, "CATALOG_SNAPSHOT_BASE_URL", "") or ""
+        # поменялся вид карточки — блоки пережимаются все
+        layout = {
+            "fields": ProductListRowSerializer.values_fields(),
+            "output": list(ProductListRowSerializer.source_serializer.Meta.fields),
+            "renditions": list(get_rendition_widths()),
+            "base_url": base_url,
+        }
+        previous = {}
+        if (
+            not force
+            and manifest
+            and manifest.get("layout") == layout
+            and manifest["versions"].get(CATEGORIES) == versions[CATEGORIES]
+        ):
+            previous = manifest["blocks"]
+
+        fingerprints = _fingerprints()
+        blocks = {}
+        rebuilt = 0
+        for block, fingerprint in fingerprints.items():
+            path = blocks_dir / f"{block}.gz"
+            old = previous.get(block)
+            if old is not None and old["fingerprint"] == fingerprint and path.exists():
+                blocks[block] = old
+                continue
+            data = _encode_block(int(block), base_url)
+            _write_atomic(path, data)
+            blocks[block] = {"fingerprint": fingerprint, "md5": hashlib.md5(data).hexdigest(), "size": len(data)}
+            rebuilt += 1
+
+        order = sorted(blocks, key=int)
+        digest = hashlib.md5("".join(blocks[b]["md5"] for b in order).encode("ascii")).hexdigest()
+        etag = quote_etag(digest)
+        file_name = f"{FILE_PREFIX}{digest}{FILE_SUFFIX}"
+        path = directory / file_name
+
+        if not path.exists():
+            tmp = path.with_name(f".{file_name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp, "wb") as out:
+                for block in order:
+                    with open(blocks_dir / f"{block}.gz", "rb") as src:
+                        while chunk := src.read(READ_CHUNK):
+                            out.write(chunk)
+            os.replace(tmp, path)
+
+        # Last-Modified двигаем только когда поменялось содержимое
+        if manifest and manifest.get("etag") == etag:
+            modified_at = manifest["modified_at"]
+        else:
+            modified_at = timezone.now().isoformat()
+
+        manifest = {
+            "versions": versions,
+            "layout": layout,
+            "etag": etag,
+            "file": file_name,
+            "size": sum(blocks[b]["size"] for b in order),
+            "count": sum(blocks[b]["fingerprint"][0] for b in order),
+            "modified_at": modified_at,
+            "blocks": blocks,
+        }
+        _write_atomic(directory / MANIFEST_NAME, json.dumps(manifest).encode("utf-8"))
+
+        # старые файлы и блоки исчезнувших id
+        for stale in directory.glob(f"{FILE_PREFIX}*{FILE_SUFFIX}"):
+            if stale.name != file_name:
+                stale.unlink(missing_ok=True)
+        for stale in blocks_dir.glob("*.gz"):
+            if stale.stem not in blocks:
+                stale.unlink(missing_ok=True)
+
+        return _snapshot_from_manifest(directory, manifest), rebuilt
+
+
+def get_snapshot() -> Snapshot:
+    snapshot, _ = build_snapshot()
+    return snapshot
+
+
+# ===== отдача файла =====
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _parse_range(header: str, size: int):
+    """
+    Один диапазон "bytes=a-b" / "bytes=a-" / "bytes=-n" -> (start, end) включительно.
+    None — заголовка нет или он нам не подходит (несколько диапазонов): отдаём весь файл.
+    "unsatisfiable" — диапазон за пределами файла (416).
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        length = int(last)
+        if length == 0:
+            return "unsatisfiable"
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or (last and int(last) < start):
+        return "unsatisfiable"
+    return start, end
+
+
+def _iter_file(path: Path, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(READ_CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def snapshot_response(request, snapshot: Snapshot):
+    """
+    Файл с ETag / Last-Modified, 304 по If-None-Match / If-Modified-Since,
+    один диапазон Range (206 / 416) с учётом If-Range.
+    """
+    last_modified = int(snapshot.modified_at.timestamp())
+    response = get_conditional_response(request, etag=snapshot.etag, last_modified=last_modified)
+
+    if response is None:
+        byte_range = _parse_range(request.META.get("HTTP_RANGE", ""), snapshot.size)
+        if_range = request.META.get("HTTP_IF_RANGE")
+        if byte_range is not None and if_range and snapshot.etag not in parse_etags(if_range):
+            # файл поменялся с момента первой части — отдаём целиком
+            byte_range = None
+
+        if byte_range == "unsatisfiable":
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{snapshot.size}"
+        elif byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(_iter_file(snapshot.path, start, length), status=206)
+            response["Content-Range"] = f"bytes {start}-{end}/{snapshot.size}"
+            response["Content-Length"] = str(length)
+        else:
+            response = FileResponse(open(snapshot.path, "rb"))
+
+        if response.status_code != 416:
+            response["Content-Type"] = "application/gzip"
+            response["Content-Disposition"] = 'attachment; filename="catalog.ndjson.gz"'
+
+    response["ETag"] = snapshot.etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+    cache_control = (getattr(settings, "CATALOG_CACHE_CONTROL", {}) or {}).get("snapshot")
+    if cache_control:
+        patch_cache_control(response, public=True, **cache_control)
+    return response
@@ -1,3 +1,1973 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from decimal import Decimal
+from io import BytesIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from apps.utils import get_rendition_widths, rendition_name
+
+from .cache import CATEGORIES, get_version, product_detail_cache, response_cache_stats
+from .changes import prune_changes
+from .counts import compute_category_counts, rebuild_category_counts
+from .downloads import BUDGET_EXCEEDED, ImageDownloader
+from .images import image_jobs
+from .search import ProductSearchIndex, product_search_index
+from .tree import get_category_index
+from .models import (
+    PRODUCT_ORDERING_INDEXES,
+    Category,
+    Characteristics,
+    CharacteristicsDict,
+    Product,
+    ProductChange,
+    ProductImage,
+    SimilarProduct,
+    StoredImage,
+    normalize_characteristic_value,
+)
+from .similar import rebuild_similar, refresh_similar, similar_refresh
+from . import snapshot as snapshot_module
+from .snapshot import build_snapshot
+from .renderers import StreamingJSONEncoder
+from .views import ProductViewSet, sync_product_images
+
+
+# ===== планы запросов списка товаров =====
+class ProductListQueryPlanTests(TestCase):
+    """
+    EXPLAIN QUERY PLAN для каждого сочетания фильтра ProductFilter, сортировки
+    из ordering_fields и режима пагинации (номера страниц; курсор — первая и следующая страница).
+
+    У каждого поля сортировки есть частичный индекс витрины и индекс (category, поле)
+    (PRODUCT_ORDERING_INDEXES). Падает, если:
+        - таблица товаров читается целиком (SCAN catalog_product без индекса);
+        - строки страницы читаются обходом индекса, который не упорядочен по полю
+          сортировки, — это проход по всем живым товарам. SCAN по индексу самого
+          поля сортировки допустим: строки идут уже по порядку, LIMIT обрывает чтение;
+        - при фильтре по категории, диапазону цены или attr[] хоть один запрос
+          обходит индекс (SCAN), а не ищет по нему (SEARCH);
+        - ORDER BY сортируется во временном B-дереве, хотя строки можно читать
+          по индексу. Сортировка допустима только над строками, уже найденными
+          поиском по другой колонке: несколько категорий, id из attr[] или диапазон
+          цены при сортировке по другому полю (SORTED_AFTER_SEARCH).
+    COUNT(*) режима страниц без сужающих фильтров считает все живые товары
+    по определению — для него проверяется только отсутствие обхода таблицы.
+    """
+
+    FILTERS = (
+        {},
+        {"category": "{category}"},
+        {"category": "{parent}", "include_descendants": "true"},
+        {"category_in": "{category},{other}"},
+        {"min_price": "10"},
+        {"min_price": "10", "max_price": "100"},
+        {"max_wholesale_price": "50"},
+        {"min_effective_price": "10", "max_effective_price": "40"},
+        {"category": "{category}", "max_effective_price": "40"},
+        {"promotion": "true"},
+        {"promotion": "false"},
+        {"in_stock": "true"},
+        {"category": "{category}", "min_price": "10"},
+        {"category": "{category}", "promotion": "true"},
+        {"attr[{key}]": "A4"},
+    )
+    PAGINATION = (
+        {},
+        {"pagination": "cursor"},
+    )
+    # фильтр диапазона -> колонка, по индексу которой он ищет
+    RANGE_FILTERS = {
+        "min_price": "price",
+        "max_price": "price",
+        "max_wholesale_price": "wholesale_price",
+        "min_effective_price": "effective_price",
+        "max_effective_price": "effective_price",
+    }
+    # несколько отрезков индекса (IN по категориям, id из attr[]) — порядок между ними не сохраняется
+    SORTED_AFTER_SEARCH = ("category_in", "include_descendants", "attr[{key}]")
+    NARROWING_FILTERS = ("category", *SORTED_AFTER_SEARCH, *RANGE_FILTERS)
+
+    scan_re = re.compile(r"^SCAN catalog_product(?: USING (?:COVERING )?INDEX (\w+))?")
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.parent = Category.objects.create(name="Бумага", slug="paper")
+        cls.category = Category.objects.create(name="Офисная", slug="office", parent=cls.parent)
+        cls.other = Category.objects.create(name="Картон", slug="cardboard")
+        cls.key = CharacteristicsDict.objects.create(title="Формат")
+
+        for i in range(6):
+            product = Product.objects.create(
+                code=f"P-{i}",
+                name=f"Товар {i}",
+                slug=f"product-{i}",
+                category=cls.category if i % 2 else cls.other,
+                price=Decimal(10 * i + 5),
+                wholesale_price=Decimal(8 * i + 4),
+                discount=i,
+                promotion=bool(i % 3),
+            )
+            Characteristics.objects.create(product=product, key=cls.key, value="A4")
+
+    def setUp(self):
+        cache.clear()
+
+    def get_ordering_params(self):
+        yield None
+        for field in ProductViewSet.ordering_fields:
+            yield field
+            yield f"-{field}"
+
+    def build_params(self, filters, ordering, pagination):
+        values = {"category": self.category.pk, "parent": self.parent.pk, "other": self.other.pk, "key": self.key.pk}
+        params = {key.format(**values): value.format(**values) for key, value in filters.items()}
+        params.update(pagination, page_size="1")
+        if ordering:
+            params["ordering"] = ordering
+        return params
+
+    def capture_product_queries(self, url, params):
+        """
+        GET url -> [(sql, params)] запросов к catalog_product.
+        CaptureQueriesContext тут не годится: тестовый клиент сбрасывает журнал запросов на каждый запрос.
+        """
+        queries = []
+
+        def wrapper(execute, sql, sql_params, many, context):
+            if "catalog_product" in sql:
+                queries.append((sql, sql_params))
+            return execute(sql, sql_params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response, queries
+
+    def explain(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assert_plan_ok(self, sql, plan, filters, ordering):
+        field = (ordering or "-created_at").lstrip("-")
+        suffix = dict(PRODUCT_ORDERING_INDEXES)[field]
+        narrowed = any(key in filters for key in self.NARROWING_FILTERS)
+        is_count = "COUNT(" in sql
+
+        for line in plan:
+            match = self.scan_re.match(line)
+            if not match:
+                continue
+            self.assertTrue(match.group(1), f"полный обход таблицы товаров:\n{sql}\n{plan}")
+            self.assertFalse(narrowed, f"обход индекса вместо поиска по фильтру:\n{sql}\n{plan}")
+            if not is_count:
+                self.assertEqual(
+                    match.group(1),
+                    f"catalog_prod_live_{suffix}_idx",
+                    f"обход всех живых товаров по индексу не того поля:\n{sql}\n{plan}",
+                )
+
+        searched_elsewhere = any(key in filters for key in self.SORTED_AFTER_SEARCH) or any(
+            column != field for key, column in self.RANGE_FILTERS.items() if key in filters
+        )
+        if not searched_elsewhere:
+            sorted_in_memory = [line for line in plan if "TEMP B-TREE FOR" in line and "ORDER BY" in line]
+            self.assertFalse(sorted_in_memory, f"сортировка во временном B-дереве вместо индекса:\n{sql}\n{plan}")
+
+    def test_product_list_plans(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("формат EXPLAIN QUERY PLAN — SQLite")
+
+        url = reverse("product-list")
+        combinations = itertools.product(self.FILTERS, self.get_ordering_params(), self.PAGINATION)
+        for filters, ordering, pagination in combinations:
+            params = self.build_params(filters, ordering, pagination)
+            with self.subTest(**params):
+                cache.clear()
+                response, queries = self.capture_product_queries(url, params)
+                # курсор: следующая страница добавляет условие (значение, id) > (...)
+                next_url = response.json().get("next") if pagination.get("pagination") == "cursor" else None
+                if next_url:
+                    cache.clear()
+                    queries += self.capture_product_queries(next_url, {})[1]
+
+                self.assertTrue(queries)
+                for sql, sql_params in queries:
+                    self.assert_plan_ok(sql, self.explain(sql, sql_params), filters, ordering)
+
+    def test_every_ordering_is_indexed(self):
+        indexed = {field for field, _ in PRODUCT_ORDERING_INDEXES}
+        self.assertEqual(set(ProductViewSet.ordering_fields), indexed)
+        self.assertEqual(set(self.RANGE_FILTERS.values()) - indexed, set())
+
+    def test_live_indexes_are_used(self):
+        """
+        Витрина без фильтров читает товары по частичному индексу сортировки, а не по таблице,
+        с категорией — по индексу (category, поле).
+        """
+        if connection.vendor != "sqlite":
+            self.skipTest("формат EXPLAIN QUERY PLAN — SQLite")
+
+        for (field, suffix), descending in itertools.product(PRODUCT_ORDERING_INDEXES, (False, True)):
+            ordering = f"-{field}" if descending else field
+            for params, index in (
+                ({}, f"catalog_prod_live_{suffix}_idx"),
+                ({"category": self.category.pk}, f"catalog_prod_cat_{suffix}_idx"),
+            ):
+                with self.subTest(ordering=ordering, **params):
+                    cache.clear()
+                    _, queries = self.capture_product_queries(
+                        reverse("product-list"), {**params, "ordering": ordering}
+                    )
+                    sql, sql_params = next(q for q in queries if "ORDER BY" in q[0])
+                    plan = self.explain(sql, sql_params)
+                    self.assertTrue(any(index in line for line in plan), plan)
+                    self.assertFalse(any("TEMP B-TREE" in line for line in plan), plan)
+
+    def test_price_range_searches_its_index(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("формат EXPLAIN QUERY PLAN — SQLite")
+
+        cache.clear()
+        _, queries = self.capture_product_queries(reverse("product-list"), {"min_price": "10", "max_price": "20"})
+        for sql, sql_params in queries:
+            if '"price" >=' not in sql:
+                continue  # MAX(updated_at) для ETag
+            plan = self.explain(sql, sql_params)
+            self.assertTrue(
+                any(line.startswith("SEARCH catalog_product USING") and "price>" in line for line in plan), plan
+            )
+
+
+# ===== цена со скидкой =====
+class ProductEffectivePriceTests(TestCase):
+    def create_product(self, **kwargs):
+        return Product.objects.create(code="EP-1", name="Товар", slug="ep-1", **kwargs)
+
+    def test_computed_on_save(self):
+        product = self.create_product(price=Decimal("199.99"), discount=15)
+        self.assertEqual(product.effective_price, Decimal("169.99"))
+
+        product.discount = 0
+        product.save(update_fields=["discount"])
+        product.refresh_from_db()
+        self.assertEqual(product.effective_price, Decimal("199.99"))
+
+    def test_without_price(self):
+        self.assertIsNone(self.create_product(price=None, discount=10).effective_price)
+
+    def test_ordering_and_filter(self):
+        cheap = Product.objects.create(code="EP-1", name="A", slug="ep-1", price=Decimal("100"), discount=50)
+        dear = Product.objects.create(code="EP-2", name="B", slug="ep-2", price=Decimal("80"), discount=0)
+
+        response = self.client.get(reverse("product-list"), {"ordering": "effective_price"})
+        self.assertEqual([row["id"] for row in response.json()["results"]], [cheap.pk, dear.pk])
+        self.assertEqual(response.json()["results"][0]["effective_price"], "50.00")
+
+        cache.clear()
+        response = self.client.get(reverse("product-list"), {"min_effective_price": "60"})
+        self.assertEqual([row["id"] for row in response.json()["results"]], [dear.pk])
+
+
+# ===== фильтр по категории =====
+class CategoryFilterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.paper = Category.objects.create(name="Бумага", slug="paper")
+        cls.office = Category.objects.create(name="Офисная", slug="office", parent=cls.paper)
+        cls.a4 = Category.objects.create(name="А4", slug="a4", parent=cls.office)
+        cls.pens = Category.objects.create(name="Ручки", slug="pens")
+        cls.folders = Category.objects.create(name="Папки", slug="folders")
+        for category in (cls.paper, cls.office, cls.a4, cls.pens, cls.folders):
+            Product.objects.create(code=category.slug, name=category.name, slug=category.slug, category=category)
+
+    def setUp(self):
+        cache.clear()
+
+    def slugs(self, params):
+        response = self.client.get(reverse("product-list"), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return sorted(row["slug"] for row in response.json()["results"])
+
+    def test_only_category_itself_by_default(self):
+        self.assertEqual(self.slugs({"category": self.paper.pk}), ["paper"])
+        self.assertEqual(self.slugs({"category": self.paper.pk, "include_descendants": "false"}), ["paper"])
+
+    def test_include_descendants(self):
+        self.assertEqual(
+            self.slugs({"category": self.paper.pk, "include_descendants": "true"}),
+            ["a4", "office", "paper"],
+        )
+        self.assertEqual(self.slugs({"category": self.office.pk, "include_descendants": "true"}), ["a4", "office"])
+        self.assertEqual(
+            self.slugs({"category_in": f"{self.office.pk},{self.pens.pk}", "include_descendants": "true"}),
+            ["a4", "office", "pens"],
+        )
+
+    def test_new_subcategory_is_included(self):
+        drafts = Category.objects.create(name="Черновая", slug="drafts", parent=self.paper)
+        Product.objects.create(code="drafts", name="Черновая", slug="drafts", category=drafts)
+        self.assertIn("drafts", self.slugs({"category": self.paper.pk, "include_descendants": "true"}))
+
+
+# ===== фильтр по характеристикам =====
+class ProductAttributeFilterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.format = CharacteristicsDict.objects.create(title="Формат")
+        cls.density = CharacteristicsDict.objects.create(title="Плотность")
+        cls.a4 = cls.create_product("a4", {cls.format: "A4", cls.density: "80"})
+        cls.a4_cyrillic = cls.create_product("a4-cyr", {cls.format: " А4 ", cls.density: "160"})  # кириллица
+        cls.a3 = cls.create_product("a3", {cls.format: "a3", cls.density: "80"})
+        cls.a5 = cls.create_product("a5", {cls.format: "A5"})
+
+    @classmethod
+    def create_product(cls, slug, values):
+        product = Product.objects.create(code=slug, name=slug, slug=slug)
+        for key, value in values.items():
+            Characteristics.objects.create(product=product, key=key, value=value)
+        return product
+
+    def setUp(self):
+        cache.clear()
+
+    def ids(self, query):
+        response = self.client.get(f"{reverse('product-list')}?{query}")
+        self.assertEqual(response.status_code, 200, response.content)
+        return sorted(row["id"] for row in response.json()["results"])
+
+    def test_values_of_one_key_are_or(self):
+        fmt = self.format.pk
+        self.assertEqual(self.ids(f"attr[{fmt}]=A4"), sorted([self.a4.pk, self.a4_cyrillic.pk]))
+        self.assertEqual(
+            self.ids(f"attr[{fmt}]=A4&attr[{fmt}]=A3"),
+            sorted([self.a4.pk, self.a4_cyrillic.pk, self.a3.pk]),
+        )
+
+    def test_keys_are_and(self):
+        fmt, density = self.format.pk, self.density.pk
+        self.assertEqual(
+            self.ids(f"attr[{fmt}]=A4&attr[{fmt}]=A3&attr[{density}]=80"),
+            sorted([self.a4.pk, self.a3.pk]),
+        )
+        self.assertEqual(self.ids(f"attr[{fmt}]=A5&attr[{density}]=80"), [])
+
+    def test_value_normalization(self):
+        fmt = self.format.pk
+        expected = sorted([self.a4.pk, self.a4_cyrillic.pk])
+        # латиница, кириллица, регистр и пробелы дают одно значение
+        for value in ("a4", "А4", "а4", "%20A4%20"):
+            with self.subTest(value=value):
+                self.assertEqual(self.ids(f"attr[{fmt}]={value}"), expected)
+        self.assertEqual(normalize_characteristic_value("  Ёлочка  Мелкая "), normalize_characteristic_value("елочка мелкая"))
+
+    def test_unknown_key_and_empty_values(self):
+        self.assertEqual(self.ids("attr[999999]=A4"), [])
+        self.assertEqual(len(self.ids(f"attr[{self.format.pk}]=")), 4)  # пустое значение не фильтрует
+        self.assertEqual(len(self.ids("attr[abc]=A4")), 4)
+
+
+# ===== кэш ответов =====
+def post_crm_webhook(client, payload):
+    body = json.dumps(payload).encode("utf-8")
+    signature = "sha256=" + hmac.new(b"test-secret", body, hashlib.sha256).hexdigest()
+    return client.post(
+        reverse("crm_products_webhook"), body, content_type="application/json", HTTP_X_CRM_SIGNATURE=signature
+    )
+
+
+@override_settings(SITE_WEBHOOK_SECRET="test-secret", CRM_WEBHOOK_SYNC_IMAGES=False, CATALOG_SIMILAR_ASYNC=False)
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.external_id = str(uuid.uuid4())
+
+    def webhook(self, payload):
+        with self.captureOnCommitCallbacks(execute=True), self.assertLogs("apps.catalog.views", "INFO"):
+            response = post_crm_webhook(self.client, payload)
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def list_names(self):
+        return [row["name"] for row in self.client.get(reverse("product-list")).json()["results"]]
+
+    def test_webhook_upsert_and_delete_invalidate_list(self):
+        Product.objects.create(code="RC-1", name="Старый", slug="rc-1")
+        self.assertEqual(self.list_names(), ["Старый"])
+        self.assertEqual(self.list_names(), ["Старый"])  # из кеша
+
+        item = {"id": self.external_id, "name": "Новый", "slug": "rc-new", "price": "10"}
+        self.webhook({"results": [item]})
+        self.assertEqual(self.list_names(), ["Новый", "Старый"])
+
+        self.webhook({"results": [{**item, "name": "Переименован"}]})
+        self.assertEqual(self.list_names(), ["Переименован", "Старый"])
+
+        # удаление ещё и уведомляет CRM — здесь адрес не настроен, предупреждение ожидаемо
+        with self.assertLogs("apps.catalog", "WARNING"):
+            self.webhook({"event": "product.deleted", "data": {"id": self.external_id}})
+        self.assertEqual(self.list_names(), ["Старый"])
+
+    def test_stats_counters_move(self):
+        Product.objects.create(code="RC-1", name="Товар", slug="rc-1")
+        admin = get_user_model().objects.create_user("staff", password="x", is_staff=True)
+        before = response_cache_stats.snapshot()
+        self.client.get(reverse("product-list"))
+        self.client.get(reverse("product-list"))
+        self.client.force_login(admin)
+        stats = self.client.get(reverse("catalog_stats")).json()["response_cache"]
+        self.assertEqual(stats["misses"], before["misses"] + 1)
+        self.assertEqual(stats["hits"], before["hits"] + 1)
+        self.assertGreater(stats["bytes"], 0)
+
+
+@override_settings(
+    SITE_WEBHOOK_SECRET="test-secret",
+    CRM_WEBHOOK_SYNC_IMAGES=False,
+    CATALOG_IMAGE_WORKERS=0,
+    CATALOG_SIMILAR_ASYNC=False,
+)
+class ProductDetailCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.product = Product.objects.create(code="DC-1", name="Товар", slug="dc-1")
+
+    def detail(self, slug="dc-1"):
+        return self.client.get(reverse("product-detail", args=[slug]))
+
+    def test_image_and_characteristic_saves_invalidate(self):
+        before = product_detail_cache.stats.snapshot()
+        self.assertEqual(self.detail().json()["images"], [])
+        self.assertEqual(self.detail().json()["images"], [])
+        after = product_detail_cache.stats.snapshot()
+        self.assertEqual(after["misses"], before["misses"] + 1)
+        self.assertEqual(after["hits"], before["hits"] + 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductImage.objects.create(product=self.product, image=ImageProcessingTests.png((300, 200)))
+        self.assertEqual(len(self.detail().json()["images"]), 1)
+
+        key = CharacteristicsDict.objects.create(title="Формат")
+        with self.captureOnCommitCallbacks(execute=True):
+            Characteristics.objects.create(product=self.product, key=key, value="A4")
+        self.assertIn("A4", json.dumps(self.detail().json(), ensure_ascii=False))
+
+    def test_crm_slug_change_evicts_old_key(self):
+        external_id = str(uuid.uuid4())
+        item = {"id": external_id, "name": "Ручка", "slug": "pen-old", "price": "10"}
+        with self.captureOnCommitCallbacks(execute=True), self.assertLogs("apps.catalog.views", "INFO"):
+            post_crm_webhook(self.client, {"results": [item]})
+        self.assertEqual(self.detail("pen-old").status_code, 200)
+        self.assertIsNotNone(cache.get(product_detail_cache.key("pen-old")))
+
+        with self.captureOnCommitCallbacks(execute=True), self.assertLogs("apps.catalog.views", "INFO"):
+            post_crm_webhook(self.client, {"results": [{**item, "slug": "pen-new"}]})
+        self.assertIsNone(cache.get(product_detail_cache.key("pen-old")))
+        self.assertEqual(self.detail("pen-old").status_code, 404)
+        self.assertEqual(self.detail("pen-new").json()["name"], "Ручка")
+
+
+# ===== условные запросы =====
+class ConditionalResponseTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Бумага", slug="paper")
+        cls.product = Product.objects.create(code="CR-1", name="Товар", slug="cr-1", category=cls.category)
+
+    def setUp(self):
+        cache.clear()
+
+    def urls(self):
+        return (
+            reverse("product-list"),
+            reverse("product-detail", args=[self.product.slug]),
+            reverse("category-tree"),
+        )
+
+    def get_with_queries(self, url, **headers):
+        queries = []
+
+        def wrapper(execute, sql, sql_params, many, context):
+            queries.append(sql)
+            return execute(sql, sql_params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            response = self.client.get(url, **headers)
+        return response, queries
+
+    def test_304_without_catalog_queries(self):
+        for url in self.urls():
+            first = self.client.get(url)
+            self.assertEqual(first.status_code, 200)
+            validators = (
+                {"HTTP_IF_NONE_MATCH": first["ETag"]},
+                {"HTTP_IF_MODIFIED_SINCE": first["Last-Modified"]},
+            )
+            for headers in validators:
+                with self.subTest(url=url, headers=list(headers)):
+                    response, queries = self.get_with_queries(url, **headers)
+                    self.assertEqual(response.status_code, 304)
+                    self.assertEqual(response.content, b"")
+                    self.assertEqual(response["ETag"], first["ETag"])
+                    # только версия каталога — ни товаров, ни категорий
+                    touched = [sql for sql in queries if "catalog_product" in sql or "catalog_category" in sql]
+                    self.assertEqual(touched, [])
+                    self.assertLessEqual(len(queries), 1, queries)
+
+    def test_etag_changes_after_write(self):
+        etags = {url: self.client.get(url)["ETag"] for url in self.urls()}
+        self.product.name = "Переименован"
+        self.product.save()
+        self.category.name = "Картон"
+        self.category.save()
+        for url, etag in etags.items():
+            with self.subTest(url=url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response["ETag"], etag)
+
+    @override_settings(CATALOG_CACHE_CONTROL={"product": {"max_age": 7}, "category:tree": {"max_age": 11}})
+    def test_cache_control_from_settings(self):
+        list_response = self.client.get(reverse("product-list"))
+        self.assertIn("max-age=7", list_response["Cache-Control"])
+        self.assertIn("public", list_response["Cache-Control"])
+        self.assertIn("max-age=11", self.client.get(reverse("category-tree"))["Cache-Control"])
+
+
+# ===== снимок каталога =====
+class CatalogSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        snapshot_dir = override_settings(CATALOG_SNAPSHOT_DIR=Path(directory))
+        snapshot_dir.enable()
+        self.addCleanup(snapshot_dir.disable)
+        # два блока: id < 1000 и 1000+
+        self.first = Product.objects.create(code="SN-1", name="Первый", slug="sn-1")
+        Product.objects.create(code="SN-2", name="Второй", slug="sn-2")
+        Product.objects.create(id=1500, code="SN-3", name="Третий", slug="sn-3")
+
+    def get(self, **headers):
+        response = self.client.get(reverse("catalog_snapshot"), **headers)
+        return response, b"".join(response.streaming_content) if response.streaming else response.content
+
+    def test_full_file(self):
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        lines = gzip.decompress(body).decode("utf-8").splitlines()
+        self.assertEqual([json.loads(line)["code"] for line in lines], ["SN-1", "SN-2", "SN-3"])
+
+        response, _ = self.get(HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_ranges(self):
+        full_response, full = self.get()
+        size = len(full)
+
+        response, body = self.get(HTTP_RANGE="bytes=0-9")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 0-9/{size}")
+        self.assertEqual(body, full[:10])
+
+        response, body = self.get(HTTP_RANGE="bytes=10-")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, full[10:])
+
+        response, body = self.get(HTTP_RANGE="bytes=-5")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes {size - 5}-{size - 1}/{size}")
+        self.assertEqual(body, full[-5:])
+
+        response, _ = self.get(HTTP_RANGE=f"bytes={size}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{size}")
+
+        response, body = self.get(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=full_response["ETag"])
+        self.assertEqual(response.status_code, 206)
+
+        # файл поменялся после первой части — If-Range со старым ETag получает весь новый файл
+        self.first.name = "Первый, переименован"
+        self.first.save()
+        response, body = self.get(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=full_response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], full_response["ETag"])
+        self.assertIn("переименован", gzip.decompress(body).decode("utf-8"))
+
+    def test_incremental_rebuild_reencodes_changed_block_only(self):
+        snapshot, rebuilt = build_snapshot()
+        self.assertEqual(rebuilt, 2)
+
+        self.first.name = "Изменён"
+        self.first.save()
+        with mock.patch("apps.catalog.snapshot._encode_block", wraps=snapshot_module._encode_block) as encode:
+            changed, rebuilt = build_snapshot()
+        self.assertEqual(rebuilt, 1)
+        self.assertEqual([call.args[0] for call in encode.call_args_list], [0])
+        self.assertNotEqual(changed.etag, snapshot.etag)
+        with open(changed.path, "rb") as f:
+            names = [json.loads(line)["name"] for line in gzip.decompress(f.read()).decode("utf-8").splitlines()]
+        self.assertEqual(names, ["Изменён", "Второй", "Третий"])
+
+        # версия не менялась — ничего не пережимается
+        self.assertEqual(build_snapshot()[1], 0)
+
+
+# ===== поиск =====
+@override_settings(CATALOG_SIMILAR_ASYNC=False)
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Канцелярия", slug="office")
+        self.gel = Product.objects.create(code="S-1", name="Ручка гелевая СИНЯЯ", slug="s-1", category=self.category)
+        self.pencil = Product.objects.create(code="S-2", name="Карандаш чёрный", slug="s-2", category=self.category)
+        # индекс общий на процесс: после отката прошлого теста его позиция в журнале впереди базы
+        product_search_index.versions = None
+
+    def search(self, query):
+        response = self.client.get(reverse("product-list"), {"search": query})
+        return [row["id"] for row in response.json()["results"]]
+
+    def test_cyrillic_case_insensitive_and_typos(self):
+        self.assertEqual(self.search("синяя"), [self.gel.pk])
+        self.assertEqual(self.search("ГЕЛЕВАЯ ручка"), [self.gel.pk])
+        self.assertEqual(self.search("черный"), [self.pencil.pk])  # ё -> е
+        self.assertEqual(self.search("карандшь"), [self.pencil.pk])
+        self.assertEqual(self.search("гел"), [self.gel.pk])
+
+    def test_cursor_mode_keeps_relevance(self):
+        # "синяя" в названии — выше, чем только в категории
+        category = Category.objects.create(name="Синяя серия", slug="blue")
+        by_category = Product.objects.create(code="S-6", name="Тетрадь", slug="s-6", category=category)
+        url = reverse("product-list")
+        paged = self.client.get(url, {"search": "синяя"}).json()
+        self.assertEqual([row["id"] for row in paged["results"]], [self.gel.pk, by_category.pk])
+
+        # релевантность — не колонка: курсор не строится, те же номера страниц в том же порядке
+        cursor = self.client.get(url, {"search": "синяя", "pagination": "cursor", "page_size": "1"}).json()
+        self.assertEqual(cursor["count"], 2)
+        self.assertEqual([row["id"] for row in cursor["results"]], [self.gel.pk])
+        second = self.client.get(cursor["next"]).json()
+        self.assertEqual([row["id"] for row in second["results"]], [by_category.pk])
+
+        # с явной сортировкой — обычный keyset по колонке
+        ordered = self.client.get(
+            url, {"search": "синяя", "pagination": "cursor", "ordering": "-created_at", "page_size": "1"}
+        ).json()
+        self.assertNotIn("count", ordered)
+        self.assertEqual([row["id"] for row in ordered["results"]], [by_category.pk])
+
+    def test_truncated_search_is_flagged(self):
+        Product.objects.create(code="S-7", name="Ручка шариковая", slug="s-7", category=self.category)
+        Product.objects.create(code="S-8", name="Ручка капиллярная", slug="s-8", category=self.category)
+        url = reverse("product-list")
+        for params in ({}, {"pagination": "cursor"}):
+            with self.subTest(**params):
+                cache.clear()
+                data = self.client.get(url, {"search": "ручка", **params}).json()
+                self.assertEqual(len(data["results"]), 3)
+                self.assertNotIn("search_truncated", data)
+
+                cache.clear()
+                with override_settings(CATALOG_SEARCH_MAX_RESULTS=2):
+                    data = self.client.get(url, {"search": "ручка", **params}).json()
+                    facets = self.client.get(reverse("product-facets"), {"search": "ручка"}).json()
+                self.assertEqual(len(data["results"]), 2)
+                self.assertIs(data["search_truncated"], True)
+                self.assertEqual(facets["count"], 2)
+                self.assertIs(facets["search_truncated"], True)
+
+    def suggest(self, query, **params):
+        response = self.client.get(reverse("catalog_suggest"), {"q": query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_suggest(self):
+        short = Product.objects.create(code="S-4", name="Ручка", slug="s-4", category=self.category)
+        cheap = Product.objects.create(code="S-5", name="Стержень для ручки", slug="s-5", category=self.category)
+
+        data = self.suggest("РУЧ")
+        # с начала названия — первыми, среди них короче — выше; совпадение в середине — после
+        self.assertEqual([p["id"] for p in data["products"]], [short.pk, self.gel.pk, cheap.pk])
+        self.assertEqual(data["products"][0], {"id": short.pk, "slug": "s-4", "name": "Ручка"})
+        self.assertEqual(data["categories"], [])
+
+        self.assertEqual([p["id"] for p in self.suggest("син")["products"]], [self.gel.pk])  # середина названия
+        self.assertEqual([p["id"] for p in self.suggest("чер")["products"]], [self.pencil.pk])  # ё -> е
+        self.assertEqual(self.suggest("канц")["categories"], [{"id": self.category.pk, "slug": "office", "name": "Канцелярия"}])
+        self.assertEqual(len(self.suggest("руч", limit=1)["products"]), 1)
+        self.assertEqual(self.suggest("  "), {"products": [], "categories": []})
+        self.assertEqual(self.suggest("ластик"), {"products": [], "categories": []})
+
+    def test_index_follows_save_and_delete(self):
+        self.search("ручка")  # строим индекс
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pencil.name = "Маркер перманентный"
+            self.pencil.save()
+        cache.clear()
+        self.assertEqual(self.search("маркер"), [self.pencil.pk])
+        self.assertEqual(self.search("карандаш"), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.gel.delete()
+        cache.clear()
+        self.assertEqual(self.search("ручка"), [])
+
+    def test_catch_up_reads_change_log(self):
+        # индекс другого процесса: сигналы этого процесса его не трогают
+        index = ProductSearchIndex()
+        index.ensure_fresh()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.gel.name = "Ручка шариковая"
+            self.gel.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pencil.delete()
+        hidden = Product.objects.create(code="S-3", name="Ластик", slug="s-3", is_available=False)
+
+        with mock.patch.object(index, "_rebuild") as rebuild, self.assertNumQueries(5):
+            # версии, журнал (граница + строки), товары, характеристики
+            index.ensure_fresh()
+        rebuild.assert_not_called()
+        self.assertEqual(index.search("шариковая"), [self.gel.pk])
+        self.assertEqual(index.search("гелевая"), [])
+        self.assertEqual(index.search("карандаш"), [])
+        self.assertEqual(index.search("ластик"), [])
+        self.assertNotIn(hidden.pk, index.documents)
+
+    def test_catch_up_after_pruned_log_rebuilds(self):
+        index = ProductSearchIndex()
+        index.ensure_fresh()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.gel.save()
+        ProductChange.objects.filter(id__lte=index.change_id + 1).delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pencil.save()
+        with mock.patch.object(index, "_rebuild", wraps=index._rebuild) as rebuild:
+            index.ensure_fresh()
+        rebuild.assert_called_once()
+        self.assertEqual(index.search("карандаш"), [self.pencil.pk])
+
+
+# ===== корзина и избранное =====
+class ProductBulkLookupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.paper = Category.objects.create(name="Бумага", slug="paper")
+        cls.products = [
+            Product.objects.create(code=f"BL-{i}", name=f"Товар {i}", slug=f"bl-{i}", category=cls.paper, price=i)
+            for i in range(1, 31)
+        ]
+        cls.sold_out = Product.objects.create(code="BL-OUT", name="Закончился", slug="bl-out", is_available=False)
+        cls.hidden = Product.objects.create(code="BL-OFF", name="Снят", slug="bl-off", is_active=False)
+
+    def post(self, payload):
+        return self.client.post(reverse("product-bulk"), payload, content_type="application/json")
+
+    def post_with_queries(self, payload):
+        queries = []
+
+        def wrapper(execute, sql, sql_params, many, context):
+            queries.append(sql)
+            return execute(sql, sql_params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            response = self.post(payload)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json(), queries
+
+    def test_order_and_deduplication(self):
+        first, second, third = self.products[:3]
+        data = self.post(
+            {
+                "ids": [third.pk, first.pk, third.pk],
+                # second по slug, first ещё раз по slug — в ответе один раз, на месте id
+                "slugs": [second.slug, first.slug, second.slug],
+            }
+        ).json()
+        self.assertEqual([card["id"] for card in data["results"]], [third.pk, first.pk, second.pk])
+        self.assertEqual(data["missing"], {"ids": [], "slugs": []})
+        self.assertEqual(data["unavailable"], [])
+
+    def test_missing_and_unavailable(self):
+        product = self.products[0]
+        data = self.post(
+            {
+                "ids": [product.pk, self.sold_out.pk, self.hidden.pk, 10**9],
+                "slugs": ["no-such-product", self.hidden.slug],
+            }
+        ).json()
+        self.assertEqual([card["id"] for card in data["results"]], [product.pk, self.sold_out.pk])
+        self.assertEqual(data["missing"], {"ids": [self.hidden.pk, 10**9], "slugs": ["no-such-product", self.hidden.slug]})
+        self.assertEqual(data["unavailable"], [self.sold_out.pk])
+
+    def test_validation(self):
+        self.assertEqual(self.post({}).status_code, 400)
+        self.assertEqual(self.post({"ids": [2**63]}).status_code, 400)
+        with override_settings(CATALOG_BULK_LOOKUP_MAX_ITEMS=3):
+            self.assertEqual(self.post({"ids": [1, 2], "slugs": ["a", "b"]}).status_code, 400)
+            # повторы в лимит не считаются
+            self.assertEqual(self.post({"ids": [1, 1, 1, 2], "slugs": ["a", "a"]}).status_code, 200)
+
+    def test_query_count_does_not_grow_with_items(self):
+        one, one_queries = self.post_with_queries({"ids": [self.products[0].pk]})
+        many, many_queries = self.post_with_queries(
+            {"ids": [p.pk for p in self.products[:20]], "slugs": [p.slug for p in self.products[20:]]}
+        )
+        self.assertEqual(len(one["results"]), 1)
+        self.assertEqual(len(many["results"]), 30)
+        self.assertEqual(len(many_queries), len(one_queries))
+
+
+# ===== похожие товары =====
+@override_settings(CATALOG_SIMILAR_ASYNC=False)
+class SimilarProductTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.paper = Category.objects.create(name="Бумага", slug="paper")
+        cls.office = Category.objects.create(name="Офисная", slug="office", parent=cls.paper)
+        cls.pens = Category.objects.create(name="Ручки", slug="pens")
+        cls.format = CharacteristicsDict.objects.create(title="Формат")
+
+    def create_product(self, slug, category, price, format_value=None):
+        product = Product.objects.create(code=slug, name=slug, slug=slug, category=category, price=Decimal(price))
+        if format_value:
+            Characteristics.objects.create(product=product, key=self.format, value=format_value)
+        return product
+
+    def similar_ids(self, product):
+        return list(SimilarProduct.objects.filter(product=product).values_list("similar_id", flat=True))
+
+    def test_ranking(self):
+        a4 = self.create_product("a4", self.office, 100, "A4")
+        same_format = self.create_product("a4-other", self.office, 300, "А4")  # кириллица -> та же нормализация
+        close_price = self.create_product("a3", self.office, 105, "A3")
+        parent_branch = self.create_product("paper-roll", self.paper, 100)
+        other_branch = self.create_product("pen", self.pens, 100)
+
+        rebuild_similar([a4.pk])
+        self.assertEqual(self.similar_ids(a4), [same_format.pk, close_price.pk, parent_branch.pk])
+        self.assertNotIn(other_branch.pk, self.similar_ids(a4))
+
+    def test_refreshed_on_commit(self):
+        first = self.create_product("first", self.office, 100)
+        second = self.create_product("second", self.office, 110)
+        rebuild_similar([first.pk, second.pk])
+        self.assertEqual(self.similar_ids(first), [second.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            third = self.create_product("third", self.office, 101)
+        # новый товар попал и в свой список, и в списки соседей
+        self.assertEqual(self.similar_ids(third), [first.pk, second.pk])
+        self.assertEqual(self.similar_ids(first), [third.pk, second.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            third.is_available = False
+            third.save()
+        self.assertEqual(self.similar_ids(first), [second.pk])
+        self.assertEqual(self.similar_ids(third), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.similar_ids(first), [])
+
+    def test_refresh_only_on_relevant_changes(self):
+        product = self.create_product("first", self.office, 100)
+        self.create_product("second", self.office, 110)
+
+        product = Product.objects.get(pk=product.pk)
+        with mock.patch("apps.catalog.similar.refresh_similar") as refresh, \
+                self.captureOnCommitCallbacks(execute=True):
+            product.quantity = 5
+            product.description = "новое описание"
+            product.save()
+        refresh.assert_not_called()
+
+        with mock.patch("apps.catalog.similar.refresh_similar") as refresh, \
+                self.captureOnCommitCallbacks(execute=True):
+            product.discount = 10
+            product.save()
+        refresh.assert_called_once()
+        self.assertIn(product.pk, refresh.call_args.args[0])
+
+    def test_one_refresh_per_transaction(self):
+        product = self.create_product("first", self.office, 100)
+        with mock.patch("apps.catalog.similar.refresh_similar") as refresh, \
+                self.captureOnCommitCallbacks(execute=True):
+            product.price = Decimal(120)
+            product.save()
+            for n in range(5):
+                key = CharacteristicsDict.objects.create(title=f"Свойство {n}")
+                Characteristics.objects.create(product=product, key=key, value=str(n))
+        refresh.assert_called_once()
+        self.assertIn(product.pk, refresh.call_args.args[0])
+
+    def test_refresh_keeps_catalog_version(self):
+        base = self.create_product("base", self.office, 100)
+        near = self.create_product("near", self.office, 110)
+        rebuild_similar([base.pk])
+        closer = self.create_product("closer", self.office, 101)
+
+        cache.clear()
+        catalog_version = get_version()
+        list_etag = self.client.get(reverse("product-list"))["ETag"]
+        before = self.client.get(reverse("product-similar", kwargs={"slug": "base"}))
+        self.assertEqual([card["id"] for card in before.json()["results"]], [near.pk])
+
+        self.assertGreater(refresh_similar([closer.pk]), 0)
+        # списки — своя версия: кэш и ETag списка товаров не сбрасываются
+        self.assertEqual(get_version(), catalog_version)
+        self.assertEqual(self.client.get(reverse("product-list"))["ETag"], list_etag)
+        after = self.client.get(reverse("product-similar", kwargs={"slug": "base"}))
+        self.assertNotEqual(after["ETag"], before["ETag"])
+        self.assertEqual([card["id"] for card in after.json()["results"]], [closer.pk, near.pk])
+
+    def test_endpoint(self):
+        product = self.create_product("base", self.office, 100)
+        near = self.create_product("near", self.office, 101)
+        far = self.create_product("far", self.office, 500)
+        rebuild_similar([product.pk])
+
+        response = self.client.get(reverse("product-similar", kwargs={"slug": "base"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([card["id"] for card in response.json()["results"]], [near.pk, far.pk])
+
+        response = self.client.get(reverse("product-similar", kwargs={"slug": "missing"}))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CATALOG_SIMILAR_ASYNC=True)
+class BackgroundSimilarRefreshTests(TransactionTestCase):
+    """
+    Пересчёт в фоновом потоке — своим соединением, нужен настоящий commit.
+    """
+
+    def test_refreshed_in_background(self):
+        office = Category.objects.create(name="Офисная", slug="office")
+        first = Product.objects.create(code="first", name="first", slug="first", category=office, price=100)
+        self.assertTrue(similar_refresh.wait(timeout=60))
+
+        with mock.patch("apps.catalog.similar.rebuild_similar", wraps=rebuild_similar) as rebuild:
+            with transaction.atomic():
+                second = Product.objects.create(code="second", name="second", slug="second", category=office, price=110)
+                key = CharacteristicsDict.objects.create(title="Формат")
+                Characteristics.objects.create(product=second, key=key, value="A4")
+            self.assertTrue(similar_refresh.wait(timeout=60))
+        # один пересчёт на транзакцию: сам товар, затем его соседи
+        self.assertEqual(rebuild.call_count, 2)
+        self.assertEqual(rebuild.call_args_list[0].args[0], {second.pk})
+
+        links = dict(SimilarProduct.objects.values_list("product_id", "similar_id"))
+        self.assertEqual(links, {first.pk: second.pk, second.pk: first.pk})
+        self.assertEqual(similar_refresh.stats()["failed"], 0)
+
+
+# ===== фасеты =====
+class ProductFacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.paper = Category.objects.create(name="Бумага", slug="paper")
+        cls.pens = Category.objects.create(name="Ручки", slug="pens")
+        for n, (category, price, promotion, available) in enumerate(
+            [
+                (cls.paper, "50", True, True),
+                (cls.paper, "150", False, True),
+                (cls.paper, "700", False, False),
+                (cls.pens, "20", True, True),
+                (cls.pens, "6000", False, False),
+            ]
+        ):
+            Product.objects.create(
+                code=f"F-{n}",
+                name=f"Товар {n}",
+                slug=f"f-{n}",
+                category=category,
+                price=Decimal(price),
+                promotion=promotion,
+                is_available=available,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def list_count(self, params):
+        response = self.client.get(reverse("product-list"), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()["count"]
+
+    def test_counts(self):
+        facets = self.client.get(reverse("product-facets")).json()
+        self.assertEqual(facets["count"], 3)
+        self.assertEqual(
+            [(c["slug"], c["count"]) for c in facets["categories"]],
+            [("paper", 2), ("pens", 1)],
+        )
+        self.assertEqual([b["count"] for b in facets["price"]], [2, 1, 0, 0, 0])
+        self.assertEqual(facets["price"][-1], {"min": "5000", "max": None, "count": 0})
+        self.assertEqual(facets["promotion"], {"true": 2, "false": 1})
+
+    def test_counts_match_filtered_list(self):
+        for params in (
+            {},
+            {"category": self.paper.pk},
+            {"promotion": "true"},
+            {"min_price": "100"},
+            {"category_in": f"{self.paper.pk},{self.pens.pk}", "max_price": "100"},
+        ):
+            with self.subTest(params=params):
+                facets = self.client.get(reverse("product-facets"), params).json()
+                self.assertEqual(facets["count"], self.list_count(params))
+                for category in facets["categories"]:
+                    # category поверх category_in — как выбор значения фасета
+                    narrowed = {k: v for k, v in params.items() if k != "category_in"}
+                    self.assertEqual(category["count"], self.list_count({**narrowed, "category": category["id"]}))
+                # фасеты считаются внутри текущего фильтра, а не вместо него
+                if "promotion" not in params:
+                    self.assertEqual(facets["promotion"]["true"], self.list_count({**params, "promotion": "true"}))
+                    self.assertEqual(facets["promotion"]["false"], self.list_count({**params, "promotion": "false"}))
+                self.assertEqual(sum(b["count"] for b in facets["price"]), facets["count"])
+
+    def test_in_stock_counts_unavailable_products(self):
+        facets = self.client.get(reverse("product-facets")).json()
+        self.assertEqual(facets["in_stock"], {"true": 3, "false": 2})
+
+        facets = self.client.get(reverse("product-facets"), {"category": self.paper.pk}).json()
+        self.assertEqual(facets["in_stock"], {"true": 2, "false": 1})
+
+    def test_single_pass_over_products(self):
+        markers = Category.objects.create(name="Маркеры", slug="markers")
+        Product.objects.create(code="F-9", name="Маркер", slug="f-9", category=markers, is_available=False)
+        queries = []
+
+        def wrapper(execute, sql, sql_params, many, context):
+            queries.append(sql)
+            return execute(sql, sql_params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            facets = self.client.get(reverse("product-facets")).json()
+        # счётчики и наличие — из одного GROUP BY, без prefetch и отдельного запроса
+        # (MAX(updated_at) — валидатор Last-Modified, не фасеты)
+        reads = [sql for sql in queries if "catalog_product" in sql and "MAX(" not in sql]
+        self.assertEqual(len(reads), 1, queries)
+        self.assertIn("GROUP BY", reads[0])
+        self.assertEqual(facets["in_stock"], {"true": 3, "false": 3})
+        # категория только с закончившимися товарами в сайдбар не попадает
+        self.assertNotIn("markers", [c["slug"] for c in facets["categories"]])
+
+
+# ===== keyset-пагинация =====
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Бумага", slug="paper")
+        prices = (None, Decimal("10"), Decimal("10"), None, Decimal("5"), Decimal("20"), Decimal("10"))
+        for i in range(23):
+            price = prices[i % len(prices)]
+            Product.objects.create(
+                code=f"KS-{i}",
+                name=f"Товар {i % 4}",  # повторяющиеся названия
+                slug=f"ks-{i}",
+                category=category,
+                price=price,
+                wholesale_price=None if i % 3 == 0 else Decimal(i % 5),
+                discount=i % 2 * 10,
+            )
+        # одинаковое время создания у половины товаров
+        Product.objects.filter(id__in=Product.objects.order_by("id").values("id")[:12]).update(
+            created_at=timezone.now() - timedelta(days=1)
+        )
+        Product.objects.create(code="KS-hidden", name="Скрыт", slug="ks-hidden", is_available=False)
+        cls.expected = set(Product.objects.filter(is_active=True, is_available=True).values_list("id", flat=True))
+
+    def setUp(self):
+        cache.clear()
+
+    def walk(self, ordering, **filters):
+        ids = []
+        response = self.client.get(
+            reverse("product-list"),
+            {"pagination": "cursor", "ordering": ordering, "page_size": "4", **filters},
+        )
+        for _ in range(len(self.expected)):
+            self.assertEqual(response.status_code, 200)
+            payload = response.json()
+            ids += [row["id"] for row in payload["results"]]
+            if payload["next"] is None:
+                return ids
+            response = self.client.get(payload["next"])
+        self.fail(f"{ordering}: лента не закончилась")
+
+    def test_every_ordering_both_directions(self):
+        for field in ProductViewSet.ordering_fields:
+            for ordering in (field, f"-{field}"):
+                with self.subTest(ordering=ordering):
+                    ids = self.walk(ordering)
+                    self.assertEqual(len(ids), len(set(ids)), "повторы")
+                    self.assertEqual(set(ids), self.expected, "пропуски")
+
+                    # порядок тот же, что у ORDER BY поля с id как tiebreaker-ом (NULL — одним блоком)
+                    values = dict(Product.objects.filter(id__in=ids).values_list("id", field))
+                    keys = [(values[pk] is None, values[pk], pk) for pk in ids]
+                    nulls = [is_null for is_null, _, _ in keys]
+                    self.assertEqual(nulls, sorted(nulls) if nulls[0] is False else sorted(nulls, reverse=True))
+                    present = [(value, pk) for is_null, value, pk in keys if not is_null]
+                    self.assertEqual(present, sorted(present, reverse=ordering.startswith("-")))
+
+    def test_range_filter_skips_null_segment(self):
+        expected = list(
+            Product.objects.filter(is_active=True, is_available=True, price__gte=10)
+            .order_by("-price", "-id")
+            .values_list("id", flat=True)
+        )
+        queries = []
+
+        def wrapper(execute, sql, sql_params, many, context):
+            queries.append(sql)
+            return execute(sql, sql_params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            self.assertEqual(self.walk("-price", min_price="10"), expected)
+        self.assertFalse([sql for sql in queries if '"price" IS NULL' in sql])
+
+    def test_cursor_from_other_ordering_is_rejected(self):
+        first = self.client.get(
+            reverse("product-list"),
+            {"pagination": "cursor", "ordering": "price", "page_size": "4"},
+        ).json()
+        cursor = first["next"].split("cursor=", 1)[1].split("&", 1)[0]
+        response = self.client.get(reverse("product-list"), {"cursor": cursor, "ordering": "-price"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_garbage_cursor_is_rejected(self):
+        for cursor in ("not-base64!", "e30", "eyJvIjoicHJpY2UiLCJ2IjoiYWJjIiwiaWQiOjF9"):
+            with self.subTest(cursor=cursor):
+                response = self.client.get(reverse("product-list"), {"cursor": cursor, "ordering": "price"})
+                self.assertEqual(response.status_code, 404)
+
+
+# ===== быстрая сериализация списка =====
+@override_settings(CATALOG_IMAGE_WORKERS=0)
+class ProductListSerializationTests(TestCase):
+    """
+    ProductListRowSerializer (CATALOG_FAST_LIST_SERIALIZATION) отдаёт те же байты,
+    что и ProductListSerializer.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.media_root = tempfile.mkdtemp()
+        category = Category.objects.create(name="Бумага «А4»", slug="paper")
+        rows = (
+            # (категория, цена, опт, старая цена, скидка)
+            (category, Decimal("199.99"), Decimal("150.5"), Decimal("249.00"), 15),
+            (None, Decimal("0.10"), None, None, 0),
+            (category, None, None, None, 30),
+            (None, None, Decimal("12.3"), Decimal("1000"), 5),
+            (category, Decimal("100000.00"), Decimal("99999.99"), None, 100),
+        )
+        cls.products = [
+            Product.objects.create(
+                code=f"FS-{i}",
+                name=f"Товар {i} — «кавычки» и \\ слэш",
+                slug=f"fs-{i}",
+                category=category_,
+                price=price,
+                wholesale_price=wholesale,
+                old_price=old_price,
+                discount=discount,
+                quantity=i,
+                promotion=bool(i % 2),
+            )
+            for i, (category_, price, wholesale, old_price, discount) in enumerate(rows)
+        ]
+        with override_settings(MEDIA_ROOT=cls.media_root):
+            ProductImage.objects.create(product=cls.products[0], image=ImageProcessingTests.png((700, 350)))
+            ProductImage.objects.create(product=cls.products[3], image=ImageProcessingTests.png((100, 100)))
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def get_both(self, params, url=None):
+        contents = []
+        for fast in (True, False):
+            cache.clear()
+            with override_settings(CATALOG_FAST_LIST_SERIALIZATION=fast):
+                response = self.client.get(url or reverse("product-list"), params)
+            self.assertEqual(response.status_code, 200)
+            contents.append(response.content)
+        return contents
+
+    def test_fast_and_model_serializer_bytes_match(self):
+        cases = (
+            {},
+            {"ordering": "price"},
+            {"ordering": "-wholesale_price", "page_size": "2", "page": "2"},
+            {"pagination": "cursor", "ordering": "effective_price", "page_size": "2"},
+        )
+        for params in cases:
+            with self.subTest(**params):
+                fast, slow = self.get_both(params)
+                self.assertEqual(fast, slow)
+
+        payload = json.loads(self.get_both({})[0])["results"]
+        cards = {card["code"]: card for card in payload}
+        self.assertNotIn("category_id", cards["FS-1"])  # source="category.id" без категории — ключа нет
+        self.assertIsNone(cards["FS-2"]["price"])
+        self.assertEqual(cards["FS-3"]["wholesale_price"], "12.30")
+        self.assertIsNone(cards["FS-4"]["main_image"])
+        self.assertIn("320w", cards["FS-0"]["main_image_srcset"])
+
+    def test_cursor_pages_match(self):
+        url, params, pages = None, {"pagination": "cursor", "ordering": "-price", "page_size": "2"}, 0
+        while params is not None:
+            fast, slow = self.get_both(params, url)
+            self.assertEqual(fast, slow)
+            url, params, pages = json.loads(fast)["next"], {}, pages + 1
+            if url is None:
+                params = None
+        self.assertEqual(pages, 3)
+
+
+# ===== потоковый JSON =====
+class StreamingRendererTests(TestCase):
+    STREAM = "application/json; stream=true"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.parent = Category.objects.create(name="Бумага", slug="paper")
+        cls.child = Category.objects.create(name="Офисная\u2028А4", slug="office", parent=cls.parent)
+        for i in range(40):
+            Product.objects.create(
+                code=f"ST-{i}",
+                name=f"Товар «{i}»\u2029",
+                slug=f"st-{i}",
+                category=(cls.child, cls.parent, None)[i % 3],
+                price=None if i % 7 == 0 else Decimal(f"{i}.{i % 10}5"),
+                discount=i % 4 * 5,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def get_both(self, url, params=None):
+        plain = self.client.get(url, params, HTTP_ACCEPT="application/json")
+        cache.clear()
+        streamed = self.client.get(url, params, HTTP_ACCEPT=self.STREAM)
+        self.assertEqual(plain.status_code, 200)
+        self.assertTrue(streamed.streaming)
+        self.assertEqual(streamed["Content-Type"], "application/json")
+        return plain, b"".join(streamed.streaming_content)
+
+    def test_streamed_bytes_equal_json_renderer(self):
+        cases = (
+            (reverse("product-list"), {"page_size": "200"}),
+            (reverse("product-list"), {"pagination": "cursor", "page_size": "7", "ordering": "price"}),
+            (reverse("product-detail", args=["st-1"]), None),
+            (reverse("product-facets"), None),
+            (reverse("category-tree"), None),
+        )
+        for url, params in cases:
+            with self.subTest(url=url, params=params):
+                plain, streamed = self.get_both(url, params)
+                self.assertEqual(streamed, plain.content)
+
+    def test_list_and_tree_do_not_fall_back_to_default(self):
+        # Decimal/UUID в списке и дереве уже строки — C-энкодер не зовёт Python на каждое значение
+        calls = []
+
+        class CountingEncoder(StreamingJSONEncoder):
+            def default(self, value):
+                calls.append(type(value))
+                return super().default(value)
+
+        for url in (reverse("product-list"), reverse("category-tree")):
+            response = self.client.get(url, {"page_size": "200"}, HTTP_ACCEPT="application/json")
+            self.assertEqual(b"".join(CountingEncoder().iterencode(response.data)), response.content)
+        self.assertEqual(calls, [])
+
+
+# ===== счётчики товаров в категориях =====
+@override_settings(CATALOG_SIMILAR_ASYNC=False)
+class CategoryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.paper = Category.objects.create(name="Бумага", slug="paper")
+        cls.office = Category.objects.create(name="Офисная", slug="office", parent=cls.paper)
+        cls.colored = Category.objects.create(name="Цветная", slug="colored", parent=cls.paper)
+        cls.pens = Category.objects.create(name="Ручки", slug="pens")
+
+    def create_product(self, slug, category, **kwargs):
+        return Product.objects.create(code=slug, name=slug, slug=slug, category=category, **kwargs)
+
+    def counts(self):
+        return {
+            c.slug: (c.product_count, c.product_count_total)
+            for c in Category.objects.all()
+        }
+
+    def test_rollup(self):
+        self.create_product("p1", self.office)
+        self.create_product("p2", self.office)
+        self.create_product("p3", self.colored)
+        self.create_product("p4", self.paper)
+        self.create_product("hidden", self.office, is_available=False)
+        self.create_product("pen", self.pens)
+
+        expected = {"paper": (1, 4), "office": (2, 2), "colored": (1, 1), "pens": (1, 1)}
+        by_slug = {c.slug: c.pk for c in Category.objects.all()}
+        self.assertEqual(compute_category_counts(), {by_slug[k]: v for k, v in expected.items()})
+        # сигналы вели те же числа, полный пересчёт ничего не исправляет
+        self.assertEqual(self.counts(), expected)
+        self.assertEqual(rebuild_category_counts(), 0)
+
+    def test_incremental(self):
+        product = self.create_product("p1", self.office)
+        self.assertEqual(self.counts()["paper"], (0, 1))
+
+        # как вебхук: читаем заново и сохраняем
+        product = Product.objects.get(pk=product.pk)
+        product.category = self.pens
+        product.save()
+        self.assertEqual(self.counts()["office"], (0, 0))
+        self.assertEqual(self.counts()["paper"], (0, 0))
+        self.assertEqual(self.counts()["pens"], (1, 1))
+
+        product = Product.objects.get(pk=product.pk)
+        product.is_available = False
+        product.save()
+        self.assertEqual(self.counts()["pens"], (0, 0))
+
+        product.is_available = True
+        product.category = self.colored
+        product.save()
+        self.assertEqual(self.counts()["colored"], (1, 1))
+        self.assertEqual(self.counts()["paper"], (0, 1))
+
+        Product.objects.get(pk=product.pk).delete()
+        self.assertEqual(self.counts()["paper"], (0, 0))
+
+    def test_counts_do_not_touch_category_structure_version(self):
+        self.client.get(reverse("product-list"), {"search": "p1"})  # строим поисковый индекс
+        tree_etag = self.client.get(reverse("category-tree"))["ETag"]
+        categories = get_version(CATEGORIES)
+
+        with mock.patch.object(product_search_index, "rebuild") as rebuild:
+            product = self.create_product("p1", self.office)
+            Product.objects.get(pk=product.pk).save(update_fields=["is_available"])
+            self.client.get(reverse("product-list"), {"search": "p1"})
+        rebuild.assert_not_called()
+        self.assertEqual(get_version(CATEGORIES), categories)
+
+        response = self.client.get(reverse("category-tree"))
+        self.assertNotEqual(response["ETag"], tree_etag)
+        paper = next(c for c in response.json() if c["slug"] == "paper")
+        self.assertEqual((paper["product_count"], paper["product_count_total"]), (0, 1))
+
+    def test_deferred_product_falls_back_to_rebuild(self):
+        product = self.create_product("p1", self.office)
+        product = Product.objects.only("id", "slug").get(pk=product.pk)
+        product.category_id = self.pens.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertEqual(self.counts()["pens"], (1, 1))
+        self.assertEqual(self.counts()["paper"], (0, 0))
+
+    def test_tree_payload(self):
+        self.create_product("p1", self.office)
+        tree = self.client.get(reverse("category-tree")).json()
+        paper = next(node for node in tree if node["slug"] == "paper")
+        self.assertEqual((paper["product_count"], paper["product_count_total"]), (0, 1))
+        office = next(node for node in paper["children"] if node["slug"] == "office")
+        self.assertEqual((office["product_count"], office["product_count_total"]), (1, 1))
+
+
+# ===== дерево категорий =====
+class CategoryTreeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.paper = Category.objects.create(name="Бумага", slug="paper")
+        self.office = Category.objects.create(name="Офисная", slug="office", parent=self.paper)
+        self.pens = Category.objects.create(name="Ручки", slug="pens")
+
+    def tree(self):
+        response = self.client.get(reverse("category-tree"))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def slugs(self, nodes=None):
+        """{slug: [slug детей]} по всему дереву."""
+        result = {}
+        for node in self.tree() if nodes is None else nodes:
+            result[node["slug"]] = [child["slug"] for child in node["children"]]
+            result.update(self.slugs(node["children"]))
+        return result
+
+    def get_with_queries(self):
+        queries = []
+
+        def wrapper(execute, sql, sql_params, many, context):
+            queries.append(sql)
+            return execute(sql, sql_params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            response = self.client.get(reverse("category-tree"))
+        self.assertEqual(response.status_code, 200)
+        return queries
+
+    def test_tree_is_read_in_one_query(self):
+        for i in range(3):
+            Category.objects.create(name=f"Подкатегория {i}", slug=f"sub-{i}", parent=self.office)
+
+        # версии + Last-Modified, версии дерева, всё дерево, счётчики товаров —
+        # число запросов не зависит от числа категорий
+        with self.assertNumQueries(5):
+            queries = self.get_with_queries()
+        tree_reads = [sql for sql in queries if '"catalog_category"."parent_id"' in sql]
+        self.assertEqual(len(tree_reads), 1, queries)
+
+        # дерево не менялось: категории из БД больше не читаются
+        queries = self.get_with_queries()
+        self.assertEqual([sql for sql in queries if '"catalog_category"."parent_id"' in sql], [])
+        with self.assertNumQueries(1):  # только версия
+            self.assertEqual(len(get_category_index().nodes), 6)
+
+    def test_rebuild_after_save(self):
+        self.assertIn("office", self.slugs()["paper"])
+        self.office.name = "Для принтера"
+        self.office.save()
+        paper = next(node for node in self.tree() if node["slug"] == "paper")
+        self.assertEqual(paper["children"][0]["name"], "Для принтера")
+
+    def test_rebuild_after_move(self):
+        self.tree()
+        self.office.move_to(self.pens)
+        slugs = self.slugs()
+        self.assertEqual(slugs["paper"], [])
+        self.assertEqual(slugs["pens"], ["office"])
+
+    def test_rebuild_after_delete(self):
+        self.tree()
+        Category.objects.get(pk=self.office.pk).delete()
+        self.assertEqual(self.slugs(), {"paper": [], "pens": []})
+
+    @override_settings(SITE_WEBHOOK_SECRET="test-secret", CRM_WEBHOOK_SYNC_IMAGES=False, CATALOG_SIMILAR_ASYNC=False)
+    def test_rebuild_after_webhook_creates_category(self):
+        self.tree()
+        item = {
+            "id": str(uuid.uuid4()),
+            "name": "Маркер",
+            "price": "10",
+            "category": {"slug": "markers", "name": "Маркеры"},
+        }
+        with self.captureOnCommitCallbacks(execute=True), self.assertLogs("apps.catalog.views", "INFO"):
+            response = post_crm_webhook(self.client, {"results": [item]})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn("markers", self.slugs())
+
+
+# ===== лента изменений =====
+class ProductChangesFeedTests(TestCase):
+    def create_product(self, slug, **kwargs):
+        return Product.objects.create(code=slug, name=slug, slug=slug, price=Decimal("10"), **kwargs)
+
+    def feed(self, since=None):
+        params = {"since": since} if since is not None else {}
+        return self.client.get(reverse("product-changes"), params)
+
+    def test_upserts_and_tombstones(self):
+        kept = self.create_product("kept")
+        token = self.feed().json()["next"]
+
+        changed = self.create_product("changed")
+        removed = self.create_product("removed")
+        kept.name = "renamed"
+        kept.save()
+        kept.name = "renamed again"
+        kept.save()
+        removed_id = removed.pk
+        removed.delete()
+        changed.is_available = False
+        changed.save()
+
+        data = self.feed(token).json()
+        # по каждому товару одна запись, в порядке последнего изменения
+        self.assertEqual([card["id"] for card in data["results"]], [kept.pk])
+        self.assertEqual(data["results"][0]["name"], "renamed again")
+        self.assertEqual(data["deleted"], [removed_id, changed.pk])
+        self.assertFalse(data["has_more"])
+
+        empty = self.feed(data["next"]).json()
+        self.assertEqual((empty["results"], empty["deleted"]), ([], []))
+        self.assertEqual(empty["next"], data["next"])
+
+    @override_settings(CATALOG_CHANGES_PAGE_SIZE=2)
+    def test_paging(self):
+        token = self.feed().json()["next"]
+        products = [self.create_product(f"p{i}") for i in range(3)]
+
+        first = self.feed(token).json()
+        self.assertTrue(first["has_more"])
+        second = self.feed(first["next"]).json()
+        self.assertFalse(second["has_more"])
+        ids = [card["id"] for card in first["results"] + second["results"]]
+        self.assertEqual(ids, [p.pk for p in products])
+
+    def test_category_delete_records_products(self):
+        paper = Category.objects.create(name="Бумага", slug="paper")
+        office = Category.objects.create(name="Офисная", slug="office", parent=paper)
+        in_parent = self.create_product("in-parent", category=paper)
+        in_child = self.create_product("in-child", category=office)
+        self.create_product("other")
+        token = self.feed().json()["next"]
+
+        Category.objects.get(pk=paper.pk).delete()
+
+        data = self.feed(token).json()
+        # подкатегория ушла каскадом — её товары тоже в ленте
+        self.assertEqual(sorted(card["id"] for card in data["results"]), sorted([in_parent.pk, in_child.pk]))
+        # без категории поля category_* в карточке нет (как у DRF для source="category.id")
+        self.assertFalse([card for card in data["results"] if "category_id" in card])
+        self.assertEqual(data["deleted"], [])
+
+    def test_invalid_and_expired_token(self):
+        self.assertEqual(self.feed("garbage!").status_code, 400)
+
+        token = self.feed().json()["next"]
+        for i in range(3):
+            self.create_product(f"p{i}")
+        ProductChange.objects.update(created_at=timezone.now() - timedelta(days=60))
+        self.assertEqual(prune_changes(30), 2)
+        self.assertEqual(self.feed(token).status_code, 410)
+
+
+# ===== обработка картинок =====
+@override_settings(CATALOG_IMAGE_WORKERS=0, CATALOG_SIMILAR_ASYNC=False)
+class ImageProcessingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    @staticmethod
+    def png(size=(2000, 1000)):
+        buffer = BytesIO()
+        Image.new("RGB", size, "red").save(buffer, format="PNG")
+        return ContentFile(buffer.getvalue(), name="photo.png")
+
+    def test_new_upload_processed_once(self):
+        product = Product.objects.create(code="IMG-1", name="Товар", slug="img-1")
+        upload = self.png()
+        with mock.patch("apps.utils.Image.Image.save", autospec=True, side_effect=Image.Image.save) as encode:
+            image = ProductImage.objects.create(product=product, image=upload)
+        # исходник — один раз, плюс по разу на каждое превью
+        self.assertEqual(encode.call_count, 1 + len(get_rendition_widths()))
+        self.assertTrue(image.image.name.endswith(".webp"))
+        with Image.open(image.image.path) as stored:
+            self.assertEqual(stored.size, (1600, 800))
+        for width in get_rendition_widths():
+            with image.image.storage.open(rendition_name(image.image.name, width)) as f, Image.open(f) as rendition:
+                self.assertEqual(rendition.size, (width, width // 2))
+
+    def test_same_bytes_share_one_file(self):
+        first = Product.objects.create(code="IMG-1", name="Красный", slug="img-1")
+        second = Product.objects.create(code="IMG-2", name="Синий", slug="img-2")
+        data = self.png().read()
+        a = ProductImage.objects.create(product=first, image=ContentFile(data, name="a.png"))
+        with mock.patch("apps.utils.Image.Image.save", autospec=True, side_effect=Image.Image.save) as encode:
+            b = ProductImage.objects.create(product=second, image=ContentFile(data, name="b.png"))
+        encode.assert_not_called()
+        self.assertEqual(a.image.name, b.image.name)
+
+        storage = a.image.storage
+        files = [a.image.name, *(rendition_name(a.image.name, width) for width in get_rendition_widths())]
+        with self.captureOnCommitCallbacks(execute=True):
+            a.delete()
+        self.assertTrue(all(storage.exists(name) for name in files))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(any(storage.exists(name) for name in files))
+        self.assertFalse(StoredImage.objects.filter(name=a.image.name).exists())
+
+    def test_upload_after_last_release_writes_file_again(self):
+        product = Product.objects.create(code="IMG-1", name="Товар", slug="img-1")
+        data = self.png((300, 300)).read()
+        first = ProductImage.objects.create(product=product, image=ContentFile(data, name="a.png"))
+        name = first.image.name
+        self.assertEqual(StoredImage.objects.get(name=name).refs, 1)
+
+        # последняя ссылка снята: строка учёта и файл удалены вместе, ссылку на них уже не взять
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertFalse(StoredImage.link(name))
+        self.assertFalse(first.image.storage.exists(name))
+
+        second = ProductImage.objects.create(product=product, image=ContentFile(data, name="b.png"))
+        self.assertEqual(second.image.name, name)
+        self.assertTrue(second.image.storage.exists(name))
+        self.assertEqual(StoredImage.objects.get(name=name).refs, 1)
+
+    def test_srcset_in_list(self):
+        product = Product.objects.create(code="IMG-1", name="Товар", slug="img-1")
+        image = ProductImage.objects.create(product=product, image=self.png((400, 400)))
+
+        card = self.client.get(reverse("product-list")).json()["results"][0]
+        entries = [entry.rsplit(" ", 1) for entry in card["main_image_srcset"].split(", ")]
+        # превью 640 и 1280 шире исходника 400px — их нет ни в storage, ни в srcset
+        self.assertEqual([w for _, w in entries], ["160w", "320w"])
+        self.assertTrue(entries[0][0].endswith(rendition_name(image.image.name, 160)))
+        self.assertTrue(entries[0][0].startswith("http://testserver/"))
+        storage = image.image.storage
+        self.assertEqual(
+            [width for width in get_rendition_widths() if storage.exists(rendition_name(image.image.name, width))],
+            [160, 320],
+        )
+        for _, width in entries:
+            with storage.open(rendition_name(image.image.name, int(width[:-1]))) as f, Image.open(f) as rendition:
+                self.assertEqual(rendition.width, int(width[:-1]))
+
+    def test_no_srcset_below_smallest_rendition(self):
+        product = Product.objects.create(code="IMG-1", name="Товар", slug="img-1")
+        ProductImage.objects.create(product=product, image=self.png((120, 80)))
+        card = self.client.get(reverse("product-list")).json()["results"][0]
+        self.assertIsNotNone(card["main_image"])
+        self.assertIsNone(card["main_image_srcset"])
+
+    def test_plain_save_keeps_file(self):
+        category = Category.objects.create(name="Бумага", slug="paper", image=self.png((100, 100)))
+        name = category.image.name
+        mtime = os.path.getmtime(category.image.path)
+
+        category = Category.objects.get(pk=category.pk)
+        category.is_active = False
+        with mock.patch("apps.catalog.models.rename_upload_file") as process, \
+                mock.patch("apps.catalog.models.generate_renditions") as renditions:
+            category.save()
+        process.assert_not_called()
+        renditions.assert_not_called()
+        self.assertEqual(Category.objects.get(pk=category.pk).image.name, name)
+        self.assertEqual(os.path.getmtime(category.image.path), mtime)
+
+
+@override_settings(CATALOG_IMAGE_WORKERS=1, CATALOG_SIMILAR_ASYNC=False)
+class BackgroundImageProcessingTests(TransactionTestCase):
+    """
+    Фоновый поток пишет в БД своим соединением — нужен настоящий commit.
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.product = Product.objects.create(code="IMG-1", name="Товар", slug="img-1")
+
+    def test_upload_saved_pending_then_swapped(self):
+        image = ProductImage.objects.create(product=self.product, image=ImageProcessingTests.png())
+        source = image.image.name
+        self.assertEqual(image.status, ProductImage.PENDING)
+        self.assertTrue(source.endswith(".png"))
+
+        self.assertTrue(image_jobs.wait(timeout=60))
+        image.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(image.status, ProductImage.READY)
+        self.assertTrue(image.image.name.endswith(".webp"))
+        self.assertEqual(self.product.main_image, image.image.name)
+        with Image.open(image.image.path) as stored:
+            self.assertEqual(stored.size, (1600, 800))
+        for width in get_rendition_widths():
+            self.assertTrue(image.image.storage.exists(rendition_name(image.image.name, width)))
+        self.assertFalse(image.image.storage.exists(source))
+
+        stats = image_jobs.stats()
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertIsNotNone(stats["avg_processing_ms"])
+
+    def test_same_bytes_reuse_processed_file(self):
+        data = ImageProcessingTests.png().read()
+        first = ProductImage.objects.create(product=self.product, image=ContentFile(data, name="a.png"))
+        self.assertTrue(image_jobs.wait(timeout=60))
+        first.refresh_from_db()
+
+        other = Product.objects.create(code="IMG-2", name="Синий", slug="img-2")
+        with mock.patch.object(image_jobs, "submit") as submit:
+            second = ProductImage.objects.create(product=other, image=ContentFile(data, name="b.png"))
+        submit.assert_not_called()
+        self.assertEqual(second.status, ProductImage.READY)
+        self.assertEqual(second.image.name, first.image.name)
+        other.refresh_from_db()
+        self.assertEqual(other.main_image, first.image.name)
+
+    def test_pending_duplicates_share_one_job(self):
+        data = ImageProcessingTests.png().read()
+        with mock.patch.object(image_jobs, "submit"):
+            first = ProductImage.objects.create(product=self.product, image=ContentFile(data, name="a.png"))
+        other = Product.objects.create(code="IMG-2", name="Синий", slug="img-2")
+        processed = image_jobs.stats()["processed"]
+        second = ProductImage.objects.create(product=other, image=ContentFile(data, name="b.png"))
+        self.assertEqual(second.status, ProductImage.PENDING)
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertEqual(StoredImage.objects.get(name=first.image.name).refs, 2)
+
+        self.assertTrue(image_jobs.wait(timeout=60))
+        self.assertEqual(image_jobs.stats()["processed"], processed + 1)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.status, second.status), (ProductImage.READY, ProductImage.READY))
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(StoredImage.objects.get(name=first.image.name).refs, 2)
+        self.assertFalse(StoredImage.objects.filter(name__contains=".src.").exists())
+
+    def test_source_submitted_while_running_is_not_processed_again(self):
+        started, release = threading.Event(), threading.Event()
+        data = ImageProcessingTests.png((300, 300)).read()
+
+        class SlowStorage:
+            def open(self, name, mode):
+                started.set()
+                release.wait(30)
+                return BytesIO(data)
+
+        done = []
+        processed = image_jobs.stats()["processed"]
+        image_jobs.submit(SlowStorage(), "x.src.png", on_done=lambda main, renditions: done.append(main))
+        self.assertTrue(started.wait(30))
+        image_jobs.submit(SlowStorage(), "x.src.png", on_done=lambda main, renditions: done.append(main))
+        release.set()
+        self.assertTrue(image_jobs.wait(timeout=60))
+        # одна обработка, результат применён дважды: для первой и для пришедшей следом записи
+        self.assertEqual(image_jobs.stats()["processed"], processed + 1)
+        self.assertEqual(len(done), 2)
+
+    def test_pending_image_hidden_from_storefront(self):
+        with mock.patch.object(image_jobs, "submit"):
+            ProductImage.objects.create(product=self.product, image=ImageProcessingTests.png((100, 100)))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.main_image, "")
+        detail = self.client.get(reverse("product-detail", args=[self.product.slug])).json()
+        self.assertEqual(detail["images"], [])
+
+    def test_broken_upload_marked_failed(self):
+        image = ProductImage.objects.create(product=self.product, image=ContentFile(b"not an image", name="x.png"))
+        with self.assertLogs("apps.catalog.images", "ERROR"):
+            self.assertTrue(image_jobs.wait(timeout=60))
+        image.refresh_from_db()
+        self.assertEqual(image.status, ProductImage.FAILED)
+
+        admin = get_user_model().objects.create_user("staff", password="x", is_staff=True)
+        self.client.force_login(admin)
+        stats = self.client.get(reverse("catalog_stats")).json()["image_jobs"]
+        self.assertEqual(stats["failed_images"], 1)
+        self.assertEqual(stats["workers"], 1)
+
+
+# ===== загрузка картинок вебхука CRM =====
+class _ImageHandler(BaseHTTPRequestHandler):
+    """
+    Подставной сервер CRM: /slow/... отвечает через ?delay= секунд, /large — больше
+    лимита, /stream-large — то же без Content-Length, /page — HTML, /missing — 404.
+    """
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+    state = None
+
+    def setup(self):
+        super().setup()
+        with self.state["lock"]:
+            self.state["connections"] += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        state = self.state
+        path, _, query = self.path.partition("?")
+        params = dict(pair.split("=", 1) for pair in query.split("&") if "=" in pair)
+        with state["lock"]:
+            state["requests"] += 1
+            state["active"] += 1
+            state["max_active"] = max(state["max_active"], state["active"])
+        try:
+            if path.startswith("/slow"):
+                time.sleep(float(params.get("delay", "0.5")))
+            if path == "/missing":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            content_type, body = "image/png", state["png"]
+            if path == "/page":
+                content_type, body = "text/html", b"<html></html>"
+            elif path in ("/large", "/stream-large"):
+                body = b"\0" * 4096
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            if path == "/stream-large":
+                # без длины: тело до закрытия соединения
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            else:
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with state["lock"]:
+                state["active"] -= 1
+
+
+class _ImageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # клиент рвёт соединение по лимиту размера или бюджету — это ожидаемо
+        pass
+
+
+@override_settings(CATALOG_IMAGE_WORKERS=0, CRM_WEBHOOK_MAX_IMAGE_BYTES=2048)
+class CRMImageDownloadTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        buffer = BytesIO()
+        Image.new("RGB", (8, 8), "red").save(buffer, format="PNG")
+        cls.state = {
+            "lock": threading.Lock(),
+            "connections": 0,
+            "requests": 0,
+            "active": 0,
+            "max_active": 0,
+            "png": buffer.getvalue(),
+        }
+        handler = type("Handler", (_ImageHandler,), {"state": cls.state})
+        cls.server = _ImageServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        with self.state["lock"]:
+            self.state["max_active"] = 0
+        self.product = Product.objects.create(code="CRM-1", name="Товар", slug="crm-1")
+
+    def urls(self, count, delay=0.5):
+        return [f"{self.base_url}/slow/{n}.png?delay={delay}" for n in range(count)]
+
+    def test_downloads_run_in_parallel_in_order(self):
+        urls = self.urls(6)
+        started = time.monotonic()
+        with ImageDownloader(workers=6, per_host=6) as downloader, self.assertLogs("apps.catalog.views", "INFO"):
+            stats, errors = sync_product_images(self.product, [{"image_url": url} for url in urls], downloader)
+        # по очереди — 3 с
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual((stats["added"], errors), (6, []))
+        self.assertEqual(list(self.product.images.order_by("id").values_list("source_url", flat=True)), urls)
+
+    def test_per_host_limit_reuses_connections(self):
+        before = self.state["connections"]
+        with ImageDownloader(workers=6, per_host=2) as downloader:
+            downloader.prefetch(self.urls(6, delay=0.1))
+            results = [downloader.get(url) for url in self.urls(6, delay=0.1)]
+        self.assertTrue(all(result.content == self.state["png"] for result in results))
+        self.assertEqual(self.state["max_active"], 2)
+        # keep-alive: 6 картинок не больше чем по 2 соединениям
+        self.assertLessEqual(self.state["connections"] - before, 2)
+
+    def test_prefetch_window_bounds_memory(self):
+        urls = self.urls(10, delay=0.05)
+        before = self.state["requests"]
+        with ImageDownloader(workers=2, window=4) as downloader:
+            downloader.prefetch(urls)
+            time.sleep(0.5)
+            # вперёд скачано только окно, остальное ждёт get()
+            self.assertEqual(self.state["requests"] - before, 4)
+            results = [downloader.get(url) for url in urls]
+            self.assertEqual(downloader._futures, {})
+        self.assertTrue(all(result.content == self.state["png"] for result in results))
+        self.assertEqual(self.state["requests"] - before, 10)
+
+    def test_size_and_content_type_guards(self):
+        paths = ["/large", "/stream-large", "/page", "/missing"]
+        payload = [{"image": f"{self.base_url}{path}"} for path in paths]
+        with self.assertLogs("apps.catalog.views", "WARNING"):
+            stats, errors = sync_product_images(self.product, payload)
+        self.assertEqual((stats["added"], stats["failed"]), (0, 4))
+        self.assertEqual(
+            [error["error"] for error in errors],
+            ["too large", "too large", "content-type text/html", "http 404"],
+        )
+
+    def test_time_budget(self):
+        started = time.monotonic()
+        with ImageDownloader(budget=0.3) as downloader, self.assertLogs("apps.catalog.views", "WARNING"):
+            stats, errors = sync_product_images(self.product, [{"image": url} for url in self.urls(2, delay=2)], downloader)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(stats["failed"], 2)
+        self.assertEqual({error["error"] for error in errors}, {BUDGET_EXCEEDED})
+        self.assertFalse(self.product.images.exists())
+
+    @override_settings(SITE_WEBHOOK_SECRET="test-secret", CRM_WEBHOOK_IMAGE_WORKERS=8, CRM_WEBHOOK_IMAGE_PER_HOST=8)
+    def test_webhook_prefetches_all_products(self):
+        urls = self.urls(8)
+        items = [
+            {"id": str(uuid.uuid4()), "name": f"Товар {n}", "price": "10", "images": urls[n * 2:n * 2 + 2]}
+            for n in range(4)
+        ]
+        body = json.dumps({"results": items}).encode("utf-8")
+        signature = "sha256=" + hmac.new(b"test-secret", body, hashlib.sha256).hexdigest()
+
+        started = time.monotonic()
+        with self.assertLogs("apps.catalog.views", "INFO"):
+            response = self.client.post(
+                reverse("crm_products_webhook"), body, content_type="application/json", HTTP_X_CRM_SIGNATURE=signature
+            )
+        # картинки всех товаров качаются вместе — не 4 * 2 * 0.5 с
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()["images"]["added"], 8)
@@ -0,0 +1,123 @@
+"""
+Дерево категорий в памяти процесса.
+
+Все категории забираем одним запросом (ORDER BY tree_id, lft) и раскладываем
+по parent_id — дальше дерево собирается без обращений к БД. Снимок живёт,
+пока не изменится версия CATEGORIES (см. signals.categories_changed).
+Счётчики товаров (product_count*) меняются с каждым товаром — их подставляем
+отдельно, по версии CATEGORY_COUNTS, не перечитывая дерево.
+"""
+import threading
+from functools import cached_property
+
+from .cache import CATEGORIES, CATEGORY_COUNTS, get_version, get_versions
+from .models import Category
+from .search import PrefixIndex
+from .serializers import CategoryTreeSerializer
+
+
+class CategoryIndex:
+    def __init__(self, categories):
+        self.nodes = list(categories)
+        self.by_id = {c.pk: c for c in self.nodes}
+        self.position = {c.pk: i for i, c in enumerate(self.nodes)}
+        self.children = {}
+        for c in self.nodes:
+            # nodes отсортированы по (tree_id, lft) -> дети уже в порядке MPTT
+            self.children.setdefault(c.parent_id, []).append(c)
+        self._descendants = {}
+
+    @property
+    def roots(self):
+        return self.children.get(None, [])
+
+    @cached_property
+    def suggestions(self) -> PrefixIndex:
+        prefix = PrefixIndex()
+        prefix.bulk_load(
+            (c.pk, (c.name,), {"id": c.pk, "slug": c.slug, "name": c.name})
+            for c in self.nodes
+            if c.is_active
+        )
+        return prefix
+
+    def descendant_ids(self, pk) -> frozenset:
+        """
+        Категория + все потомки. В порядке (tree_id, lft) потомки узла идут
+        сразу за ним, и их ровно (rght - lft - 1) / 2 — берём срез списка.
+        """
+        ids = self._descendants.get(pk)
+        if ids is None:
+            idx = self.position.get(pk)
+            if idx is None:
+                ids = frozenset()
+            else:
+                node = self.nodes[idx]
+                count = (node.rght - node.lft - 1) // 2
+                ids = frozenset(c.pk for c in self.nodes[idx: idx + 1 + count])
+            self._descendants[pk] = ids
+        return ids
+
+
+_lock = threading.Lock()
+_index = (None, None)  # (version, CategoryIndex)
+_counts = (None, None)  # (version CATEGORY_COUNTS, {id: (product_count, product_count_total)})
+_tree_payloads = {}  # ((CATEGORIES, CATEGORY_COUNTS), scheme://host/) -> serialized tree
+
+
+def get_category_index(version=None) -> CategoryIndex:
+    global _index
+    if version is None:
+        version = get_version(CATEGORIES)
+    cached_version, index = _index
+    if index is not None and cached_version == version:
+        return index
+
+    index = CategoryIndex(Category.objects.order_by("tree_id", "lft"))
+    with _lock:
+        _index = (version, index)
+    return index
+
+
+def get_category_counts(version) -> dict:
+    global _counts
+    cached_version, counts = _counts
+    if counts is not None and cached_version == version:
+        return counts
+
+    rows = Category.objects.values_list("id", "product_count", "product_count_total")
+    counts = {pk: (count, total) for pk, count, total in rows}
+    with _lock:
+        _counts = (version, counts)
+    return counts
+
+
+def get_category_tree(request):
+    """
+    Сериализованное дерево активных корней (дети — как у obj.get_children()).
+    """
+    versions = get_versions(CATEGORIES, CATEGORY_COUNTS)
+    version = (versions[CATEGORIES], versions[CATEGORY_COUNTS])
+    key = (version, request.build_absolute_uri("/"))
+    data = _tree_payloads.get(key)
+    if data is not None:
+        return data
+
+    index = get_category_index(versions[CATEGORIES])
+    roots = [c for c in index.roots if c.is_active]
+    data = CategoryTreeSerializer(
+        roots,
+        many=True,
+        context={
+            "request": request,
+            "category_children": index.children,
+            "category_counts": get_category_counts(versions[CATEGORY_COUNTS]),
+        },
+    ).data
+
+    with _lock:
+        # старые версии больше не понадобятся
+        for stale in [k for k in _tree_payloads if k[0] != version]:
+            del _tree_payloads[stale]
+        _tree_payloads[key] = data
+    return data
@@ -2,7 +2,14 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from .views import ProductViewSet, CategoryViewSet, CRMProductsWebhookAPIView
+from .views import (
+    ProductViewSet,
+    CategoryViewSet,
+    CRMProductsWebhookAPIView,
+    CatalogSnapshotAPIView,
+    CatalogStatsAPIView,
+    CatalogSuggestAPIView,
+)
 
 router = DefaultRouter()
 router.register(r"products", ProductViewSet, basename="product")
@@ -10,6 +17,9 @@ router.register(r"categories", CategoryViewSet, basename="category")
 
 urlpatterns = [
     path("", include(router.urls)),
+    path("suggest/", CatalogSuggestAPIView.as_view(), name="catalog_suggest"),
+    path("snapshot/", CatalogSnapshotAPIView.as_view(), name="catalog_snapshot"),
+    path("stats/", CatalogStatsAPIView.as_view(), name="catalog_stats"),
     path("integrations/crm/products/", CRMProductsWebhookAPIView.as_view(), name="crm_products_webhook"),
     path("integrations/crm/products", CRMProductsWebhookAPIView.as_view(), name="crm_products_webhook_noslash"),
 ]
@@ -1,9 +1,12 @@
-from django.db.models import Prefetch
+import functools
+
+from django.db.models import Count, Prefetch, Q
+from rest_framework.mixins import RetrieveModelMixin
 from rest_framework.viewsets import ReadOnlyModelViewSet
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.pagination import PageNumberPagination
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import BaseFilterBackend, SearchFilter
 from django_filters.rest_framework import DjangoFilterBackend
 import django_filters
 import hmac
@@ -11,33 +14,61 @@ import hashlib
 from decimal import Decimal
 from django.conf import settings
 from django.db import transaction
+from django.shortcuts import get_object_or_404
 from django.utils.text import slugify
 from rest_framework.views import APIView
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
 import logging
 import uuid
 import os
+import re
 from urllib.parse import urlparse, urljoin
 
-import requests
 from django.core.files.base import ContentFile
 
-from .models import Product, ProductImage, Category, Characteristics
+from .cache import (
+    CATALOG,
+    CATEGORIES,
+    CATEGORY_COUNTS,
+    SIMILAR,
+    CachedResponseMixin,
+    ConditionalResponseMixin,
+    get_version,
+    product_detail_cache,
+    response_cache_stats,
+)
+from .changes import InvalidToken, TokenExpired, current_token, decode_token, encode_token, read_changes
+from .downloads import ImageDownloader
+from .images import image_jobs
+from .models import Product, ProductImage, Category, Characteristics, normalize_characteristic_value
+from .pagination import KeysetPagination
+from .renderers import StreamingResponseMixin
+from .search import ProductSearchFilter, ProductOrderingFilter, product_search_index
+from .similar import similar_refresh
+from .snapshot import get_snapshot, snapshot_response
+from .tree import get_category_index, get_category_tree
 from .serializers import (
     ProductListSerializer,
+    ProductListRowSerializer,
+    ProductBulkLookupSerializer,
     ProductDetailSerializer,
     CategorySerializer,
-    CategoryTreeSerializer,
 )
 
 logger = logging.getLogger(__name__)
 
 
 # ===== фильтрация товаров =====
+class NumberInFilter(django_filters.BaseInFilter, django_filters.NumberFilter):
+    pass
+
+
 class ProductFilter(django_filters.FilterSet):
-    category = django_filters.NumberFilter(field_name="category_id")
-    category_in = django_filters.BaseInFilter(field_name="category_id")
+    category = django_filters.NumberFilter(method="filter_category")
+    category_in = NumberInFilter(method="filter_category")
+    # ?category=5&include_descendants=true -> товары категории 5 и всех её подкатегорий
+    include_descendants = django_filters.BooleanFilter(method="filter_include_descendants")
 
     min_price = django_filters.NumberFilter(field_name="price", lookup_expr="gte")
     max_price = django_filters.NumberFilter(field_name="price", lookup_expr="lte")
@@ -50,6 +81,14 @@ class ProductFilter(django_filters.FilterSet):
         field_name="wholesale_price", lookup_expr="lte"
     )
 
+    # цена со скидкой — то, что реально платит покупатель
+    min_effective_price = django_filters.NumberFilter(
+        field_name="effective_price", lookup_expr="gte"
+    )
+    max_effective_price = django_filters.NumberFilter(
+        field_name="effective_price", lookup_expr="lte"
+    )
+
     promotion = django_filters.BooleanFilter(field_name="promotion")
     in_stock = django_filters.BooleanFilter(field_name="is_available")
 
@@ -62,22 +101,117 @@ class ProductFilter(django_filters.FilterSet):
             "is_available",
         )
 
+    def filter_category(self, queryset, name, value):
+        ids = [int(v) for v in value] if isinstance(value, (list, tuple)) else [int(value)]
+        if self.form.cleaned_data.get("include_descendants"):
+            # диапазоны lft/rght -> набор id (кэшируется до изменения дерева)
+            index = get_category_index()
+            ids = set().union(*(index.descendant_ids(pk) for pk in ids)) or set(ids)
+        if len(ids) == 1:
+            return queryset.filter(category_id=next(iter(ids)))
+        return queryset.filter(category_id__in=sorted(ids))
+
+    def filter_include_descendants(self, queryset, name, value):
+        # сам по себе ничего не фильтрует — влияет на category / category_in
+        return queryset
+
+
+class ProductAttributeFilter(BaseFilterBackend):
+    """
+    ?attr[<key_id>]=A4&attr[<key_id>]=A3&attr[<other_key_id>]=80
+    Значения одного ключа — ИЛИ, разные ключи — И.
+    Каждый ключ — подзапрос по индексу (key, value_normalized, product)
+    таблицы характеристик, без JOIN-ов товара с характеристиками.
+    """
+
+    param_re = re.compile(r"^attr\[(\d+)\]$")
+
+    def get_attribute_filters(self, request) -> dict:
+        filters = {}
+        for param in request.query_params.keys():
+            match = self.param_re.match(param)
+            if not match:
+                continue
+            values = {
+                normalize_characteristic_value(v)
+                for v in request.query_params.getlist(param)
+                if v.strip()
+            }
+            if values:
+                filters.setdefault(int(match.group(1)), set()).update(values)
+        return filters
+
+    def filter_queryset(self, request, queryset, view):
+        for key_id, values in sorted(self.get_attribute_filters(request).items()):
+            product_ids = (
+                Characteristics.objects
+                .filter(key_id=key_id, value_normalized__in=sorted(values))
+                .values("product_id")
+            )
+            queryset = queryset.filter(id__in=product_ids)
+        return queryset
+
 
 # ===== пагинация =====
 class ProductPagination(PageNumberPagination):
+    """
+    По умолчанию — номера страниц (count/next/previous/results).
+    ?pagination=cursor или ?cursor=... — keyset-режим для бесконечной ленты:
+    без COUNT(*) и OFFSET, ответ {"next": ..., "results": [...]}.
+    ?search= без ?ordering= сортирует по релевантности — это не колонка, и курсор
+    по ней не построить: такой запрос отдаётся номерами страниц в порядке релевантности.
+    Поиск обрезан до CATALOG_SEARCH_MAX_RESULTS — в ответе "search_truncated": true.
+    """
+
     page_size = 40
     page_size_query_param = "page_size"
     max_page_size = 200
 
+    mode_query_param = "pagination"
+    cursor_query_param = "cursor"
+
+    keyset = None
+
+    def use_cursor(self, request) -> bool:
+        return (
+            request.query_params.get(self.mode_query_param) == "cursor"
+            or bool(request.query_params.get(self.cursor_query_param))
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        if self.use_cursor(request):
+            keyset = KeysetPagination(self.get_page_size(request))
+            keyset.cursor_query_param = self.cursor_query_param
+            if keyset.get_ordering_term(request, queryset, view) is not None:
+                self.keyset = keyset
+                return keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            response = self.keyset.get_paginated_response(data)
+        else:
+            response = super().get_paginated_response(data)
+        if getattr(self.request, "search_truncated", False):
+            response.data["search_truncated"] = True
+        return response
+
 
 # ===== категории =====
-class CategoryViewSet(ReadOnlyModelViewSet):
+class CategoryViewSet(StreamingResponseMixin, ConditionalResponseMixin, ReadOnlyModelViewSet):
     """
     GET /categories/         -> список категорий (плоский)
     GET /categories/tree/    -> дерево категорий
     GET /categories/{slug}/  -> детальная категория по slug
+
+    ETag/Last-Modified — от версий дерева категорий и счётчиков товаров в них (см. cache.py).
+    Accept: application/json; stream=true — потоковый JSON (см. renderers.py).
     """
 
+    conditional_version_names = (CATEGORIES, CATEGORY_COUNTS)
+    conditional_model = Category
+
     queryset = Category.objects.filter(is_active=True).order_by("tree_id", "lft")
     serializer_class = CategorySerializer
     filter_backends = [SearchFilter]
@@ -91,33 +225,38 @@ class CategoryViewSet(ReadOnlyModelViewSet):
     def tree(self, request, *args, **kwargs):
         """
         Дерево категорий от корня вниз.
+        Собирается из одного запроса и держится в памяти до изменения категорий.
         """
-        roots = self.get_queryset().filter(parent__isnull=True)
-        serializer = CategoryTreeSerializer(
-            roots,
-            many=True,
-            context={"request": request},
-        )
-        return Response(serializer.data)
+        return self.conditional_response(request, lambda: Response(get_category_tree(request)))
 
 
 # ===== товары =====
-class ProductViewSet(ReadOnlyModelViewSet):
+class ProductViewSet(StreamingResponseMixin, ConditionalResponseMixin, CachedResponseMixin, ReadOnlyModelViewSet):
     """
     GET /products/          -> быстрый список (лайт-данные, 1 картинка)
     GET /products/{slug}/   -> детальная карточка по slug
+    POST /products/bulk/    -> лёгкие карточки по списку ids/slugs (корзина, избранное)
+    GET /products/{slug}/similar/ -> похожие товары (заранее посчитанный список, см. similar.py)
+    GET /products/changes/?since=<токен> -> изменения после токена (см. changes.py)
+
+    Список кэшируется до следующего изменения каталога, карточка — по slug (см. cache.py).
+    Повторный запрос с If-None-Match / If-Modified-Since получает 304 без обращения к кэшу.
+    Accept: application/json; stream=true — потоковый JSON (см. renderers.py).
     """
 
+    conditional_model = Product
+
     pagination_class = ProductPagination
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ProductAttributeFilter, ProductSearchFilter, ProductOrderingFilter]
     filterset_class = ProductFilter
-    search_fields = ("name", "code", "slug")
+    response_cache_query_prefixes = ("attr[",)
     ordering_fields = (
         "created_at",
         "price",
         "wholesale_price",  # 👈 сортировка по опту тоже доступна
         "discount",
         "name",
+        "effective_price",
     )
     ordering = ("-created_at",)
 
@@ -125,17 +264,35 @@ class ProductViewSet(ReadOnlyModelViewSet):
     lookup_field = "slug"
     lookup_url_kwarg = "slug"
 
+    # действия с лёгкими карточками (ProductListSerializer), а не детальной карточкой
+    card_actions = ("list", "bulk", "similar", "changes")
+    # /similar/: карточки соседей (CATALOG) и сами списки — у пересчёта списков своя версия
+    similar_version_names = (CATALOG, SIMILAR)
+
+    def get_response_cache_version_names(self):
+        if self.action == "similar":
+            return self.similar_version_names
+        return super().get_response_cache_version_names()
+
+    def get_conditional_version_names(self):
+        if self.action == "similar":
+            return self.similar_version_names
+        return super().get_conditional_version_names()
+
     def get_queryset(self):
         """
         Оптимизированный queryset:
         - select_related("category") — нет лишних запросов по категории
         - only(...) — забираем только нужные поля продукта
-        - list: префетчим только первую картинку (через to_attr="images_all")
+        - list: картинка берётся из Product.main_image, без prefetch
         - detail: префетчим все картинки и характеристики с key
         """
+        base_qs = Product.objects.filter(is_active=True)
+        # bulk (корзина, избранное) видит и закончившиеся товары — чтобы сообщить о них
+        if getattr(self, "action", None) != "bulk":
+            base_qs = base_qs.filter(is_available=True)
         base_qs = (
-            Product.objects
-            .filter(is_active=True, is_available=True)
+            base_qs
             .select_related("category")
             .only(
                 "id",
@@ -146,10 +303,12 @@ class ProductViewSet(ReadOnlyModelViewSet):
                 "wholesale_price", 
                 "old_price",
                 "discount",
+                "effective_price",
                 "promotion",
                 "is_available",
                 "is_active",
                 "quantity", 
+                "main_image",
                 "created_at",
                 "updated_at",
                 "category__id",
@@ -158,19 +317,14 @@ class ProductViewSet(ReadOnlyModelViewSet):
             )
         )
 
-        # Для списка — только первая картинка, через to_attr="images_all"
-        if getattr(self, "action", None) == "list":
-            images_qs = (
-                ProductImage.objects
-                .only("id", "image", "product")
-                .order_by("id")
-            )
-            base_qs = base_qs.prefetch_related(
-                Prefetch("images", queryset=images_qs, to_attr="images_all")
-            )
+        # Для списка картинки не нужны: путь первой лежит в Product.main_image
+        if getattr(self, "action", None) in self.card_actions:
+            if self.use_fast_list():
+                # строки .values(), см. ProductListRowSerializer
+                return ProductListRowSerializer.prepare_queryset(base_qs)
         else:
             # Для детальной карточки — все картинки + характеристики с key
-            images_qs = ProductImage.objects.only("id", "image", "product")
+            images_qs = ProductImage.objects.filter(status=ProductImage.READY).only("id", "image", "product")
             chars_qs = (
                 Characteristics.objects
                 .select_related("key")
@@ -192,10 +346,282 @@ class ProductViewSet(ReadOnlyModelViewSet):
         return base_qs
 
     def get_serializer_class(self):
-        if getattr(self, "action", None) == "list":
+        if getattr(self, "action", None) in self.card_actions:
             return ProductListSerializer
         return ProductDetailSerializer
 
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Карточка кэшируется по slug (cache.ProductDetailCache), а не по версии
+        всего каталога, как список.
+        """
+        return self.conditional_response(request, functools.partial(self.retrieve_cached, request, *args, **kwargs))
+
+    def retrieve_cached(self, request, *args, **kwargs):
+        slug = str(kwargs.get(self.lookup_url_kwarg or self.lookup_field, ""))
+        host = request.build_absolute_uri("/")
+        # stamp до сериализации: если товар поменяется по ходу, запись просто не совпадёт
+        stamp = product_detail_cache.get_stamp(Product.objects.filter(is_active=True, is_available=True), slug)
+        if stamp is not None:
+            data = product_detail_cache.get(slug, host, stamp)
+            if data is not None:
+                return Response(data)
+
+        response = RetrieveModelMixin.retrieve(self, request, *args, **kwargs)
+        if stamp is not None and response.status_code == 200:
+            product_detail_cache.set(slug, host, stamp, response.data)
+        return response
+
+    def use_fast_list(self) -> bool:
+        return bool(getattr(settings, "CATALOG_FAST_LIST_SERIALIZATION", True))
+
+    def get_serializer(self, *args, **kwargs):
+        if getattr(self, "action", None) in self.card_actions and args and self.use_fast_list():
+            kwargs.setdefault("context", self.get_serializer_context())
+            return ProductListRowSerializer(*args, **kwargs)
+        return super().get_serializer(*args, **kwargs)
+
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="bulk",
+        authentication_classes=[],
+        permission_classes=[AllowAny],
+    )
+    def bulk(self, request, *args, **kwargs):
+        """
+        POST /products/bulk/ {"ids": [12, 15], "slugs": ["ruchka-sinyaya"]}
+        Карточки для корзины и избранного одним запросом (цена, опт, остаток, наличие)
+        вместо /products/{slug}/ на каждый товар. Порядок — как в запросе.
+
+        missing — нет в каталоге или снят с продажи (is_active=False);
+        unavailable — карточка есть, но товар закончился.
+        И те, и другие OrderSerializer не примет — корзина убирает их заранее.
+        """
+        lookup = ProductBulkLookupSerializer(data=request.data)
+        lookup.is_valid(raise_exception=True)
+        ids = lookup.validated_data["ids"]
+        slugs = lookup.validated_data["slugs"]
+
+        queryset = self.get_queryset().filter(Q(id__in=ids) | Q(slug__in=slugs)).order_by()
+        cards = self.get_serializer(queryset, many=True).data
+        by_id = {card["id"]: card for card in cards}
+        by_slug = {card["slug"]: card for card in cards}
+
+        results = []
+        seen = set()
+        for card in [by_id.get(pk) for pk in ids] + [by_slug.get(slug) for slug in slugs]:
+            if card is not None and card["id"] not in seen:
+                seen.add(card["id"])
+                results.append(card)
+
+        return Response(
+            {
+                "results": results,
+                "missing": {
+                    "ids": [pk for pk in ids if pk not in by_id],
+                    "slugs": [slug for slug in slugs if slug not in by_slug],
+                },
+                "unavailable": [card["id"] for card in results if not card["is_available"]],
+            }
+        )
+
+    @action(detail=True, methods=["get"], url_path="similar")
+    def similar(self, request, *args, **kwargs):
+        """
+        Похожие товары для карточки: {"results": [лёгкие карточки]} в порядке оценки.
+        Список посчитан заранее (SimilarProduct), здесь только чтение по индексу.
+        """
+        return self.conditional_response(
+            request,
+            functools.partial(self.cached_response, request, functools.partial(self._similar, request)),
+        )
+
+    def _similar(self, request):
+        slug = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+        product_id = get_object_or_404(
+            Product.objects.filter(is_active=True, is_available=True).values_list("id", flat=True),
+            slug=slug,
+        )
+        queryset = (
+            self.get_queryset()
+            .filter(similar_to__product_id=product_id)
+            .order_by("similar_to__position")
+        )
+        return Response({"results": self.get_serializer(queryset, many=True).data})
+
+    @action(detail=False, methods=["get"], url_path="changes")
+    def changes(self, request, *args, **kwargs):
+        """
+        {"results": [лёгкие карточки], "deleted": [id], "next": токен, "has_more": bool}
+
+        results — товары, изменённые после since (в порядке изменений), deleted — удалённые
+        и снятые с витрины. Дальше ходим с ?since=<next>, пока has_more.
+        Без since — пустой ответ с текущим токеном: берём его ДО выгрузки каталога
+        (/snapshot/ или список), чтобы не пропустить изменения во время выгрузки.
+        410 — токен старше хранимого журнала, каталог нужно выгрузить заново.
+        """
+        token = request.query_params.get("since")
+        if not token:
+            return Response({"results": [], "deleted": [], "next": current_token(), "has_more": False})
+
+        try:
+            batch = read_changes(decode_token(token))
+        except InvalidToken:
+            return Response({"detail": "Invalid token"}, status=400)
+        except TokenExpired:
+            return Response({"detail": "Token expired, reload the catalog"}, status=410)
+
+        cards = {}
+        if batch.upserted:
+            queryset = self.get_queryset().filter(id__in=batch.upserted).order_by()
+            cards = {card["id"]: card for card in self.get_serializer(queryset, many=True).data}
+        # изменённый, но уже не на витрине (is_active / is_available) — для клиента удалён
+        hidden = [pk for pk in batch.upserted if pk not in cards]
+
+        return Response(
+            {
+                "results": [cards[pk] for pk in batch.upserted if pk in cards],
+                "deleted": batch.deleted + hidden,
+                "next": encode_token(batch.last_id),
+                "has_more": batch.has_more,
+            }
+        )
+
+    @action(detail=False, methods=["get"], url_path="facets")
+    def facets(self, request, *args, **kwargs):
+        """
+        Счётчики для сайдбара фильтров по текущим фильтрам (те же параметры, что у списка):
+        категории, ценовые диапазоны, акции, наличие. Один GROUP BY category_id
+        с условными COUNT-ами, итоги складываем в Python.
+        Группируем все активные товары, включая закончившиеся: список их не показывает,
+        поэтому остальные счётчики берут только is_available=True, а наличие — обе части.
+        """
+        return self.conditional_response(
+            request,
+            functools.partial(self.cached_response, request, functools.partial(self._facets, request)),
+        )
+
+    def _facets(self, request):
+        edges = [Decimal(str(e)) for e in getattr(settings, "CATALOG_FACET_PRICE_BUCKETS", (0, 100, 500, 1000, 5000))]
+        live = Q(is_available=True)
+        aggregates = {
+            "total": Count("id", filter=live),
+            "promotion": Count("id", filter=live & Q(promotion=True)),
+            "out_of_stock": Count("id", filter=Q(is_available=False)),
+        }
+        for i, lower in enumerate(edges):
+            bucket = live & Q(price__gte=lower)
+            if i + 1 < len(edges):
+                bucket &= Q(price__lt=edges[i + 1])
+            aggregates[f"price_{i}"] = Count("id", filter=bucket)
+
+        # без get_queryset(): select_related/only/prefetch для GROUP BY не нужны
+        queryset = self.filter_queryset(Product.objects.filter(is_active=True))
+        rows = list(queryset.order_by().values("category_id").annotate(**aggregates))
+
+        total = sum(row["total"] for row in rows)
+        promotion = sum(row["promotion"] for row in rows)
+        out_of_stock = sum(row["out_of_stock"] for row in rows)
+
+        index = get_category_index()
+        categories = []
+        for row in sorted(rows, key=lambda r: -r["total"]):
+            node = index.by_id.get(row["category_id"])
+            if node is None or not row["total"]:
+                continue
+            categories.append({"id": node.pk, "slug": node.slug, "name": node.name, "count": row["total"]})
+
+        price = []
+        for i, lower in enumerate(edges):
+            upper = edges[i + 1] if i + 1 < len(edges) else None
+            price.append(
+                {
+                    "min": str(lower),
+                    "max": str(upper) if upper is not None else None,
+                    "count": sum(row[f"price_{i}"] for row in rows),
+                }
+            )
+
+        data = {
+            "count": total,
+            "categories": categories,
+            "price": price,
+            "promotion": {"true": promotion, "false": total - promotion},
+            "in_stock": {"true": total, "false": out_of_stock},
+        }
+        if getattr(request, "search_truncated", False):
+            data["search_truncated"] = True
+        return Response(data)
+
+
+# ===== автодополнение =====
+class CatalogSuggestAPIView(APIView):
+    """
+    GET /suggest/?q=бум&limit=10 -> {"products": [{id, slug, name}], "categories": [...]}
+    Лёгкая замена /products/?search= на каждое нажатие клавиши: без сериализаторов,
+    картинок и COUNT — только префиксный индекс в памяти.
+    """
+
+    permission_classes = [AllowAny]
+    default_limit = 10
+    max_limit = 20
+
+    def get(self, request, *args, **kwargs):
+        query = (request.query_params.get("q") or "").strip()
+        limit = min(max(_to_int(request.query_params.get("limit"), default=self.default_limit), 1), self.max_limit)
+        if not query:
+            return Response({"products": [], "categories": []})
+
+        product_search_index.ensure_fresh()
+        return Response(
+            {
+                "products": product_search_index.suggest(query, limit),
+                "categories": get_category_index().suggestions.lookup(query, limit),
+            }
+        )
+
+
+# ===== снимок каталога =====
+class CatalogSnapshotAPIView(APIView):
+    """
+    GET /snapshot/ -> все активные товары одним файлом NDJSON (gzip), карточки как в /products/.
+    Для агрегаторов, BI и холодного старта приложения вместо обхода /products/ по страницам.
+    ETag + Range: клиент докачивает оборванную загрузку и не качает неизменившийся файл.
+    """
+
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def get(self, request, *args, **kwargs):
+        # пересборка (только изменившихся блоков) — при первом запросе после изменения каталога
+        return snapshot_response(request, get_snapshot())
+
+
+# ===== служебная статистика =====
+class CatalogStatsAPIView(APIView):
+    """
+    GET /stats/ -> кэш ответов, поисковый индекс, очереди картинок и похожих товаров (только для staff).
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(
+            {
+                "catalog_version": get_version(),
+                "response_cache": response_cache_stats.snapshot(),
+                "detail_cache": product_detail_cache.stats.snapshot(),
+                "search_index": product_search_index.stats(),
+                "similar_refresh": similar_refresh.stats(),
+                # очередь и время — этого процесса сервера; pending/failed — по всей БД
+                "image_jobs": {
+                    **image_jobs.stats(),
+                    "pending_images": ProductImage.objects.filter(status=ProductImage.PENDING).count(),
+                    "failed_images": ProductImage.objects.filter(status=ProductImage.FAILED).count(),
+                },
+            }
+        )
 
 
 def _verify_signature(raw_body: bytes, signature: str) -> bool:
@@ -345,7 +771,7 @@ def _normalize_image_url(url: str) -> str:
     return u
 
 
-def sync_product_images(product, images_payload):
+def sync_product_images(product, images_payload, downloader=None):
     """
     images_payload (NurCRM):
       [
@@ -357,13 +783,18 @@ def sync_product_images(product, images_payload):
     - Скачивает новые изображения и сохраняет в ProductImage (ProcessedImageField -> WEBP)
     - Не качает повторно (по source_url)
     - Удаляет изображения, которые пропали в CRM (только те, у которых source_url заполнен)
+
+    downloader — загрузки всего вебхука (общий бюджет времени, см. downloads.py);
+    без него — свой на этот товар.
     """
     if not product or getattr(product, "pk", None) is None:
         return
+    if downloader is None:
+        with ImageDownloader() as downloader:
+            return sync_product_images(product, images_payload, downloader)
 
     item = {"images": images_payload or []}
     incoming_urls = _extract_image_urls(item)
-    max_bytes = int(getattr(settings, "CRM_WEBHOOK_MAX_IMAGE_BYTES", 10_000_000) or 10_000_000)
 
     stats = {"added": 0, "deleted": 0, "skipped": 0, "failed": 0}
     errors = []
@@ -386,6 +817,13 @@ def sync_product_images(product, images_payload):
         stats["deleted"] += len(to_delete)
         ProductImage.objects.filter(product=product, source_url__in=list(to_delete)).delete()
 
+    # все новые картинки качаются параллельно, сохраняются — в порядке CRM
+    downloader.prefetch(
+        url
+        for url in map(_normalize_image_url, incoming_urls)
+        if url not in current_urls and url.startswith(("http://", "https://"))
+    )
+
     # add new
     for idx, url in enumerate(incoming_urls):
         url = _normalize_image_url(url)
@@ -402,55 +840,18 @@ def sync_product_images(product, images_payload):
             errors.append({"url": url, "error": "unsupported scheme"})
             continue
         try:
-            resp = requests.get(
-                url,
-                timeout=12,
-                stream=True,
-                headers={"User-Agent": "Ak-KagazWebhook/1.0"},
-            )
-            if resp.status_code >= 400:
-                logger.warning("CRM image download failed: status=%s url=%s", resp.status_code, url)
-                stats["failed"] += 1
-                errors.append({"url": url, "error": f"http {resp.status_code}"})
-                continue
-
-            content_type = (resp.headers.get("Content-Type") or "").lower()
-            if content_type and not content_type.startswith("image/"):
-                logger.warning("CRM image has non-image content-type: %s url=%s", content_type, url)
+            download = downloader.get(url)
+            if download.error:
+                logger.warning("CRM image download failed: %s url=%s", download.error, url)
                 stats["failed"] += 1
-                errors.append({"url": url, "error": f"content-type {content_type}"})
-                continue
-
-            content_length = resp.headers.get("Content-Length")
-            if content_length:
-                try:
-                    if int(content_length) > max_bytes:
-                        logger.warning("CRM image too large: bytes=%s url=%s", content_length, url)
-                        stats["failed"] += 1
-                        errors.append({"url": url, "error": "too large"})
-                        continue
-                except Exception:
-                    pass
-
-            chunks = []
-            total = 0
-            for chunk in resp.iter_content(chunk_size=64 * 1024):
-                if not chunk:
-                    continue
-                total += len(chunk)
-                if total > max_bytes:
-                    logger.warning("CRM image exceeded max bytes while streaming: url=%s", url)
-                    stats["failed"] += 1
-                    errors.append({"url": url, "error": "too large"})
-                    chunks = None
-                    break
-                chunks.append(chunk)
-            if chunks is None:
+                errors.append({"url": url, "error": download.error})
                 continue
 
             filename = _filename_from_url(url, fallback_name=f"{product.external_id or product.pk}-{idx}.img")
-            pi = ProductImage(product=product, source_url=url)
-            pi.image.save(filename, ContentFile(b"".join(chunks)), save=True)
+            # файл ещё не в storage: ProductImage.save() сохранит его как есть и поставит
+            # в очередь фоновой обработки (images.py) — вебхук не ждёт WEBP
+            pi = ProductImage(product=product, source_url=url, image=ContentFile(download.content, name=filename))
+            pi.save()
             stats["added"] += 1
         except Exception as e:
             logger.exception("CRM image sync failed: url=%s product_id=%s", url, product.pk)
@@ -473,6 +874,34 @@ def sync_product_images(product, images_payload):
     return stats, errors[:10]
 
 
+def _missing_image_urls(items):
+    """
+    URL картинок всех товаров вебхука, которых у своего товара ещё нет, — в порядке
+    вебхука. Их можно начать качать до разбора первого товара.
+    """
+    wanted = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        external_id = _to_uuid(item.get("id") or item.get("product_id") or item.get("external_id"))
+        for url in _extract_image_urls({"images": item.get("images") or []}):
+            url = _normalize_image_url(url)
+            if url.startswith(("http://", "https://")):
+                wanted.append((external_id, url))
+    if not wanted:
+        return []
+
+    existing = set(
+        ProductImage.objects
+        .filter(
+            product__external_id__in={external_id for external_id, _ in wanted if external_id},
+            source_url__in={url for _, url in wanted},
+        )
+        .values_list("product__external_id", "source_url")
+    )
+    return list(dict.fromkeys(url for external_id, url in wanted if (external_id, url) not in existing))
+
+
 def _filename_from_url(url: str, fallback_name: str):
     try:
         path = urlparse(url).path or ""
@@ -486,7 +915,7 @@ def _filename_from_url(url: str, fallback_name: str):
     return base
 
 
-def _upsert_product_from_crm_item(item):
+def _upsert_product_from_crm_item(item, downloader=None):
     external_id_raw = item.get("id") or item.get("product_id") or item.get("external_id")
     external_id = _to_uuid(external_id_raw)
     if not external_id:
@@ -635,7 +1064,7 @@ def _upsert_product_from_crm_item(item):
     if bool(getattr(settings, "CRM_WEBHOOK_SYNC_IMAGES", True)):
         images_payload = item.get("images") or []
         if images_payload:
-            image_stats, image_errors = sync_product_images(obj, images_payload)
+            image_stats, image_errors = sync_product_images(obj, images_payload, downloader)
 
     return external_id, created, saved, image_stats, image_errors
 
@@ -715,39 +1144,44 @@ class CRMProductsWebhookAPIView(APIView):
         images = {"added": 0, "deleted": 0, "skipped": 0, "failed": 0}
         image_errors = []
 
-        for idx, item in enumerate(items):
-            try:
-                external_id, created, saved, image_stats, per_item_image_errors = _upsert_product_from_crm_item(item)
-                if created:
-                    created_count += 1
-                elif saved:
-                    updated_count += 1
-                else:
-                    skipped_count += 1
-
-                if image_stats:
-                    for k in images.keys():
-                        images[k] += int(image_stats.get(k, 0) or 0)
-                if per_item_image_errors and len(image_errors) < 20:
-                    image_errors.extend(per_item_image_errors[: (20 - len(image_errors))])
-
-                logger.info(
-                    "CRM webhook processed product: path=%s external_id=%s created=%s saved=%s",
-                    request.path,
-                    external_id,
-                    created,
-                    saved,
-                )
-                if per_item_image_errors:
-                    logger.warning(
-                        "CRM webhook image errors: path=%s external_id=%s errors=%s",
+        with ImageDownloader() as downloader:
+            if bool(getattr(settings, "CRM_WEBHOOK_SYNC_IMAGES", True)):
+                downloader.prefetch(_missing_image_urls(items))
+            for idx, item in enumerate(items):
+                try:
+                    external_id, created, saved, image_stats, per_item_image_errors = _upsert_product_from_crm_item(
+                        item, downloader
+                    )
+                    if created:
+                        created_count += 1
+                    elif saved:
+                        updated_count += 1
+                    else:
+                        skipped_count += 1
+
+                    if image_stats:
+                        for k in images.keys():
+                            images[k] += int(image_stats.get(k, 0) or 0)
+                    if per_item_image_errors and len(image_errors) < 20:
+                        image_errors.extend(per_item_image_errors[: (20 - len(image_errors))])
+
+                    logger.info(
+                        "CRM webhook processed product: path=%s external_id=%s created=%s saved=%s",
                         request.path,
                         external_id,
-                        per_item_image_errors[:3],
+                        created,
+                        saved,
                     )
-            except Exception as e:
-                logger.exception("CRM webhook failed to process item #%s: path=%s", idx, request.path)
-                errors.append({"index": idx, "error": str(e)})
+                    if per_item_image_errors:
+                        logger.warning(
+                            "CRM webhook image errors: path=%s external_id=%s errors=%s",
+                            request.path,
+                            external_id,
+                            per_item_image_errors[:3],
+                        )
+                except Exception as e:
+                    logger.exception("CRM webhook failed to process item #%s: path=%s", idx, request.path)
+                    errors.append({"index": idx, "error": str(e)})
 
         status_code = 200 if not errors else 207  # Multi-Status
         return Response(
@@ -0,0 +1,26 @@
+"""
+Превью (srcset) картинок новостей, загруженных до появления превью
+или после смены IMAGE_RENDITION_WIDTHS. Готовые не пересоздаются.
+
+    python manage.py news_renditions
+"""
+from django.core.management.base import BaseCommand
+
+from apps.main.models import News
+from apps.utils import generate_renditions, renditions_outdated
+
+
+class Command(BaseCommand):
+    help = "Создаёт превью картинок новостей."
+
+    def handle(self, *args, **options):
+        changed = 0
+        for news in News.objects.exclude(image="").exclude(image__isnull=True).only("id", "image"):
+            image = news.image
+            if not image.storage.exists(image.name):
+                continue
+            if not renditions_outdated(image):
+                continue
+            generate_renditions(image)
+            changed += 1
+        self.stdout.write(f"renditions: {changed} updated")
@@ -1,5 +1,6 @@
 from django.db import models
 from imagekit.models import ProcessedImageField
+from apps.utils import generate_renditions, is_new_upload
 import uuid
 
 class StaticPage(models.Model):
@@ -132,7 +133,14 @@ class News(models.Model):
 
     def __str__(self) -> str:
         return self.title
-    
+
+    def save(self, *args, **kwargs):
+        # превью (srcset) — только для нового файла; сам файл ужимает ProcessedImageField
+        new_image = is_new_upload(self.image)
+        super().save(*args, **kwargs)
+        if new_image:
+            generate_renditions(self.image)
+
 
 class ExternalProduct(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -1,6 +1,8 @@
 # serializers.py
 from rest_framework import serializers
 
+from apps.utils import rendition_srcset
+
 from .models import StaticPage, News
 
 
@@ -37,6 +39,7 @@ class StaticPageSerializer(serializers.ModelSerializer):
 
 class NewsListSerializer(serializers.ModelSerializer):
     image_url = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = News
@@ -47,6 +50,7 @@ class NewsListSerializer(serializers.ModelSerializer):
             "preview_text",
             "image",
             "image_url",
+            "image_srcset",
             "is_published",
             "published_at",
         )
@@ -58,6 +62,19 @@ class NewsListSerializer(serializers.ModelSerializer):
             return request.build_absolute_uri(url) if request else url
         return None
 
+    def get_image_srcset(self, obj):
+        # превью 160/320/640/1280 рядом с картинкой (apps.utils.generate_renditions)
+        if not obj.image:
+            return None
+        request = self.context.get("request")
+        storage = obj.image.storage
+
+        def build_url(name):
+            url = storage.url(name)
+            return request.build_absolute_uri(url) if request else url
+
+        return rendition_srcset(obj.image.name, build_url, storage)
+
 
 class NewsDetailSerializer(serializers.ModelSerializer):
     image_url = serializers.SerializerMethodField()
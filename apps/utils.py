@@ -1,27 +1,37 @@
 from io import BytesIO
 from PIL import Image
+from django.conf import settings
+from django.core.cache import cache
 from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
+import hashlib
 import os
 import string
 import random
+import time
 
 
 def get_product_upload_path(instance, filename):
-    return os.path.join("products", str(instance.product_id), filename)
+    """
+    Картинки товаров лежат по хешу содержимого (content_key): products/store/ab/<key>.webp —
+    одно фото варианта (цвет, размер) на все товары, где оно есть.
+    """
+    return os.path.join("products", "store", filename[:2], filename)
 
 
 def get_random_string(length):
     return "".join(random.choice(string.ascii_uppercase + string.digits) for _ in range(length))
 
 
-def rename_upload_file(image, filename=None, *, quality=82, max_side=1600):
+def is_new_upload(image) -> bool:
     """
-    1) Переименовывает файл
-    2) Конвертирует ВСЕ изображения в WEBP (сжатие)
+    В поле пришёл новый файл, ещё не записанный в storage (загрузка в админке,
+    вебхук CRM). Уже сохранённая картинка -> False: обычный save() её не трогает.
     """
-    img = Image.open(image)
+    return bool(image) and not image._committed
 
-    # resize (по желанию)
+
+def _fit(img, max_side):
     w, h = img.size
     if max(w, h) > max_side:
         if w >= h:
@@ -31,19 +41,204 @@ def rename_upload_file(image, filename=None, *, quality=82, max_side=1600):
             new_h = max_side
             new_w = int(w * (max_side / h))
         img = img.resize((new_w, new_h), Image.LANCZOS)
+    return img
+
 
+def _webp_ready(img):
     # WEBP: сохраняем с альфой если есть, иначе RGB
     has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
-    img = img.convert("RGBA" if has_alpha else "RGB")
+    return img.convert("RGBA" if has_alpha else "RGB")
+
+
+def _encode_webp(img, quality, method) -> bytes:
+    buffer = BytesIO()
+    img.save(buffer, format="WEBP", quality=quality, method=method)
+    return buffer.getvalue()
+
+
+# ===== хранилище по содержимому =====
+def content_key(image, *, quality=82, max_side=1600) -> str:
+    """
+    Хеш загруженных байт и параметров обработки — имя файла в хранилище.
+    Те же байты с теми же параметрами -> тот же готовый WEBP.
+    """
+    digest = hashlib.blake2b(f"webp:q{quality}:s{max_side}:".encode("ascii"), digest_size=20)
+    for chunk in image.file.chunks():
+        digest.update(chunk)
+    image.file.seek(0)
+    return digest.hexdigest()
+
+
+def key_from_name(name) -> str:
+    # products/store/ab/<key>.src.png -> <key>
+    return os.path.basename(name).split(".", 1)[0]
+
+
+def use_stored(image, filename) -> bool:
+    """
+    Файл filename уже есть в хранилище — поле ссылается на него, ничего не пишем.
+    """
+    name = image.field.generate_filename(image.instance, filename)
+    if not image.storage.exists(name):
+        return False
+    image.name = name
+    image._committed = True
+    return True
+
 
-    ext = "webp"
-    name = filename or get_random_string(15)
-    title = f"{name}.{ext}"
+def rename_upload_file(image, key=None, *, reuse=True, quality=82, max_side=1600) -> bool:
+    """
+    1) Переименовывает файл: <хеш содержимого>.webp
+    2) Конвертирует ВСЕ изображения в WEBP (сжатие)
+
+    Только для новых файлов (см. is_new_upload): результат пишется в storage как есть,
+    в обход ProcessedImageFieldFile.save — иначе imagekit кодирует WEBP второй раз.
+    Те же байты уже ужимали — берём готовый файл. -> True, если WEBP записан заново.
+    reuse=False — готовый файл уже искали по учёту ссылок (ProductImage), пишем всегда.
+    """
+    key = key or content_key(image, quality=quality, max_side=max_side)
+    title = f"{key}.webp"
+    if reuse and use_stored(image, title):
+        return False
+
+    img = _webp_ready(_fit(Image.open(image), max_side))
+    # загруженный оригинал в storage не попадал — удалять нечего
+    FieldFile.save(image, title, content=ContentFile(_encode_webp(img, quality, 6)), save=False)
+    return True
+
+
+def original_filename(image, key) -> str:
+    # <key>.src.png — исходник до фоновой обработки (apps/catalog/images.py)
+    _, ext = os.path.splitext(image.name or "")
+    return f"{key}.src{ext.lower() or '.bin'}"
+
+
+def store_original(image, key):
+    """
+    Новый файл пишется в storage без обработки, с исходным расширением — пока его
+    не ужмёт фоновый процесс (apps/catalog/images.py).
+    """
+    FieldFile.save(image, original_filename(image, key), content=image.file, save=False)
+
+
+# ===== превью разных размеров (srcset) =====
+def get_rendition_widths():
+    return tuple(sorted(getattr(settings, "IMAGE_RENDITION_WIDTHS", (160, 320, 640, 1280))))
+
+
+def rendition_name(name, width):
+    """
+    products/12/ABC.webp -> products/12/ABC.w320.webp — рядом с исходником.
+    """
+    root, _ = os.path.splitext(name)
+    return f"{root}.w{width}.webp"
 
-    new_img_bytes = BytesIO()
-    img.save(new_img_bytes, format="WEBP", quality=quality, method=6)
-    new_img_bytes.seek(0)
 
-    # удаляем старый файл и сохраняем новый webp
-    image.delete(save=False)
-    image.save(title, content=ContentFile(new_img_bytes.getvalue()), save=False)
+def rendition_widths_for(source_width):
+    # превью не шире исходника: такое было бы той же картинкой, только файлом больше
+    return tuple(width for width in get_rendition_widths() if width < source_width)
+
+
+# набор превью у файла не меняется, пока его не пересоздаст store_renditions —
+# он и обновляет запись; срок — на случай смены IMAGE_RENDITION_WIDTHS
+RENDITION_WIDTHS_TIMEOUT = 24 * 60 * 60
+
+
+def _rendition_widths_key(name):
+    return "renditions:" + hashlib.blake2b(name.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def stored_rendition_widths(storage, name) -> tuple:
+    """
+    Ширины превью, которые есть у файла. Из storage — один раз, дальше из кеша.
+    """
+    key = _rendition_widths_key(name)
+    widths = cache.get(key)
+    if widths is None:
+        widths = tuple(width for width in get_rendition_widths() if storage.exists(rendition_name(name, width)))
+        cache.set(key, widths, RENDITION_WIDTHS_TIMEOUT)
+    return widths
+
+
+def rendition_srcset(name, build_url, storage):
+    """
+    "url 160w, url 320w, ..." для <img srcset> — только из созданных превью;
+    build_url(name) -> URL файла. Картинка уже́ самого маленького превью -> None.
+    """
+    if not name:
+        return None
+    widths = stored_rendition_widths(storage, name)
+    if not widths:
+        return None
+    return ", ".join(f"{build_url(rendition_name(name, width))} {width}w" for width in widths)
+
+
+def _renditions(img, widths, quality) -> dict:
+    """
+    {ширина: байты WEBP}. От большего к меньшему: каждое превью ужимаем из предыдущего,
+    а не из оригинала. Ширины от размера картинки и больше пропускаем.
+    """
+    renditions = {}
+    for width in sorted(widths, reverse=True):
+        if width >= img.width:
+            continue
+        img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        renditions[width] = _encode_webp(img, quality, 4)
+    return renditions
+
+
+def store_renditions(storage, name, renditions: dict):
+    for width in get_rendition_widths():
+        target = rendition_name(name, width)
+        # storage.save не перезаписывает — с занятым именем придумал бы другое;
+        # лишние (от прежних правил или ширин) удаляем
+        storage.delete(target)
+        if width in renditions:
+            storage.save(target, ContentFile(renditions[width]))
+    cache.set(_rendition_widths_key(name), tuple(sorted(renditions)), RENDITION_WIDTHS_TIMEOUT)
+
+
+def renditions_outdated(image) -> bool:
+    """
+    Превью файла не совпадают с нужными для его ширины (команды пересборки превью).
+    """
+    with image.storage.open(image.name, "rb") as f, Image.open(f) as img:
+        expected = rendition_widths_for(img.width)
+    stored = tuple(width for width in get_rendition_widths() if image.storage.exists(rendition_name(image.name, width)))
+    return stored != expected
+
+
+def delete_image_files(storage, name):
+    """
+    Файл и все его превью. Вызывать только когда на файл больше никто не ссылается.
+    """
+    for target in (name, *(rendition_name(name, width) for width in get_rendition_widths())):
+        storage.delete(target)
+    cache.delete(_rendition_widths_key(name))
+
+
+def generate_renditions(image, *, quality=80):
+    """
+    Превью всех размеров из уже сохранённого файла. Вызывается один раз — когда
+    пришёл новый файл; повторный вызов перезаписывает превью.
+    """
+    with image.storage.open(image.name, "rb") as f:
+        img = Image.open(f)
+        img.load()
+    store_renditions(image.storage, image.name, _renditions(_webp_ready(img), get_rendition_widths(), quality))
+
+
+def process_image_bytes(data: bytes, widths, *, quality=82, max_side=1600, rendition_quality=80):
+    """
+    То же, что rename_upload_file + generate_renditions, но байты -> байты: без Django
+    и storage, чтобы выполняться в отдельном процессе.
+    -> (WEBP, {ширина: WEBP превью}, секунд на обработку)
+    """
+    started = time.perf_counter()
+    img = _webp_ready(_fit(Image.open(BytesIO(data)), max_side))
+    main = _encode_webp(img, quality, 6)
+    # превью — из уже ужатой картинки, как generate_renditions из сохранённого файла
+    img = Image.open(BytesIO(main))
+    img.load()
+    renditions = _renditions(img, widths, rendition_quality)
+    return main, renditions, time.perf_counter() - started
@@ -231,10 +231,79 @@ CRM_WEBHOOK_SYNC_IMAGES = True
 # Защита от слишком больших файлов
 CRM_WEBHOOK_MAX_IMAGE_BYTES = 10_000_000
 
+# Загрузка картинок вебхука (apps/catalog/downloads.py): одновременных загрузок,
+# из них к одному хосту, таймаут (connect, read) одной картинки и сколько секунд
+# всего на картинки одного вебхука — не успевшие докачает следующий вебхук
+CRM_WEBHOOK_IMAGE_WORKERS = 8
+CRM_WEBHOOK_IMAGE_PER_HOST = 4
+CRM_WEBHOOK_IMAGE_TIMEOUT = (5, 12)
+CRM_WEBHOOK_IMAGE_BUDGET = 60
+
 # NurCRM иногда присылает относительный путь вида "/media/...". Укажи базовый URL.
 # Пример: "https://app.nurcrm.kg"
 CRM_MEDIA_BASE_URL = os.environ.get("CRM_MEDIA_BASE_URL", "https://app.nurcrm.kg")
 
+# Кэш ответов каталога (/api/catalog/products/). Инвалидация по версии каталога,
+# TIMEOUT — лишь верхняя граница жизни записи. Для нескольких воркеров лучше
+# общий backend (Redis/Memcached) в CACHES, иначе у каждого процесса свой кэш.
+CATALOG_RESPONSE_CACHE_TIMEOUT = 60 * 60
+
+# Кэш детальной карточки (/products/{slug}/) по slug. Каждое попадание сверяется
+# с updated_at товара, так что правки через save()/вебхук видны сразу; TIMEOUT —
+# граница устаревания для правок в обход сигналов (queryset.update, raw SQL).
+CATALOG_DETAIL_CACHE_TIMEOUT = 5 * 60
+
+# Список товаров через .values() + заранее собранный план полей (тот же JSON,
+# что у ProductListSerializer, но в разы быстрее). False — старый путь через ModelSerializer.
+CATALOG_FAST_LIST_SERIALIZATION = True
+
+# Поиск товаров (?search=): сколько лучших по релевантности id отдаёт индекс.
+# Совпадений больше — ответ списка и фасетов помечается "search_truncated": true
+CATALOG_SEARCH_MAX_RESULTS = 1000
+
+# /api/catalog/products/facets/: границы ценовых диапазонов (последний — "от 5000")
+CATALOG_FACET_PRICE_BUCKETS = (0, 100, 500, 1000, 5000)
+
+# POST /api/catalog/products/bulk/: сколько ids + slugs можно запросить за раз
+CATALOG_BULK_LOOKUP_MAX_ITEMS = 500
+
+# /api/catalog/products/{slug}/similar/: длина списка похожих товаров и сколько
+# ближайших по цене товаров ветки категорий оцениваем при пересчёте одного списка
+CATALOG_SIMILAR_LIMIT = 12
+CATALOG_SIMILAR_CANDIDATES = 500
+# пересчёт похожих после сохранения товара — в фоновом потоке (False — сразу после commit)
+CATALOG_SIMILAR_ASYNC = os.environ.get("CATALOG_SIMILAR_ASYNC", "1") == "1"
+
+# /api/catalog/products/changes/: строк журнала за запрос и сколько дней их хранить
+# (старше — удаляет catalog_prune_changes, клиенты со старым токеном получают 410)
+CATALOG_CHANGES_PAGE_SIZE = 500
+CATALOG_CHANGES_RETENTION_DAYS = 30
+
+# Cache-Control для GET-эндпоинтов каталога: "<basename>" или "<basename>:<action>".
+# max_age — сколько клиент не спрашивает вовсе; stale_while_revalidate — сколько ещё
+# может показывать старый ответ, перепроверяя его в фоне (ETag -> обычно 304).
+CATALOG_CACHE_CONTROL = {
+    "product": {"max_age": 30, "stale_while_revalidate": 300},
+    "product:facets": {"max_age": 60, "stale_while_revalidate": 600},
+    "category": {"max_age": 300, "stale_while_revalidate": 3600},
+    "snapshot": {"max_age": 300},
+}
+
+# /api/catalog/snapshot/: NDJSON (gzip) со всеми активными товарами.
+# Блоки и манифест лежат рядом, файл пересобирается по блокам после изменения каталога.
+CATALOG_SNAPSHOT_DIR = MEDIA_ROOT / "catalog_snapshot"
+# хост для URL картинок в снимке (снимок общий для всех запросов); пусто — относительные /media/...
+CATALOG_SNAPSHOT_BASE_URL = os.environ.get("CATALOG_SNAPSHOT_BASE_URL", "")
+
+# Превью картинок товаров, категорий и новостей (srcset): ширины в px.
+# Файлы <имя>.w<ширина>.webp лежат рядом с исходником, создаются при загрузке.
+IMAGE_RENDITION_WIDTHS = (160, 320, 640, 1280)
+
+# Картинки товаров (админка, вебхук CRM) ужимаются в фоновых процессах: запись
+# сохраняется сразу со статусом "pending", готовый WEBP подменяет исходник позже.
+# Число процессов на один процесс сервера; 0 — ужимать прямо в запросе, как раньше.
+CATALOG_IMAGE_WORKERS = int(os.environ.get("CATALOG_IMAGE_WORKERS", "2"))
+
 # ===== logging (webhook) =====
 LOG_DIR = BASE_DIR / "logs"
 LOG_DIR.mkdir(parents=True, exist_ok=True)